@@ -0,0 +1,330 @@
+import os
+import re
+import json
+import heapq
+import tempfile
+import htmlentitydefs
+import HTMLParser
+from xml.sax.saxutils import escape, quoteattr
+
+# Optional build outputs, generated at the root of each locale folder
+OUTPUTS = ("sitemap", "feed", "search")
+SITEMAP = "sitemap.xml"
+FEED = "feed.xml"
+SEARCH_INDEX = "search.json"
+
+# Number of most recent pages listed in the feed
+FEED_SIZE = 20
+# Number of bytes of utf-8 text extracted from each page
+TEXT_SIZE = 4096
+SUMMARY_SIZE = 300
+
+_DATE = re.compile(r"^(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?")
+
+def w3c_date(value):
+    """w3c_date
+    Return the YYYY, YYYY-MM or YYYY-MM-DD prefix of a date variable, or
+    None if the value is not a date.
+
+    :param value:
+    """
+    match = _DATE.match(str(value)) if value is not None else None
+    if match is None:
+        return None
+    return "-".join(part for part in match.groups() if part is not None)
+
+def _utf8(value):
+    return value.encode("utf-8") if isinstance(value, unicode) else str(value)
+
+def atom_date(value):
+    date = w3c_date(value)
+    if date is None:
+        return None
+    parts = date.split("-") + ["01"] * (3 - len(date.split("-")))
+    return "%s-%s-%sT00:00:00Z" % tuple(parts)
+
+class TextExtractor(HTMLParser.HTMLParser):
+    """TextExtractor
+    Extract the title and the first characters of the text of an html page
+    from the chunks of the page, as they are written. Script and style
+    elements are ignored. The extractor is done once enough text was
+    collected, such that the rest of the page is not parsed.
+    """
+    IGNORED_TAGS = ("script", "style", "head", "noscript")
+
+    def __init__(self, size=TEXT_SIZE):
+        HTMLParser.HTMLParser.__init__(self)
+        self.size = size
+        self.done = False
+        self.title = None
+        self._title = None
+        self._ignored = 0
+        self._text = []
+        self._length = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title" and self.title is None:
+            self._title = []
+        elif tag in self.IGNORED_TAGS:
+            self._ignored += 1
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self._title is not None:
+            self.title = " ".join("".join(self._title).split())
+            self._title = None
+        elif tag in self.IGNORED_TAGS and self._ignored > 0:
+            self._ignored -= 1
+
+    def handle_data(self, data):
+        if self._title is not None:
+            self._title.append(data)
+        elif self._ignored == 0 and not self.done:
+            self._text.append(data)
+            self._length += len(data)
+            if self._length >= self.size:
+                self.done = True
+
+    def handle_entityref(self, name):
+        codepoint = htmlentitydefs.name2codepoint.get(name)
+        self.handle_data("&%s;" % name if codepoint is None else unichr(codepoint).encode("utf-8"))
+
+    def handle_charref(self, name):
+        try:
+            codepoint = int(name[1:], 16) if name[:1] in "xX" else int(name)
+            self.handle_data(unichr(codepoint).encode("utf-8"))
+        except ValueError:
+            pass
+
+    def feed(self, data):
+        if self.done:
+            return
+        try:
+            HTMLParser.HTMLParser.feed(self, data)
+        except HTMLParser.HTMLParseError:
+            # Keep the text that was extracted so far
+            self.done = True
+
+    def tee(self, chunks):
+        """tee
+        Yield the given chunks, after they were parsed.
+
+        :param chunks: iterable of str chunks.
+        """
+        for chunk in chunks:
+            self.feed(chunk)
+            yield chunk
+
+    @property
+    def text(self):
+        text = " ".join("".join(self._text).split())
+        return text[:self.size].decode("utf-8", "ignore")
+
+class Collector(object):
+    """Collector
+    Build outputs that describe all the pages of a locale: a sitemap with
+    hreflang alternates for multi-locale builds, an Atom feed of the most
+    recent pages and a search index of the text of each page. Pages are
+    collected while they are rendered, from the metadata of the environment
+    and the text of the rendered page; entries are appended to temporary
+    files, such that memory usage does not grow with the size of pages, and
+    are written sorted by url, such that outputs do not depend on the order
+    in which pages were rendered.
+
+    :param outputs: names of the generated OUTPUTS.
+    :param base_url: url of the root of the website; required by the sitemap
+    and the feed.
+    :param locale: locale of the collected pages.
+    :param locales: all generated locales, if each locale is generated in its
+    own folder.
+    """
+    def __init__(self, outputs, base_url=None, locale=None, locales=None):
+        for name in outputs:
+            if name not in OUTPUTS:
+                raise ValueError("Unknown build output: %s" % name)
+        if base_url is None and ("sitemap" in outputs or "feed" in outputs):
+            raise ValueError("A base url is required by the sitemap and the feed")
+        self.outputs = outputs
+        self.base_url = "/" if base_url is None else base_url.rstrip("/") + "/"
+        self.locale = locale
+        self.locales = locales or []
+        self._files = dict((name, tempfile.TemporaryFile()) for name in outputs
+                           if name != "feed")
+        # (path, offset, length) of the entries of each temporary file
+        self._offsets = dict((name, []) for name in self._files)
+        # Heap of the (date, url, title, summary) of the most recent pages
+        self._feed = []
+        self._feed_title = None
+        self._feed_author = None
+
+    def url(self, path, locale=None):
+        """url
+        Return the absolute url of a page.
+
+        :param path: path of the page, relative to the locale folder.
+        :param locale:
+        """
+        if self.locales:
+            path = "%s/%s" % (locale or self.locale, path)
+        return self.base_url + path
+
+    def extractor(self):
+        """extractor
+        Return a TextExtractor for the next page, or None if no output uses
+        the text of pages.
+        """
+        if "feed" in self.outputs or "search" in self.outputs:
+            return TextExtractor()
+        return None
+
+    def add(self, env, template_name, path, extractor=None):
+        """add
+        Collect a rendered page.
+
+        :param env: jinjaenv.Environment
+        :param template_name: name of the rendered template or alias.
+        :param path: path of the generated file, relative to the locale folder.
+        :param extractor: TextExtractor that parsed the page.
+        """
+        if not path.endswith(".html"):
+            return
+        if path == "index.html" or path.endswith("/index.html"):
+            path = path[:-len("index.html")]
+        variables = env.lookup(template_name, None)
+        title = variables.get("title")
+        if title is None and extractor is not None:
+            title = extractor.title
+        text = u"" if extractor is None else extractor.text
+        date = variables.get("date")
+        if template_name == "index.html":
+            if title is not None:
+                self._feed_title = title
+            self._feed_author = variables.get("author")
+
+        if "sitemap" in self.outputs:
+            self._write_sitemap_entry(path, w3c_date(date))
+        if "search" in self.outputs:
+            self._write_entry("search", path,
+                              json.dumps({"url": self.url(path), "title": title, "text": text}))
+        if "feed" in self.outputs and atom_date(date) is not None:
+            item = (atom_date(date), path, title, text[:SUMMARY_SIZE])
+            if len(self._feed) < FEED_SIZE:
+                heapq.heappush(self._feed, item)
+            else:
+                heapq.heappushpop(self._feed, item)
+
+    def _write_sitemap_entry(self, path, date):
+        lines = ["<url><loc>%s</loc>" % escape(self.url(path))]
+        if date is not None:
+            lines.append("<lastmod>%s</lastmod>" % date)
+        for locale in self.locales:
+            lines.append('<xhtml:link rel="alternate" hreflang=%s href=%s/>'
+                         % (quoteattr(locale.replace("_", "-")), quoteattr(self.url(path, locale))))
+        lines.append("</url>\n")
+        self._write_entry("sitemap", path, "".join(lines))
+
+    def _write_entry(self, name, path, entry):
+        f = self._files[name]
+        f.seek(0, os.SEEK_END)
+        self._offsets[name].append((path, f.tell(), len(entry)))
+        f.write(entry)
+
+    def _read_entries(self, name):
+        f = self._files[name]
+        for path, offset, length in sorted(self._offsets[name]):
+            f.seek(offset)
+            yield f.read(length)
+
+    def add_file(self, env, template_name, path, file_path):
+        """add_file
+        Collect a page that was generated by a previous build.
+
+        :param env: jinjaenv.Environment
+        :param template_name:
+        :param path: path of the generated file, relative to the locale folder.
+        :param file_path: absolute path of the generated file.
+        """
+        extractor = None
+        if path.endswith(".html"):
+            extractor = self.extractor()
+        if extractor is not None:
+            with open(file_path, "rb") as f:
+                while not extractor.done:
+                    chunk = f.read(TEXT_SIZE)
+                    if not chunk:
+                        break
+                    extractor.feed(chunk)
+        self.add(env, template_name, path, extractor)
+
+    def sitemap(self):
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"'
+               ' xmlns:xhtml="http://www.w3.org/1999/xhtml">\n')
+        for entry in self._read_entries("sitemap"):
+            yield entry
+        yield "</urlset>\n"
+
+    def feed(self):
+        # Most recent first, then by url
+        entries = sorted(sorted(self._feed, key=lambda entry: entry[1]),
+                         key=lambda entry: entry[0], reverse=True)
+        feed_url = self.url(FEED)
+        title = self._feed_title or self.url("")
+        # Atom requires an author, which entries inherit from the feed
+        author = self._feed_author or title
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<feed xmlns="http://www.w3.org/2005/Atom"%s>\n' % (
+            "" if self.locale is None else " xml:lang=%s" % quoteattr(self.locale.replace("_", "-")))
+        yield "<title>%s</title>\n" % escape(_utf8(title))
+        yield "<author><name>%s</name></author>\n" % escape(_utf8(author))
+        yield "<id>%s</id>\n" % escape(feed_url)
+        yield '<link rel="self" href=%s/>\n' % quoteattr(feed_url)
+        yield '<link href=%s/>\n' % quoteattr(self.url(""))
+        yield "<updated>%s</updated>\n" % (entries[0][0] if entries else "1970-01-01T00:00:00Z")
+        for date, path, title, summary in entries:
+            url = self.url(path)
+            title = path if title is None else title
+            yield "<entry><title>%s</title><id>%s</id><link href=%s/><updated>%s</updated>" % (
+                escape(_utf8(title)),
+                escape(url), quoteattr(url), date)
+            yield "<summary>%s</summary></entry>\n" % escape(_utf8(summary))
+        yield "</feed>\n"
+
+    def search_index(self):
+        yield "["
+        for i, entry in enumerate(self._read_entries("search")):
+            yield entry if i == 0 else ",\n" + entry
+        yield "]"
+
+    def write(self, writer, dst_path):
+        """write
+        Write the collected outputs at the root of the destination folder.
+
+        :param writer: output.Writer
+        :param dst_path: destination folder of the locale.
+        """
+        generators = {"sitemap": (SITEMAP, self.sitemap), "feed": (FEED, self.feed),
+                      "search": (SEARCH_INDEX, self.search_index)}
+        for name in self.outputs:
+            filename, generator = generators[name]
+            writer.write(os.path.join(dst_path, filename), generator())
+        self.close()
+
+    def close(self):
+        for f in self._files.itervalues():
+            f.close()
+        self._files = {}
+
+def sitemap_index(base_url, locales):
+    """sitemap_index
+    Return the sitemap index that lists the sitemaps of each locale.
+
+    :param base_url:
+    :param locales:
+    """
+    base_url = base_url.rstrip("/") + "/"
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
+    for locale in locales:
+        lines.append("<sitemap><loc>%s</loc></sitemap>\n" % escape(base_url + locale + "/" + SITEMAP))
+    lines.append("</sitemapindex>\n")
+    return "".join(lines)
@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+"""
+Benchmark Prodigal on synthetic websites. Usage:
+
+    python -m prodigal.benchmark --pages 10000 --output results.json
+    python -m prodigal.benchmark --pages 10000 --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import httplib
+
+import cache
+import tools
+import translate
+import httpserver
+
+def make_site(src_path, pages=100, depth=3, trans=5, posts=20, media_files=10, media_size=10240,
+              sidebar=0):
+    """make_site
+    Write a synthetic website to src_path.
+
+    :param src_path:
+    :param pages: number of regular pages.
+    :param depth: number of levels of template inheritance.
+    :param trans: number of {% trans %} blocks per page.
+    :param posts: number of blog posts registered with add_blog_post.
+    :param media_files: number of files in the static media folder.
+    :param media_size: size of each media file, in bytes.
+    :param sidebar: number of latest posts listed, with their title and
+    date, on every page.
+    """
+    def write(name, content):
+        path = os.path.join(src_path, name)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(path, "w") as f:
+            f.write(content)
+
+    # Inheritance chain: _base0.html <- _base1.html <- ...
+    write("_base0.html", "<!DOCTYPE html>\n<html><head><title>{%% block title %%}Benchmark"
+          "{%% endblock %%}</title></head>\n<body>{%% block content %%}{%% endblock %%}"
+          "<ul>{%% for post in %d|latest_pages %%}<li><a href=\"/{{ post }}\">{{ post|get_title }}"
+          "</a> {{ post|get_date }}</li>{%% endfor %%}</ul></body></html>\n" % sidebar)
+    for level in range(1, depth):
+        write("_base%d.html" % level, "{%% extends '_base%d.html' %%}\n"
+              "{%% block content %%}<div class=\"level%d\">{%% block level%d %%}{%% endblock %%}"
+              "{{ super() }}</div>{%% endblock %%}\n" % (level - 1, level, level))
+    parent = "_base%d.html" % (depth - 1)
+
+    for page in range(pages):
+        blocks = "\n".join("<p>{%% trans %%}Sentence %d of the benchmark website.{%% endtrans %%}</p>"
+                           % (page * trans + t) for t in range(trans))
+        write(os.path.join("pages", "%03d" % (page / 1000), "page%d.html" % page),
+              "{%% extends '%s' %%}\n{%% block title %%}Page %d{%% endblock %%}\n"
+              "{%% block content %%}\n%s\n{%% endblock %%}\n" % (parent, page, blocks))
+
+    write(os.path.join("blog", "_post.html"), "{%% extends '%s' %%}\n"
+          "{%% block content %%}{%% include post %%}{%% endblock %%}\n" % parent)
+    config = ["{{ 'static'|add_media }}", "{{ 'blog/_post.html'|set_blog_template }}"]
+    for post in range(posts):
+        write(os.path.join("blog", "_post%d.html" % post),
+              "<h2>Post %d</h2>\n<p>{%% trans %%}Content of a blog post.{%% endtrans %%}</p>\n" % post)
+        config.append("{{ 'blog/_post%d.html'|add_blog_post('post%d', 'Post #%d', '2013-%02d-%02d') }}"
+                      % (post, post, post, post / 28 % 12 + 1, post % 28 + 1))
+    write("_config.html", "\n".join(config) + "\n")
+    write("index.html", "{%% extends '%s' %%}\n{%% block content %%}<ul>\n"
+          "{%% for page in 10|latest_pages %%}<li><a href=\"{{ page }}\">{{ page|get_title }}</a></li>"
+          "{%% endfor %%}\n</ul>{%% endblock %%}\n" % parent)
+
+    for index in range(media_files):
+        write(os.path.join("static", "file%d.bin" % index), os.urandom(media_size))
+
+def _timed(fn, *args, **kwargs):
+    start = time.time()
+    fn(*args, **kwargs)
+    return time.time() - start
+
+def _request_time(connection, path):
+    start = time.time()
+    connection.request("GET", path)
+    connection.getresponse().read()
+    return time.time() - start
+
+def benchmark_serve(src_path, locale, requests=20):
+    """benchmark_serve
+    Return the mean time of cold requests (first request to each page) and
+    warm requests (subsequent requests to the same pages).
+
+    :param src_path:
+    :param locale:
+    :param requests: number of distinct pages that are requested.
+    """
+    httpd = httpserver.make_server(src_path, locale, "127.0.0.1:0")
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    connection = httplib.HTTPConnection(*httpd.socket.getsockname())
+    paths = ["/pages/%03d/page%d.html" % (page / 1000, page) for page in range(requests)]
+    try:
+        cold = sum(_request_time(connection, path) for path in paths)
+        warm = sum(_request_time(connection, path) for path in paths)
+    finally:
+        connection.close()
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+    return cold / len(paths), warm / len(paths)
+
+def run(work_path, pages=100, depth=3, trans=5, posts=20, media_files=10, media_size=10240,
+        jobs=1, requests=20, sidebar=0):
+    """run
+    Generate a synthetic website in work_path and measure the duration of
+    the main Prodigal operations, in seconds.
+
+    :param work_path: empty folder.
+    """
+    src_path = os.path.join(work_path, "src")
+    dst_path = os.path.join(work_path, "dst")
+    results = {}
+    results["make_site"] = _timed(make_site, src_path, pages, depth, trans, posts,
+                                  media_files, media_size, sidebar)
+    results["translate"] = _timed(tools.translate_templates, "fr", src_path)
+    results["translate_incremental"] = _timed(tools.translate_templates, "fr", src_path)
+    results["compile"] = _timed(translate.compile, os.path.join(src_path, "fr.po"))
+    results["generate_cold"] = _timed(tools.generate, src_path, dst_path, "fr")
+    results["generate_warm"] = _timed(tools.generate, src_path, dst_path, "fr")
+    # Average time spent on each page, once templates are compiled
+    results["generate_per_page"] = results["generate_warm"] / (pages + posts + 1)
+    results["generate_incremental_first"] = _timed(tools.generate, src_path, dst_path, "fr",
+                                                   incremental=True)
+    results["generate_incremental_noop"] = _timed(tools.generate, src_path, dst_path, "fr",
+                                                  incremental=True)
+    if jobs > 1:
+        shutil.rmtree(dst_path)
+        results["generate_jobs"] = _timed(tools.generate, src_path, dst_path, "fr", jobs=jobs)
+    shutil.rmtree(os.path.join(src_path, cache.DIRNAME))
+    requests = min(requests, pages)
+    if requests > 0:
+        results["serve_cold"], results["serve_warm"] = benchmark_serve(src_path, "fr", requests)
+    return results
+
+def compare(results, reference, threshold):
+    """compare
+    Print the relative difference between results and reference results.
+    Return the names of the operations that were slower by more than
+    `threshold` (e.g: 0.2 = 20%).
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in reference or reference[name] <= 0:
+            continue
+        ratio = results[name] / reference[name] - 1
+        print "%-28s %10.4f %10.4f %+7.1f%%" % (name, reference[name], results[name], ratio * 100)
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Prodigal on a synthetic website")
+    parser.add_argument("--pages", type=int, default=1000, help="Number of pages")
+    parser.add_argument("--depth", type=int, default=3, help="Depth of template inheritance")
+    parser.add_argument("--trans", type=int, default=5, help="Number of {% trans %} blocks per page")
+    parser.add_argument("--posts", type=int, default=100, help="Number of blog posts")
+    parser.add_argument("--sidebar", type=int, default=0,
+            help="Number of latest posts listed on every page")
+    parser.add_argument("--media-files", type=int, default=10, help="Number of media files")
+    parser.add_argument("--media-size", type=int, default=102400, help="Size of media files, in bytes")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+            help="Also measure generation with this number of processes")
+    parser.add_argument("--requests", type=int, default=20,
+            help="Number of pages requested from the HTTP server")
+    parser.add_argument("-o", "--output", help="Save results to this .json file")
+    parser.add_argument("--compare", metavar="PATH",
+            help="Compare results to a previous .json file and fail on regressions")
+    parser.add_argument("--threshold", type=float, default=0.2,
+            help="Relative slowdown that is considered a regression")
+    args = parser.parse_args()
+
+    params = dict((key, getattr(args, key)) for key in ["pages", "depth", "trans", "posts",
+                                                       "media_files", "media_size", "jobs",
+                                                       "requests", "sidebar"])
+    work_path = tempfile.mkdtemp()
+    try:
+        results = run(work_path, **params)
+    finally:
+        shutil.rmtree(work_path)
+
+    for name in sorted(results):
+        print "%-28s %10.4f s" % (name, results[name])
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({
+                "params": params,
+                "python": platform.python_version(),
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            reference = json.load(f)["results"]
+        regressions = compare(results, reference, args.threshold)
+        if regressions:
+            print "Regressions:", ", ".join(regressions)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import os
+import hashlib
+import tempfile
+import contextlib
+
+DIRNAME = ".prodigal-cache"
+
+_file_mode = None
+
+def directory(src_path, *names):
+    """directory
+    Return the path of a folder located in the cache folder of the source
+    directory. The folder is created if necessary.
+
+    :param src_path:
+    :param names:
+    """
+    path = os.path.join(src_path, DIRNAME, *names)
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Folder may have been created concurrently
+            if not os.path.isdir(path):
+                raise
+    return path
+
+def path(src_path, *names):
+    """path
+    Return the path of a file stored in the cache folder of the source
+    directory. Parent folders are created if necessary.
+
+    :param src_path:
+    :param names:
+    """
+    return os.path.join(directory(src_path, *names[:-1]), names[-1])
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), ""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_mode():
+    """file_mode
+    Return the permissions of created files, according to the umask of the
+    process. Temporary files are created with 0600 permissions instead.
+    """
+    global _file_mode
+    if _file_mode is None:
+        mask = os.umask(0)
+        os.umask(mask)
+        _file_mode = 0666 & ~mask
+    return _file_mode
+
+@contextlib.contextmanager
+def atomic_file(path):
+    """atomic_file
+    Context manager that returns a file object opened for writing, whose
+    content replaces the file at path only once it is completely written.
+    Concurrent readers see either the previous or the new content.
+
+    :param path:
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            os.fchmod(f.fileno(), file_mode())
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,151 @@
+import os
+import re
+import zlib
+import multiprocessing
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import output
+
+# Extensions of the files that are precompressed
+COMPRESSIBLE = (".html", ".htm", ".css", ".js", ".json", ".xml", ".svg", ".txt")
+# Smaller files are not worth compressing
+MIN_SIZE = 256
+# Precompressed files are siblings of the compressed file, e.g: style.css.gz
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+EXTENSIONS = (".br", ".gz")
+BUFFER_SIZE = 64 * 1024
+
+def encodings():
+    """encodings
+    Return the available encodings, by order of preference.
+    """
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+def accepted_encodings(accept_encoding):
+    """accepted_encodings
+    Return the available encodings that are accepted by a client, by order
+    of preference.
+
+    :param accept_encoding: value of the Accept-Encoding header, or None.
+    """
+    if not accept_encoding:
+        return []
+    qualities = {}
+    for item in accept_encoding.split(","):
+        name, sep, params = item.partition(";")
+        quality = 1.0
+        match = re.search(r"q\s*=\s*([0-9.]+)", params)
+        if match is not None:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+    default = qualities.get("*", 0.0)
+    return [encoding for encoding in encodings() if qualities.get(encoding, default) > 0]
+
+def compress_chunks(chunks, encoding):
+    """compress_chunks
+    Yield the chunks of the compressed content of an iterable of chunks.
+    Compressed content does not depend on the time of compression.
+
+    :param chunks: iterable of str
+    :param encoding: "gzip" or "br"
+    """
+    if encoding == "br":
+        yield brotli.compress("".join(chunks))
+        return
+    # 31 window bits: gzip container, with a null timestamp
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _read_chunks(path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), ""):
+            yield chunk
+
+def is_up_to_date(path, compressed_path):
+    """is_up_to_date
+    Return True if a precompressed file has the mtime of the file it was
+    compressed from.
+
+    :param path:
+    :param compressed_path:
+    """
+    try:
+        # utime does not preserve nanoseconds
+        return abs(os.stat(compressed_path).st_mtime - os.stat(path).st_mtime) < 0.001
+    except OSError:
+        return False
+
+def _compress_file(args):
+    path, encodings = args
+    writer = output.Writer(os.path.dirname(path))
+    st = os.stat(path)
+    for encoding in encodings:
+        compressed_path = path + SUFFIXES[encoding]
+        writer.write(compressed_path, compress_chunks(_read_chunks(path), encoding))
+        os.utime(compressed_path, (st.st_atime, st.st_mtime))
+    return len(encodings)
+
+def is_sibling(path):
+    """is_sibling
+    Return True if a file may be the precompressed sibling of a compressible
+    file, e.g: style.css.gz but not archive.tar.gz.
+
+    :param path:
+    """
+    base, ext = os.path.splitext(path)
+    return ext in EXTENSIONS and os.path.splitext(base)[1] in COMPRESSIBLE
+
+def precompress(dst_path, jobs=1, kept=()):
+    """precompress
+    Write the precompressed siblings (.gz, and .br if the brotli module is
+    available) of the compressible files of a folder. Files whose siblings
+    are up-to-date are skipped, and siblings of removed files are deleted.
+    Files are compressed in a pool of processes when jobs > 1. Return the
+    number of written siblings.
+
+    :param dst_path:
+    :param jobs: number of processes that compress files.
+    :param kept: paths of the siblings that were not written by precompress,
+    e.g: copied from a media folder; they are neither replaced nor deleted.
+    """
+    kept = set(kept)
+    tasks = []
+    for dirpath, dirnames, filenames in os.walk(dst_path):
+        names = set(filenames)
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            base, ext = os.path.splitext(filename)
+            if ext in EXTENSIONS:
+                if not is_sibling(path) or path in kept:
+                    continue
+                # Siblings of removed or small files are stale
+                if base not in names or os.path.getsize(os.path.join(dirpath, base)) < MIN_SIZE:
+                    os.remove(path)
+                continue
+            if ext not in COMPRESSIBLE or os.path.getsize(path) < MIN_SIZE:
+                continue
+            missing = [encoding for encoding in encodings()
+                       if path + SUFFIXES[encoding] not in kept
+                       and not is_up_to_date(path, path + SUFFIXES[encoding])]
+            if missing:
+                tasks.append((path, missing))
+    if jobs <= 1 or len(tasks) <= 1:
+        return sum(_compress_file(task) for task in tasks)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        written = sum(pool.imap_unordered(_compress_file, tasks, max(1, len(tasks) / (jobs * 8))))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return written
@@ -14,33 +14,90 @@ def filter(fn):
     fn.is_filter = True
     return fn
 
+def _env(env):
+    """_env
+    Return the environment that calls a filter: filters that are called from
+    templates receive it directly, while filters that are called from Python
+    code use the current environment.
+
+    :param env: jinjaenv.Environment or None.
+    """
+    return jinjaenv.get() if env is None else env
+
+@filter
+def set_date(template_name, date, env=None):
+    _env(env).set_variable(template_name, "date", date)
+    return ""
+
+@filter
+def get_date(template_name, env=None):
+    return _env(env).get_variable(template_name, "date")
+
 @filter
-def set_date(template_name, date):
-    jinjaenv.get().set_variable(template_name, "date", date)
+def set_title(template_name, title, env=None):
+    _env(env).set_variable(template_name, "title", title)
     return ""
 
 @filter
-def get_date(template_name):
-    return jinjaenv.get().get_variable(template_name, "date")
+def get_title(template_name, env=None):
+    return _env(env).get_variable(template_name, "title")
 
 @filter
-def set_title(template_name, title):
-    jinjaenv.get().set_variable(template_name, "title", title)
+def set_author(template_name, author, env=None):
+    _env(env).set_variable(template_name, "author", author)
     return ""
 
 @filter
-def get_title(template_name):
-    return jinjaenv.get().get_variable(template_name, "title")
+def get_author(template_name, env=None):
+    return _env(env).get_variable(template_name, "author")
+
+@filter
+def set_tags(template_name, tags, env=None):
+    _env(env).set_variable(template_name, "tags", list(tags))
+    return ""
+
+@filter
+def get_tags(template_name, env=None):
+    return _env(env).get_variable(template_name, "tags") or []
+
+@filter
+def latest_pages(count, env=None):
+    return _env(env).query("latest", count)
 
 @filter
-def latest_pages(count):
-    dates = [(d, t) for t, d in jinjaenv.get().templates_with_variable("date")]
-    dates.sort(reverse=True)
-    return [d[1] for d in dates[:count]]
+def pages_sorted_by(key, reverse=False, start=0, count=None, env=None):
+    return _env(env).query("sorted_by", key, reverse, start, count)
 
 @filter
-def add_alias(alias, template_name, variables={}):
-    jinjaenv.get().add_alias(alias, template_name, variables)
+def pages_with_tag(tag, count=None, env=None):
+    return _env(env).query("with_value", "tags", tag, 0, count)
+
+@filter
+def pages_with_value(key, value, count=None, env=None):
+    return _env(env).query("with_value", key, value, 0, count)
+
+@filter
+def all_values(key, env=None):
+    """all_values
+    Return the sorted (value, number of pages) pairs of a variable, e.g:
+    'tags'|all_values.
+    """
+    return _env(env).query("values", key)
+
+@filter
+def paginate(page, per_page=10, tag=None, env=None):
+    """paginate
+    Return a dict with the "items", "page" and "page_count" of a page of the
+    dated pages, from the most recent to the oldest. If tag is not None, list
+    only the pages with this tag.
+    """
+    if tag is None:
+        return _env(env).query("paginate", page, per_page)
+    return _env(env).query("paginate", page, per_page, "date", True, "tags", tag)
+
+@filter
+def add_alias(alias, template_name, variables={}, env=None):
+    _env(env).add_alias(alias, template_name, variables)
 
 @filter
 def set_blog_template(template_name):
@@ -48,15 +105,27 @@ def set_blog_template(template_name):
     BLOG_TEMPLATE = template_name
 
 @filter
-def add_blog_post(template_name, alias, title, date):
-    add_alias(alias, BLOG_TEMPLATE, {"post": template_name})
-    set_title(alias, title)
-    set_date(alias, date)
+def add_blog_post(template_name, alias, title, date, tags=(), env=None):
+    add_alias(alias, BLOG_TEMPLATE, {"post": template_name}, env=env)
+    set_title(alias, title, env=env)
+    set_date(alias, date, env=env)
+    if tags:
+        set_tags(alias, tags, env=env)
+    return ""
+
+@filter
+def add_listing(template_name, kind, per_page=10, path=None, env=None):
+    """add_listing
+    Generate paginated listing pages of the dated pages with the given
+    template: kind is "archive" (archive/, archive/page/N), "tag"
+    (tags/<tag>/...) or "year" (year/<yyyy>/...).
+    """
+    _env(env).add_listing(kind, template_name, per_page, path)
     return ""
 
 @filter
-def blog_post_content(alias):
-    return jinjaenv.get().get_variable(alias, "post")
+def blog_post_content(alias, env=None):
+    return _env(env).get_variable(alias, "post")
 
 @filter
 def add_media(folder):
@@ -0,0 +1,121 @@
+import os
+import json
+
+import cache
+
+# Front matter is a Jinja comment at the very beginning of a template, such
+# that templates render the same with or without it:
+#
+#   {#---
+#   title: Post #3
+#   date: 2014-01-10
+#   tags: [prodigal, jinja]
+#   alias: post3
+#   ---#}
+START = "{#---"
+END = "---#}"
+
+def parse_value(value):
+    """parse_value
+    Parse the value of a front matter variable: "[a, b]" is a list of
+    strings, quotes around strings are removed.
+
+    :param value:
+    """
+    value = value.strip()
+    if value.startswith("[") and value.endswith("]"):
+        return [parse_value(item) for item in value[1:-1].split(",") if item.strip()]
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+        return value[1:-1]
+    return value
+
+def parse(lines):
+    """parse
+    Return the variables of the front matter at the beginning of the given
+    lines, or None if there is no front matter. Lines are consumed only up
+    to the end of the front matter.
+
+    :param lines: iterable of lines, e.g: a file object.
+    """
+    lines = iter(lines)
+    first = next(lines, "")
+    if first.strip() != START:
+        return None
+    variables = {}
+    for line in lines:
+        line = line.decode("utf-8").strip()
+        if line == END:
+            return variables
+        if not line or line.startswith("#"):
+            continue
+        key, sep, value = line.partition(":")
+        if not sep:
+            raise ValueError("Invalid front matter line: %s" % line)
+        variables[key.strip()] = parse_value(value)
+    raise ValueError("Unterminated front matter")
+
+def read(path):
+    """read
+    Return the front matter variables of a template file, or None. Only the
+    front matter is read, not the whole file.
+
+    :param path:
+    """
+    with open(path) as f:
+        try:
+            return parse(f)
+        except ValueError as e:
+            raise ValueError("%s: %s" % (path, e))
+
+class FrontMatterCache(object):
+    """FrontMatterCache
+    Persistent record of the front matter of each template file, keyed by
+    mtime and size, such that only new and modified templates are opened by
+    the prescan.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    content = json.load(f)
+            except ValueError:
+                content = {}
+            if content.get("version") == self.VERSION:
+                self.files = content["files"]
+
+    @classmethod
+    def for_source(cls, src_path):
+        return cls(cache.path(src_path, "frontmatter.json"))
+
+    def scan(self, src_path, index):
+        """scan
+        Yield the (template name, variables) pairs of all templates with a
+        front matter, sorted by template name. The cache is saved once all
+        templates were scanned.
+
+        :param src_path:
+        :param index: tree.TreeIndex of src_path.
+        """
+        files = {}
+        for path in index.files(".html"):
+            entry = index.get(path)
+            name = os.path.relpath(path, src_path)
+            cached = self.files.get(name)
+            if cached is not None and cached["stat"] == [entry.mtime, entry.size]:
+                variables = cached["variables"]
+            else:
+                variables = read(path)
+            files[name] = {"stat": [entry.mtime, entry.size], "variables": variables}
+            if variables is not None:
+                yield name, variables
+        if files != self.files:
+            self.files = files
+            self.save()
+
+    def save(self):
+        with cache.atomic_file(self.path) as f:
+            json.dump({"version": self.VERSION, "files": self.files}, f)
@@ -1,17 +1,241 @@
 import os
+import re
 import posixpath
 import urllib
+import shutil
+import time
+import hashlib
+import threading
+import collections
+import email.utils
+import Queue
 import BaseHTTPServer
 import SimpleHTTPServer
-from cStringIO import StringIO
+import SocketServer
 
+import cache
+import compress
 import jinjaenv
+import manifest
 import translate
+import tree
+import watcher
+
+class Response(object):
+    """Response
+    Rendered content, stored as the list of chunks it was rendered in, along
+    with the headers that allow clients to perform conditional requests.
+    """
+    def __init__(self, chunks, last_modified, state=None):
+        self.chunks = []
+        self.length = 0
+        sha1 = hashlib.sha1()
+        for chunk in chunks:
+            self.chunks.append(chunk)
+            self.length += len(chunk)
+            sha1.update(chunk)
+        self.etag = '"%s"' % sha1.hexdigest()
+        self.last_modified = last_modified
+        self.state = state
+        self._encoded = {}
+
+    def encoded(self, encoding):
+        """encoded
+        Return the response compressed with an encoding. The response is
+        compressed once, and the result is kept along with the response.
+
+        :param encoding: "gzip" or "br"
+        """
+        response = self._encoded.get(encoding)
+        if response is None:
+            response = Response(compress.compress_chunks(self.chunks, encoding),
+                                self.last_modified, self.state)
+            self._encoded[encoding] = response
+        return response
+
+    @property
+    def content(self):
+        return "".join(self.chunks)
+
+    def open(self):
+        return ChunksReader(self.chunks)
+
+class ChunksReader(object):
+    """ChunksReader
+    File-like object that reads a list of chunks without concatenating them.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.index = 0
+
+    def read(self, size=-1):
+        # Chunks are returned one at a time, whatever the requested size
+        if self.index >= len(self.chunks):
+            return ""
+        self.index += 1
+        return self.chunks[self.index - 1]
+
+    def close(self):
+        pass
+
+class FileRange(object):
+    """FileRange
+    File-like object that reads at most `length` bytes of a file, starting at
+    `start`.
+    """
+    def __init__(self, f, start, length):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+class ResponseCache(object):
+    """ResponseCache
+    Thread-safe LRU cache of rendered templates. A cached response is valid
+    as long as the templates (including parents and includes), translations
+    and _config.html variables it was rendered from are unchanged.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self._responses = collections.OrderedDict()
+        # (etag, last modification time) of the last response of each path
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, env):
+        """get
+        Return the cached response for this path if it is still valid, or
+        None.
+
+        :param path:
+        :param env: jinjaenv.Environment
+        """
+        with self._lock:
+            response = self._responses.pop(path, None)
+        if response is None:
+            return None
+        if not manifest.is_up_to_date(response.state, env, manifest.FileStates()):
+            return None
+        with self._lock:
+            self._responses[path] = response
+        return response
+
+    def render(self, path, env):
+        """render
+        Render a path and cache the result if it is a template. Return None if
+        the path does not exist. The response is considered modified when its
+        content changed since the previous render, since the mtimes of
+        templates do not reflect the modifications of variables and
+        translations.
+
+        :param path:
+        :param env: jinjaenv.Environment
+        """
+        with env.recording() as dependencies:
+            chunks = env.stream_path(path)
+            if chunks is None:
+                return None
+            chunks = list(chunks)
+
+        files = manifest.FileStates()
+        state = manifest.dependencies_state(env, dependencies, files)
+        response = Response(chunks, None, state)
+        with self._lock:
+            etag, last_modified = self._versions.get(path, (None, 0))
+            if response.etag != etag:
+                # Last-Modified has a one second resolution: it must increase
+                # with each modification
+                last_modified = max(time.time(), last_modified + 1)
+                self._versions[path] = (response.etag, last_modified)
+        response.last_modified = last_modified
+        if self.size > 0:
+            with self._lock:
+                self._responses[path] = response
+                while len(self._responses) > self.size:
+                    self._responses.popitem(last=False)
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._responses.clear()
+
+class ThreadPoolMixIn(SocketServer.ThreadingMixIn):
+    """ThreadPoolMixIn
+    Mix-in class that handles requests in a fixed-size pool of threads.
+    """
+    workers = 16
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, "_requests"):
+            self._requests = Queue.Queue()
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._process_requests)
+                thread.daemon = True
+                thread.start()
+        self._requests.put((request, client_address))
+
+    def _process_requests(self):
+        while True:
+            request, client_address = self._requests.get()
+            self.process_request_thread(request, client_address)
+
+class HTTPServer(ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # Index of source files, kept up-to-date with the events of the observer
+    index = None
+    observer = None
+
+    def update_index(self):
+        """update_index
+        Apply the pending file modification events to the index of source
+        files. Events are queued by the kernel as soon as files are modified,
+        such that requests never see outdated files; without inotify, they
+        are found by polling the source folder in a background thread, with
+        a delay of up to the polling interval. Return the set of modified
+        paths.
+        """
+        modified = set()
+        if self.observer is None:
+            return modified
+        paths = self.observer.read(0)
+        while paths:
+            self.index.update(paths)
+            modified.update(paths)
+            paths = self.observer.read(0)
+        return modified
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        if self.observer is not None:
+            self.observer.close()
+            self.observer = None
 
 class HttpRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     ROOT_PATH   = None
     LOCALE      = None
     TRANSLATION_UPDATER = None
+    RESPONSE_CACHE = ResponseCache()
+    CONFIG_STATES = None
+    _UPDATE_LOCK = threading.Lock()
+    COPY_BUFFER_SIZE = 64*1024
+    RANGE_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+    # Close idle keep-alive connections, such that they do not hold on to
+    # worker threads
+    timeout = 5
+    # Send headers in a single packet, without waiting for delayed ACKs on
+    # keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
 
     @property
     def locale(self):
@@ -24,45 +248,215 @@ class HttpRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                                                                        HttpRequestHandler.LOCALE)
         return HttpRequestHandler.TRANSLATION_UPDATER
 
+    @staticmethod
+    def config_states():
+        """config_states
+        Return the (mtime, size) of _config.html and of the templates it
+        includes.
+        """
+        files = manifest.FileStates()
+        paths = set(jinjaenv.get().config_dependencies.templates.itervalues())
+        paths.add(os.path.join(HttpRequestHandler.ROOT_PATH, "_config.html"))
+        return dict((path, files.stat(path)) for path in paths)
+
+    def update_environment(self):
+        """update_environment
+        Reinitialize the environment if the translations, _config.html or the
+        front matter of templates were modified.
+        """
+        with HttpRequestHandler._UPDATE_LOCK:
+            paths = self.server.update_index()
+            translations = self.locale is not None and self.translation_updater.run()
+            if (translations or self.config_states() != HttpRequestHandler.CONFIG_STATES
+                    or jinjaenv.get().is_front_matter_modified(paths)):
+                jinjaenv.reinit(translations)
+                HttpRequestHandler.CONFIG_STATES = self.config_states()
+
+    def is_not_modified(self, etag, last_modified):
+        """is_not_modified
+        Return True if the client sent a conditional request that matches the
+        response.
+
+        :param etag:
+        :param last_modified: timestamp
+        """
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            etags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in etags or etag in etags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            date = email.utils.parsedate_tz(if_modified_since)
+            if date is not None:
+                return int(last_modified) <= email.utils.mktime_tz(date)
+        return False
+
+    def send_not_modified(self, etag, last_modified):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(last_modified))
+        self.end_headers()
+
+    def requested_range(self, etag, size):
+        """requested_range
+        Return the (start, end) byte range requested by the client, None if
+        the whole file should be sent, or False if the range cannot be
+        satisfied. Multiple ranges are not supported: in that case, the whole
+        file is sent.
+
+        :param etag:
+        :param size:
+        """
+        range_header = self.headers.get("Range")
+        if range_header is None:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range.strip() != etag:
+            return None
+        match = self.RANGE_REGEX.match(range_header.strip())
+        if match is None:
+            return None
+        start, end = match.groups()
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        elif end:
+            # Suffix range: last bytes of the file
+            start = max(size - int(end), 0)
+            end = size - 1
+        else:
+            return None
+        if start > end:
+            return False
+        return start, end
+
+    def accepted_encodings(self, path):
+        """accepted_encodings
+        Return the encodings accepted by the client, by order of preference,
+        if the file at path is compressible.
+
+        :param path:
+        """
+        if os.path.splitext(path)[1] not in compress.COMPRESSIBLE:
+            return None
+        return compress.accepted_encodings(self.headers.get("Accept-Encoding"))
+
+    def send_file(self, path, ctype, encodings=None):
+        """send_file
+        Send the headers for a regular file and return a file object to read
+        its content from, such that the file is streamed without being loaded
+        in memory. Byte ranges are supported. An up-to-date precompressed
+        sibling (e.g: style.css.gz) is sent instead of the file if the client
+        accepts its encoding.
+
+        :param path:
+        :param ctype:
+        :param encodings: accepted encodings, or None if the file is not
+        compressible.
+        """
+        encoding = None
+        for accepted in encodings or []:
+            if compress.is_up_to_date(path, path + compress.SUFFIXES[accepted]):
+                encoding = accepted
+                path += compress.SUFFIXES[accepted]
+                break
+        f = open(path, "rb")
+        fs = os.fstat(f.fileno())
+        size = fs.st_size
+        etag = '"%x-%x"' % (int(fs.st_mtime * 1000000), size)
+        if self.is_not_modified(etag, fs.st_mtime):
+            f.close()
+            self.send_not_modified(etag, fs.st_mtime)
+            return None
+
+        byte_range = self.requested_range(etag, size)
+        if byte_range is False:
+            f.close()
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+
+        if byte_range is None:
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+        else:
+            start, end = byte_range
+            f = FileRange(f, start, end - start + 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-type", ctype)
+        self.send_encoding_headers(encodings, encoding)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        return f
+
+    def send_encoding_headers(self, encodings, encoding):
+        if encodings is not None:
+            self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+
+    def copyfile(self, source, outputfile):
+        shutil.copyfileobj(source, outputfile, self.COPY_BUFFER_SIZE)
+
     def send_head(self):
+        self.update_environment()
+
+        env = jinjaenv.get()
         path = self.translate_path(self.path)
-        if os.path.isdir(path):
+        if os.path.isdir(path) or env.is_template(os.path.join(path, "index.html")):
             if not self.path.endswith('/'):
                 # redirect browser - doing basically what apache does
                 self.send_response(301)
                 self.send_header("Location", self.path + "/")
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
             for index in "index.html", "index.htm":
                 index = os.path.join(path, index)
-                if os.path.exists(index):
+                if os.path.exists(index) or env.is_template(index):
                     path = index
                     break
             else:
                 return self.list_directory(path)
-        ctype = self.guess_type(jinjaenv.get().get_path(path))
+        ctype = self.guess_type(env.get_path(path))
+        encodings = self.accepted_encodings(env.get_path(path))
+
+        static_path = env.static_path(path)
+        if static_path is not None:
+            return self.send_file(static_path, ctype, encodings)
 
-        rendered = jinjaenv.get().render_path(path)
-        if rendered is None:
+        response = self.RESPONSE_CACHE.get(path, env)
+        if response is None:
+            response = self.RESPONSE_CACHE.render(path, env)
+        if response is None:
             self.send_error(404, "File not found: " + path)
             return None
+        encoding = None
+        if encodings and response.length >= compress.MIN_SIZE:
+            encoding = encodings[0]
+            response = response.encoded(encoding)
 
-        # Content length and last-modified attributes
-        #fs = os.fstat(f.fileno())
-        #content_length = fs[6]
-        #last_modified = self.date_time_string(fs.st_mtime)
-
-        f = StringIO()
-        f.write(rendered)
-        content_length = f.tell()
-        f.seek(0)
+        if self.is_not_modified(response.etag, response.last_modified):
+            self.send_not_modified(response.etag, response.last_modified)
+            return None
 
         self.send_response(200)
         self.send_header("Content-type", ctype)
-        self.send_header("Content-Length", str(content_length))
-        #self.send_header("Last-Modified", last_modified)
+        self.send_encoding_headers(encodings, encoding)
+        self.send_header("Content-Length", str(response.length))
+        self.send_header("Last-Modified", self.date_time_string(response.last_modified))
+        self.send_header("ETag", response.etag)
+        # Clients must revalidate their cached copy on every request
+        self.send_header("Cache-Control", "no-cache")
         self.end_headers()
-        return f
+        return response.open()
 
     def translate_path(self, path):
         """translate_path
@@ -85,18 +479,53 @@ class HttpRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             path = os.path.join(path, word)
         return path
 
-def serve(src_path, locale, address):
-    jinjaenv.init(src_path, locale)
+def make_server(src_path, locale, address, workers=16, cache_size=256, excluded=None):
+    """make_server
+    Create an HTTP/1.1 server that renders templates dynamically in a pool of
+    worker threads. Source files are looked up in an index that is updated
+    incrementally with the modifications reported by inotify, or found by
+    polling the source folder in a background thread when inotify is not
+    available.
+
+    :param src_path:
+    :param locale:
+    :param address: "IPADDR:PORT" string
+    :param workers: number of threads that handle requests.
+    :param cache_size: maximum number of rendered templates kept in memory.
+    :param excluded: glob patterns of files and folders that are ignored.
+    """
     HttpRequestHandler.ROOT_PATH    = os.path.abspath(src_path)
     HttpRequestHandler.LOCALE       = locale
+    HttpRequestHandler.TRANSLATION_UPDATER = None
+    HttpRequestHandler.RESPONSE_CACHE = ResponseCache(cache_size)
     translate.compile_if_possible(src_path, locale)
+    # Watch files before indexing them, such that no modification is lost
+    ignored = [os.path.join(HttpRequestHandler.ROOT_PATH, cache.DIRNAME)]
+    observer = watcher.get_observer(HttpRequestHandler.ROOT_PATH, ignored, excluded=excluded)
+    if isinstance(observer, watcher.PollingObserver):
+        # Requests must not scan the source folder
+        observer = watcher.ObserverThread(observer)
+    index = tree.TreeIndex(HttpRequestHandler.ROOT_PATH, excluded)
+    jinjaenv.init(src_path, locale, index=index)
+    HttpRequestHandler.CONFIG_STATES = HttpRequestHandler.config_states()
 
     ip, port = address.split(":")
     server_address = (ip, int(port))
 
-    HttpRequestHandler.protocol_version = "HTTP/1.0"
-    httpd = BaseHTTPServer.HTTPServer(server_address, HttpRequestHandler)
+    HttpRequestHandler.protocol_version = "HTTP/1.1"
+    try:
+        httpd = HTTPServer(server_address, HttpRequestHandler)
+    except:
+        if observer is not None:
+            observer.close()
+        raise
+    httpd.workers = workers
+    httpd.index = index
+    httpd.observer = observer
+    return httpd
 
+def serve(src_path, locale, address, workers=16, cache_size=256, excluded=None):
+    httpd = make_server(src_path, locale, address, workers, cache_size, excluded)
     sa = httpd.socket.getsockname()
     print "Serving HTTP on", "http://" + sa[0] + ":" + str(sa[1]), "..."
     httpd.serve_forever()
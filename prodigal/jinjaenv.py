@@ -1,54 +1,233 @@
 import sys
 import inspect
 import os.path
-import babel.support
+import contextlib
+import hashlib
+import json
+import threading
 import gettext
+import collections
+import cPickle
 import jinja2
 
+import cache
+import frontmatter
+import listings
+import manifest
+import media
+import metadata
+import profiler
+import translate
+import tree
 import filters# TODO get rid of this circular dependency
 
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """BytecodeCache
+    On-disk cache of compiled templates that persists across runs. Entries are
+    keyed by template path, such that all aliases of a template share the same
+    entry, and by Jinja2 version. Stale entries are detected by Jinja2 thanks
+    to the checksum of the template source. Entries are written atomically,
+    so the cache can be shared by concurrent processes.
+    """
+    def get_cache_key(self, name, filename=None):
+        return hashlib.sha1("%s\0%s" % (jinja2.__version__, filename or name)).hexdigest()
+
+    def load_bytecode(self, bucket):
+        try:
+            super(BytecodeCache, self).load_bytecode(bucket)
+        except Exception:
+            # Corrupted cache entry
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        with cache.atomic_file(self._get_cache_filename(bucket)) as f:
+            bucket.write_bytecode(f)
+
+class TemplateCache(object):
+    """TemplateCache
+    Locale-independent template data that can be shared by the loaders of
+    multiple environments during a build: the index of source files and the
+    compiled code of each template. Template files are assumed not to change
+    while the cache is used.
+    """
+    def __init__(self, excluded=None):
+        self.excluded = excluded
+        self._indexes = {}
+        self._code = {}
+
+    def index(self, src_path):
+        if src_path not in self._indexes:
+            self._indexes[src_path] = tree.TreeIndex(src_path, self.excluded)
+        return self._indexes[src_path]
+
+    def get_code(self, environment, loader, template_name):
+        path = loader.get_path(template_name)
+        if path not in self._code:
+            self._code[path] = _load_code(environment, loader, template_name)
+        return self._code[path]
+
+def _load_code(environment, loader, template_name):
+    """_load_code
+    Return the compiled code of a template, along with its uptodate function.
+    The code is fetched from the bytecode cache of the environment, if any.
+
+    :param environment:
+    :param loader:
+    :param template_name:
+    """
+    source, filename, uptodate = loader.get_source(environment, template_name)
+    bcc = environment.bytecode_cache
+    if bcc is not None:
+        bucket = bcc.get_bucket(environment, template_name, filename, source)
+        if bucket.code is not None:
+            return bucket.code, uptodate
+    code = environment.compile(source, template_name, filename)
+    if bcc is not None:
+        bucket.code = code
+        bcc.set_bucket(bucket)
+    return code, uptodate
+
 class TemplateLoader(jinja2.loaders.BaseLoader):
-    def __init__(self, src_path):
+    """TemplateLoader
+    Load templates from the source folder. When a tree.TreeIndex is given,
+    template lookups and reload checks are answered by the index instead of
+    the filesystem. Aliases are resolved by the metadata store of the
+    environment.
+    """
+    def __init__(self, src_path, cache=None, index=None, pages=None):
         self.src_path = os.path.abspath(src_path)
-        self.aliases = {}
-
-    def add_alias(self, alias, template_name):
-        self.aliases[alias] = template_name
+        self.cache = cache
+        if index is None and cache is not None:
+            index = cache.index(self.src_path)
+        self.index = index
+        self.pages = metadata.MetadataStore() if pages is None else pages
 
     def get_path(self, template_name):
-        if template_name in self.aliases:
-            return os.path.join(self.src_path, self.aliases[template_name])
-        else:
-            return os.path.join(self.src_path, template_name)
+        alias_template = self.pages.template(template_name)
+        if alias_template is not None:
+            return os.path.join(self.src_path, alias_template)
+        return os.path.join(self.src_path, template_name)
+
+    def stat(self, path):
+        if self.index is not None:
+            return self.index.get(path)
+        return tree.stat(path)
+
+    def isfile(self, path):
+        return self.stat(path) is not None
+
+    def is_template(self, template_name):
+        path = self.get_path(template_name)
+        return os.path.splitext(path)[1] == ".html" and self.isfile(path)
 
     def get_source(self, environment, template):
-        path = self.get_path(template)
-        ext = os.path.splitext(path)[1]
-        if not os.path.exists(path) or ext != ".html":
-            raise jinja2.exceptions.TemplateNotFound(template)
-        contents = open(path).read().decode('utf-8')
-        mtime = os.path.getmtime(path)
+        with profiler.measure("load", template):
+            path = self.get_path(template)
+            entry = self.stat(path)
+            if entry is None or os.path.splitext(path)[1] != ".html":
+                raise jinja2.exceptions.TemplateNotFound(template)
+            contents = open(path).read().decode('utf-8')
         def uptodate():
-            try:
-                return os.path.getmtime(path) == mtime
-            except OSError:
-                return False
+            current = self.stat(path)
+            return current is not None and current.mtime == entry.mtime
         return contents, path, uptodate
 
+    def load(self, environment, name, globals=None):
+        if self.cache is None:
+            code, uptodate = _load_code(environment, self, name)
+        else:
+            code, uptodate = self.cache.get_code(environment, self, name)
+        return environment.template_class.from_code(environment, code, globals or {}, uptodate)
+
     def list_templates(self):
-        paths = []
-        for alias, template_name in self.aliases.iteritems():
-            paths.append(alias)
-        for (dirpath, dirnames, filenames) in os.walk(self.src_path):
-            for filename in filenames:
-                path = os.path.join(dirpath, filename)
-                ext = os.path.splitext(path)[1]
-                if ext != ".html":
-                    continue
-                path = os.path.relpath(path, self.src_path)
-                paths.append(path)
+        paths = self.pages.aliases()
+        index = self.index
+        if index is None:
+            index = tree.TreeIndex(self.src_path)
+        paths += [os.path.relpath(path, self.src_path) for path in index.files(".html")]
         return paths
 
+class JinjaEnvironment(jinja2.Environment):
+    """JinjaEnvironment
+    Jinja2 environment that reports every template it loads (including parent
+    and included templates) to the dependencies that are currently being
+    recorded by the current thread, if any.
+    """
+    def __init__(self, *args, **kwargs):
+        super(JinjaEnvironment, self).__init__(*args, **kwargs)
+        self._recording = threading.local()
+        self._owner = None
+
+    @property
+    def owner(self):
+        """owner
+        Environment that owns this Jinja2 environment, passed to filters.
+        While an environment that reuses this Jinja2 environment is being
+        initialized by the current thread, filters act on that environment.
+        """
+        environment = getattr(_initializing, "environment", None)
+        if environment is not None and environment._jinja_env is self:
+            return environment
+        return self._owner
+
+    @owner.setter
+    def owner(self, environment):
+        self._owner = environment
+
+    @property
+    def dependencies(self):
+        return getattr(self._recording, "dependencies", None)
+
+    @dependencies.setter
+    def dependencies(self, dependencies):
+        self._recording.dependencies = dependencies
+
+    def get_template(self, name, parent=None, globals=None):
+        template = super(JinjaEnvironment, self).get_template(name, parent, globals)
+        if self.dependencies is not None:
+            if isinstance(name, jinja2.Template):
+                name = name.name
+            elif parent is not None:
+                name = self.join_path(name, parent)
+            self.dependencies.add_template(name, template.filename)
+        return template
+
+class Dependencies(object):
+    """Dependencies
+    Inputs that were read while rendering a template: template files,
+    variables defined in _config.html and metadata queries. Only the names
+    of variables and queries are recorded: their values are hashed when the
+    state of the dependencies is computed, if ever.
+    """
+    def __init__(self):
+        self.templates = {}
+        self.variables = set()
+        self.queries = set()
+
+    def add_template(self, template_name, path):
+        self.templates[template_name] = path
+
+    def add_variable(self, template_name, key):
+        self.variables.add((template_name, key))
+
+    def add_query(self, name, args):
+        self.queries.add((name, json.dumps(args)))
+
+def digest(value):
+    """digest
+    Return a hash of a template variable value. Values that cannot be
+    serialized are hashed through their repr().
+
+    :param value:
+    """
+    serialized = json.dumps(value, sort_keys=True, default=_serializable)
+    return hashlib.sha1(serialized).hexdigest()
+
+def _serializable(value):
+    if isinstance(value, metadata.PageRecord):
+        return dict(value.iteritems())
+    return repr(value)
+
 def _install_translations(jinja_env, src_path=None, locale=None):
     """install_translations
     Load translations into the environment, such that it can render translated
@@ -60,32 +239,63 @@ def _install_translations(jinja_env, src_path=None, locale=None):
     :param locale:
     """
     if locale is not None and src_path is not None:
-        with open(os.path.join(src_path, locale + ".mo")) as f:
-            translations = babel.support.Translations(f)
-            jinja_env.install_gettext_translations(translations)
+        translations = translate.MoTranslations(os.path.join(src_path, locale + ".mo"))
+        jinja_env.install_gettext_translations(translations)
     else:
         jinja_env.install_gettext_translations(gettext)
 
+def _runtime_filter(fn):
+    """_runtime_filter
+    Wrap a filter such that it is evaluated at render time. Jinja2 evaluates
+    filters with constant arguments at compile time (except for context
+    filters), such that their side effects and results would be lost or
+    outdated when compiled templates are reused.
+
+    Filters with an `env` argument receive the environment that renders the
+    template, which saves the lookup of the current environment on each call.
+
+    :param fn:
+    """
+    pass_env = "env" in inspect.getargspec(fn).args
+    @jinja2.contextfilter
+    def wrapper(context, *args, **kwargs):
+        if pass_env:
+            kwargs["env"] = context.environment.owner
+        profiler_ = profiler.get()
+        if not profiler_.enabled:
+            return fn(*args, **kwargs)
+        with profiler_.measure("filter", fn.__name__):
+            return fn(*args, **kwargs)
+    wrapper.__name__ = fn.__name__
+    wrapper.__wrapped__ = fn
+    return wrapper
+
 def _register_filters(env):
     # List all functions with @filter decorator in filters module
     module = sys.modules[filters.__name__]
     for (fn_name, fn) in inspect.getmembers(module, inspect.isfunction):
         if hasattr(fn, "is_filter"):
-            env.filters[fn_name] = fn
+            env.filters[fn_name] = _runtime_filter(fn)
 
-def _get_jinja_env(src_path=None, locale=None):
+def _get_jinja_env(src_path=None, locale=None, template_cache=None, index=None, pages=None):
     """_get_jinja_env
     Get the jinja2 environment required to compile templates.
 
     :param src_path:
     :param locale:
+    :param template_cache: TemplateCache shared with other environments.
+    :param index: tree.TreeIndex of the source folder.
+    :param pages: metadata.MetadataStore that resolves aliases.
     """
+    bytecode_cache = None
     if src_path is not None:
-        template_loader = TemplateLoader(src_path)
+        template_loader = TemplateLoader(src_path, template_cache, index, pages)
+        bytecode_cache = BytecodeCache(cache.directory(src_path, "bytecode"))
     else:
         template_loader = jinja2.BaseLoader()
-    env = jinja2.Environment(loader=template_loader,
-                             extensions=['jinja2.ext.i18n'])
+    env = JinjaEnvironment(loader=template_loader,
+                           bytecode_cache=bytecode_cache,
+                           extensions=['jinja2.ext.i18n'])
     _install_translations(env, src_path, locale)
     _register_filters(env)
     return env
@@ -94,94 +304,574 @@ class Environment(object):
 
     _instance = None
 
-    def __init__(self, src_path=None, locale=None):
+    def __init__(self, src_path=None, locale=None, template_cache=None, index=None,
+                 pages=None, jinja_env=None):
         self._src_path = None if src_path is None else os.path.abspath(src_path)
         self._locale = locale
-
-        self._jinja_env = _get_jinja_env(self._src_path, self._locale)
-        self._variables = {}
+        self._index = index
+
+        self._metadata = metadata.MetadataStore() if pages is None else pages
+        if jinja_env is None:
+            jinja_env = _get_jinja_env(self._src_path, self._locale, template_cache, index,
+                                       self._metadata)
+            jinja_env.owner = self
+        self._jinja_env = jinja_env
+        self._digests = {}
+        self._listings = []
+        self.config_dependencies = Dependencies()
+        # Front matter variables of each scanned template
+        self.front_matter = {}
 
     def post_init(self):
         if self._src_path is not None:
             if os.path.exists(os.path.join(self._src_path, "_config.html")):
-                self.render_template("_config.html")
+                self.load_config()
+            self.load_front_matter()
+        self.add_listing_pages()
+
+    def load_config(self):
+        """load_config
+        Render _config.html, unless the result of its previous evaluation
+        was cached and none of the files it read were modified since then.
+        """
+        config_cache = ConfigCache.for_environment(self)
+        if config_cache.restore(self):
+            return
+        with self.recording() as dependencies:
+            self.render_template("_config.html")
+        self.config_dependencies = dependencies
+        config_cache.save(self)
+
+    def activate(self):
+        """activate
+        Make this environment the owner of its Jinja2 environment, once it is
+        initialized. When the Jinja2 environment was reused from a previous
+        environment, loaded templates of the aliases that now render another
+        template are dropped.
+        """
+        jinja_env = self._jinja_env
+        previous = getattr(jinja_env.loader, "pages", None)
+        if previous is not None and previous is not self._metadata:
+            modified = set(alias for alias in set(previous.aliases()) | set(self._metadata.aliases())
+                           if previous.template(alias) != self._metadata.template(alias))
+            if modified and jinja_env.cache is not None:
+                for key in jinja_env.cache.keys():
+                    # Keys are template names, or (loader, name) since Jinja2 2.8
+                    if (key[1] if isinstance(key, tuple) else key) in modified:
+                        del jinja_env.cache[key]
+            jinja_env.loader.pages = self._metadata
+        jinja_env.owner = self
+
+    def load_front_matter(self):
+        """load_front_matter
+        Collect the front matter of all templates into the metadata store,
+        without rendering them. Front matter is loaded after _config.html,
+        such that it takes precedence over the variables defined there.
+        """
+        index = self.index
+        if index is None:
+            index = tree.TreeIndex(self._src_path)
+        scanned = frontmatter.FrontMatterCache.for_source(self._src_path).scan(self._src_path, index)
+        for template_name, variables in scanned:
+            self.front_matter[template_name] = variables
+            self.add_front_matter(template_name, variables)
+
+    def is_front_matter_modified(self, paths):
+        """is_front_matter_modified
+        Return True if the modification of the given paths changed the front
+        matter loaded by this environment: a header was modified or became
+        invalid, or a template with a header was created or deleted. The index
+        must already be updated with the paths.
+
+        :param paths: set of modified, created or deleted absolute paths.
+        """
+        index = self.index
+        if index is None:
+            index = tree.TreeIndex(self._src_path)
+        prefix = self._src_path + os.sep
+        names = set()
+        for path in paths:
+            path = os.path.normpath(path)
+            if not path.startswith(prefix):
+                continue
+            name = os.path.relpath(path, self._src_path)
+            # Templates of deleted, created or renamed folders
+            names.update(known for known in self.front_matter if known.startswith(name + os.sep))
+            names.update(os.path.relpath(indexed, self._src_path)
+                         for indexed in index.files(".html") if indexed.startswith(path + os.sep))
+            if os.path.splitext(name)[1] == ".html":
+                names.add(name)
+        for name in names:
+            path = os.path.join(self._src_path, name)
+            try:
+                variables = frontmatter.read(path) if index.isfile(path) else None
+            except (IOError, ValueError):
+                return True
+            if variables != self.front_matter.get(name):
+                return True
+        return False
+
+    def add_front_matter(self, template_name, variables):
+        """add_front_matter
+        Define the variables of a template. If an "alias" is given, the
+        variables are defined for the alias instead, which renders the
+        "template" variable (or the blog template) with the "post" variable
+        set to template_name, as the add_blog_post filter does. Without
+        template nor blog template, the alias renders the template itself.
+
+        :param template_name:
+        :param variables: dict
+        """
+        variables = dict(variables)
+        alias = variables.pop("alias", None)
+        template = variables.pop("template", None) or filters.BLOG_TEMPLATE
+        if alias is None:
+            for key, value in variables.iteritems():
+                self.set_variable(template_name, key, value)
+        elif template is None:
+            self.add_alias(alias, template_name, variables)
+        else:
+            variables["post"] = template_name
+            self.add_alias(alias, template, variables)
+
+    def add_listing(self, kind, template_name, per_page=10, path=None):
+        self._listings.append(listings.Listing(kind, template_name, per_page, path))
+
+    def add_listing_pages(self):
+        """add_listing_pages
+        Add an alias for each page of the listings declared in _config.html,
+        once all dated pages are known. The items of each page are stored in
+        its variables, such that incremental builds render only the listing
+        pages whose items changed.
+        """
+        for listing in self._listings:
+            for alias, variables in listing.pages(self._metadata):
+                self.add_alias(alias, listing.template_name, variables)
+
+    @property
+    def src_path(self):
+        return self._src_path
+
+    @property
+    def locale(self):
+        return self._locale
+
+    @property
+    def index(self):
+        """index
+        tree.TreeIndex of the source folder used by the template loader, or
+        None.
+        """
+        return getattr(self._jinja_env.loader, "index", None)
+
+    @property
+    def pages(self):
+        """pages
+        metadata.MetadataStore of the variables and aliases of all pages.
+        """
+        return self._metadata
+
+    @property
+    def translations_path(self):
+        if self._src_path is None or self._locale is None:
+            return None
+        return os.path.join(self._src_path, self._locale + ".mo")
+
+    @contextlib.contextmanager
+    def recording(self):
+        """recording
+        Context manager that records the templates and variables read by the
+        templates rendered within its scope.
+        """
+        dependencies = Dependencies()
+        self._jinja_env.dependencies = dependencies
+        try:
+            yield dependencies
+        finally:
+            self._jinja_env.dependencies = None
+
+    def _record(self, template_name, key, value):
+        dependencies = self._jinja_env.dependencies
+        if dependencies is not None:
+            dependencies.add_variable(template_name, key)
+        return value
+
+    def lookup(self, template_name, key):
+        """lookup
+        Return the value of a variable without recording it. If template_name
+        is None, return the (template_name, value) pairs of all templates that
+        define the variable. If key is None, return all variables of the
+        template.
+
+        :param template_name:
+        :param key:
+        """
+        if template_name is None:
+            return self._metadata.templates_with(key)
+        return self._metadata.get(template_name, key)
 
     def set_variable(self, template_name, key, value):
-        if template_name not in self._variables:
-            self._variables[template_name] = {}
-        self._variables[template_name][key] = value
+        self._metadata.set(template_name, key, value)
+        self._digests.clear()
 
     def get_variable(self, template_name, key):
-        return self._variables.get(template_name, {}).get(key)
+        return self._record(template_name, key, self.lookup(template_name, key))
 
     def templates_with_variable(self, key):
-        for template_name, properties in self._variables.iteritems():
-            if key in properties:
-                yield template_name, properties[key]
+        return iter(self._record(None, key, self.lookup(None, key)))
+
+    def run_query(self, name, args):
+        """run_query
+        Return the result of a metadata query without recording it.
+
+        :param name: one of metadata.MetadataStore.QUERIES.
+        :param args: list of arguments.
+        """
+        return self._metadata.query(name, *args)
+
+    def query(self, name, *args):
+        """query
+        Run a metadata query (e.g: "latest", "with_value", "paginate") and
+        record its result, such that pages that list other pages are
+        rendered again only when the listing changes.
+
+        :param name: one of metadata.MetadataStore.QUERIES.
+        :param args:
+        """
+        if self._jinja_env.dependencies is not None:
+            self._jinja_env.dependencies.add_query(name, list(args))
+        return self.run_query(name, args)
+
+    def variable_digest(self, template_name, key):
+        """variable_digest
+        Return the digest of the current value of a variable. Digests are
+        cached until a variable is modified, such that the variables listed
+        by all pages are hashed only once per build.
+
+        :param template_name:
+        :param key:
+        """
+        cache_key = ("variable", template_name, key)
+        value_digest = self._digests.get(cache_key)
+        if value_digest is None:
+            value_digest = digest(self.lookup(template_name, key))
+            self._digests[cache_key] = value_digest
+        return value_digest
+
+    def query_digest(self, name, args):
+        """query_digest
+        Return the digest of the current result of a metadata query, cached
+        as in variable_digest.
+
+        :param name:
+        :param args: list of arguments.
+        """
+        cache_key = ("query", name, json.dumps(args))
+        result_digest = self._digests.get(cache_key)
+        if result_digest is None:
+            result_digest = digest(self.run_query(name, args))
+            self._digests[cache_key] = result_digest
+        return result_digest
 
     def add_alias(self, alias, template_name, variables={}):
-        self._variables[alias] = variables
-        self._jinja_env.loader.add_alias(alias, template_name)
+        self._metadata.set_all(alias, variables, template_name)
+        self._digests.clear()
 
     def template_name(self, path):
         return os.path.relpath(os.path.abspath(path), self._src_path)
 
     def render_template(self, template_name, variables={}):
+        chunks = self.stream_template(template_name, variables)
+        if chunks is None:
+            return None
+        return "".join(chunks)
+
+    def stream_template(self, template_name, variables={}):
+        """stream_template
+        Return an iterator over the utf-8 encoded chunks of a rendered
+        template, or None if the template does not exist. The template is
+        rendered as the chunks are consumed, such that the whole page is
+        never held in memory.
+
+        :param template_name:
+        :param variables:
+        """
         try:
             template = self._jinja_env.get_template(template_name)
         except jinja2.exceptions.TemplateNotFound:
             return None
 
-        varcopy = {"template_name": template_name}
-        varcopy.update(self._variables.get(template_name, {}))
-        varcopy.update(variables)
-        return template.render(varcopy).encode("utf-8")
+        # Variables are looked up through layers instead of being copied
+        context = template.new_context(ChainMap(
+            variables,
+            self._record(template_name, None, self.lookup(template_name, None)),
+            {"template_name": template_name},
+            template.globals), shared=True)
+        return _encode_chunks(_generate(template, context))
 
     def render_string(self, string):
         return self._jinja_env.from_string(string).render()
 
-    def get_path(self, url):
-        template_name = self.template_name(url)
+    def template_path(self, template_name):
         return self._jinja_env.loader.get_path(template_name)
 
+    def get_path(self, url):
+        return self.template_path(self.template_name(url))
+
     def render_relative_path(self, path):
         return self.render_path(os.path.join(self._src_path, path))
 
     def render_path(self, path):
+        chunks = self.stream_path(path)
+        if chunks is None:
+            return None
+        return "".join(chunks)
+
+    def stream_path(self, path):
+        """stream_path
+        Return an iterator over the chunks of the content of a path, or None
+        if the path corresponds to no template and no file.
+
+        :param path:
+        """
         template_name = self.template_name(path)
-        variables = self._variables.get(template_name, {})
 
         # 1) Try to render as a template
-        rendered = self.render_template(template_name, variables)
-        if rendered is not None:
-            return rendered
+        chunks = self.stream_template(template_name)
+        if chunks is not None:
+            return chunks
 
         # 2) Just read the file
         path = os.path.join(self._src_path, template_name)
-        if os.path.exists(path):
-            return open(path, "rb").read()
+        if self._jinja_env.loader.isfile(path):
+            return _read_chunks(path)
 
         # 3) Man, we failed...
         return None
 
+    def is_template(self, path):
+        """is_template
+        Return True if a path corresponds to a template or to an alias, e.g:
+        the index.html of a listing folder that only exists in the output.
+
+        :param path:
+        """
+        return self._jinja_env.loader.is_template(self.template_name(path))
+
+    def static_path(self, path):
+        """static_path
+        Return the path of the regular file that should be served as-is for
+        this url, or None if the url corresponds to a template or to no file.
+
+        :param path:
+        """
+        template_name = self.template_name(path)
+        loader = self._jinja_env.loader
+        if loader.is_template(template_name):
+            return None
+        path = os.path.join(self._src_path, template_name)
+        if loader.isfile(path):
+            return path
+        return None
+
     def renderable_urls(self):
         for template_name in self._jinja_env.loader.list_templates():
             if not os.path.basename(template_name).startswith("_"):
                 yield os.path.join(self._src_path, template_name)
         raise StopIteration
 
-def init(src_path=None, locale=None):
+class ChainMap(collections.Mapping):
+    """ChainMap
+    Read-only view of a list of mappings, in which keys are looked up in
+    each mapping in turn. Used as the parent of template contexts, such that
+    the variables of a page are not copied for each render.
+    """
+    def __init__(self, *maps):
+        self.maps = maps
+
+    def __getitem__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                return mapping[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                return True
+        return False
+
+    def __iter__(self):
+        return iter(set().union(*self.maps))
+
+    def __len__(self):
+        return len(set().union(*self.maps))
+
+def _generate(template, context):
+    """_generate
+    Same as jinja2.Template.generate, for a context created by the caller.
+
+    :param template:
+    :param context:
+    """
+    try:
+        for event in template.root_render_func(context):
+            yield event
+    except Exception:
+        exc_info = sys.exc_info()
+    else:
+        return
+    yield template.environment.handle_exception(exc_info, True)
+
+# Number of characters rendered before a chunk is encoded and yielded
+STREAM_BUFFER_SIZE = 64*1024
+
+def _encode_chunks(generator):
+    """_encode_chunks
+    Group the small unicode strings generated by a template into utf-8
+    encoded chunks of about STREAM_BUFFER_SIZE characters.
+
+    :param generator:
+    """
+    buf = []
+    size = 0
+    for s in generator:
+        buf.append(s)
+        size += len(s)
+        if size >= STREAM_BUFFER_SIZE:
+            yield u"".join(buf).encode("utf-8")
+            buf = []
+            size = 0
+    if buf:
+        yield u"".join(buf).encode("utf-8")
+
+def _read_chunks(path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(STREAM_BUFFER_SIZE), ""):
+            yield chunk
+
+class ConfigCache(object):
+    """ConfigCache
+    Result of the evaluation of _config.html for a locale: variables and
+    aliases of pages, listings, media folders and blog template. The state
+    of the files that were read (_config.html, the templates it includes and
+    the translations) is stored along, such that _config.html is rendered
+    again only when one of them is modified.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_environment(cls, env):
+        key = hashlib.sha1(env.locale or "").hexdigest()[:16]
+        return cls(cache.path(env.src_path, "config-%s.pickle" % key))
+
+    def save(self, env):
+        # Variables and queries read by _config.html are its own output
+        dependencies = Dependencies()
+        dependencies.templates = env.config_dependencies.templates
+        content = {
+            "version": self.VERSION,
+            "state": manifest.dependencies_state(env, dependencies, manifest.FileStates()),
+            "templates": dependencies.templates,
+            "pages": env.pages.__getstate__(),
+            "listings": [(listing.kind, listing.template_name, listing.per_page, listing.path)
+                         for listing in env._listings],
+            "media": media.folders(),
+            "blog_template": filters.BLOG_TEMPLATE,
+        }
+        with cache.atomic_file(self.path) as f:
+            cPickle.dump(content, f, 2)
+
+    def restore(self, env):
+        """restore
+        Load the cached evaluation of _config.html into an environment.
+        Return False if there is no valid cached evaluation.
+
+        :param env: Environment
+        """
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "rb") as f:
+                content = cPickle.load(f)
+        except Exception:
+            # Corrupted cache entry
+            return False
+        if not isinstance(content, dict) or content.get("version") != self.VERSION:
+            return False
+        if not manifest.is_up_to_date(content["state"], env, manifest.FileStates()):
+            return False
+        env.pages.__setstate__(content["pages"])
+        env._digests.clear()
+        for kind, template_name, per_page, path in content["listings"]:
+            env.add_listing(kind, template_name, per_page, path)
+        for folder in content["media"]:
+            media.add(folder)
+        filters.BLOG_TEMPLATE = content["blog_template"]
+        env.config_dependencies.templates = content["templates"]
+        return True
+
+_init_lock = threading.RLock()
+_initializing = threading.local()
+
+def init(src_path=None, locale=None, template_cache=None, index=None, pages=None):
+    """init
+    Create the current environment. Unless the pages of the website are
+    given (e.g: by the process that sends templates to render), _config.html
+    and the front matter of templates are loaded.
+
+    :param src_path:
+    :param locale:
+    :param template_cache: TemplateCache shared with other environments.
+    :param index: tree.TreeIndex of the source folder.
+    :param pages: metadata.MetadataStore of a fully initialized environment.
+    """
     # TODO fix this somehow
     #filters.init()
-    Environment._instance = Environment(src_path, locale)
-    Environment._instance.post_init()
-
-def reinit():
-    src_path = Environment._instance._src_path
-    locale = Environment._instance._locale
-    init(src_path, locale)
+    environment = Environment(src_path, locale, template_cache, index, pages)
+    if pages is not None:
+        Environment._instance = environment
+        return
+    _post_init(environment)
+
+def _post_init(environment):
+    with _init_lock:
+        # While _config.html is rendered, the new environment is visible only
+        # to the current thread: other threads keep using the previous one.
+        _initializing.environment = environment
+        try:
+            environment.post_init()
+        finally:
+            _initializing.environment = None
+        environment.activate()
+        Environment._instance = environment
+
+def reinit(translations=False):
+    """reinit
+    Load _config.html and the front matter of templates again, e.g: after
+    they were modified. The Jinja2 environment of the current environment,
+    along with its loaded templates, is reused.
+
+    :param translations: if True, load the translations again.
+    """
+    previous = Environment._instance
+    jinja_env = previous._jinja_env
+    if translations:
+        _install_translations(jinja_env, previous._src_path, previous._locale)
+        # Loaded templates hold the previous translation functions
+        if jinja_env.cache is not None:
+            jinja_env.cache.clear()
+    environment = Environment(previous._src_path, previous._locale, index=previous._index,
+                              jinja_env=jinja_env)
+    _post_init(environment)
 
 def get():
+    environment = getattr(_initializing, "environment", None)
+    if environment is not None:
+        return environment
     if Environment._instance is None:
         init()
     return Environment._instance
@@ -0,0 +1,88 @@
+import os
+import re
+
+_SLUG = re.compile(r"[^\w-]+", re.U)
+
+def slugify(value):
+    """slugify
+    Return the path component of a listing of pages with a given value,
+    e.g: a tag. Characters other than letters, digits, "-" and "_" are
+    replaced with "-", such that slugs have no extension and cannot escape the
+    listing folder, and leading "_" are removed, such that slugs do not name
+    hidden templates.
+
+    :param value:
+    """
+    return _SLUG.sub("-", value).strip("-_") or "-"
+
+class Listing(object):
+    """Listing
+    Paginated listing pages of the dated pages (e.g: blog posts), from the
+    most recent to the oldest. The first page of a listing is generated at
+    `path`/index.html and the following pages at `path`/page/N/index.html.
+    Listings of kind "tag" and "year" generate one listing per tag (at
+    `path`/<slug of the tag>) and per year (at `path`/<yyyy>).
+    """
+    KINDS = ("archive", "tag", "year")
+
+    def __init__(self, kind, template_name, per_page=10, path=None):
+        if kind not in self.KINDS:
+            raise ValueError("Unknown listing kind: %s" % kind)
+        self.kind = kind
+        self.template_name = template_name
+        self.per_page = per_page
+        self.path = path or {"archive": "archive", "tag": "tags", "year": "year"}[kind]
+
+    def groups(self, store):
+        """groups
+        Yield the (path, variables, template names) of each listing, where
+        template names are sorted by decreasing date.
+
+        :param store: metadata.MetadataStore
+        """
+        if self.kind == "archive":
+            yield self.path, {}, store.latest(None)
+        elif self.kind == "tag":
+            slugs = set()
+            for tag, count in store.values("tags"):
+                slug = base = slugify(tag)
+                # Distinct tags may have the same slug, e.g: "node.js" and "node-js"
+                suffix = 1
+                while slug in slugs:
+                    suffix += 1
+                    slug = "%s-%d" % (base, suffix)
+                slugs.add(slug)
+                yield (os.path.join(self.path, slug), {"tag": tag},
+                       store.with_value("tags", tag))
+        else:
+            years = {}
+            for template_name in store.latest(None):
+                year = str(store.get(template_name, "date"))[:4]
+                years.setdefault(year, []).append(template_name)
+            for year, template_names in sorted(years.iteritems()):
+                yield os.path.join(self.path, year), {"year": year}, template_names
+
+    def pages(self, store):
+        """pages
+        Yield the (alias, variables) of each listing page. Aliases always name
+        the index.html of a folder. Variables include the "items" of the page,
+        its "page" number, the "page_count" and the folders of the
+        "previous_page" and "next_page", if any.
+
+        :param store: metadata.MetadataStore
+        """
+        for path, group_variables, template_names in self.groups(store):
+            page_count = max(1, (len(template_names) + self.per_page - 1) / self.per_page)
+            aliases = [path] + [os.path.join(path, "page", str(page))
+                                for page in range(2, page_count + 1)]
+            for page in range(1, page_count + 1):
+                start = (page - 1) * self.per_page
+                variables = {
+                    "items": template_names[start:start + self.per_page],
+                    "page": page,
+                    "page_count": page_count,
+                    "previous_page": aliases[page - 2] if page > 1 else None,
+                    "next_page": aliases[page] if page < page_count else None,
+                }
+                variables.update(group_variables)
+                yield os.path.join(aliases[page - 1], "index.html"), variables
@@ -1,44 +1,129 @@
 #! /usr/bin/env python
+import os
 import argparse
-from tools import generate, translate_templates, serve
+import profiler
+import tree
+import artifacts
+from tools import generate, translate_templates, serve, watch, all_locales
 
 def main():
     parser = argparse.ArgumentParser(description="Prodigal: Yet another static website generator!")
 
     subparsers = parser.add_subparsers(dest="command", help="")
 
-    parser_generate = subparsers.add_parser("generate",
+    exclude_parser = argparse.ArgumentParser(add_help=False)
+    exclude_parser.add_argument("-x", "--exclude", metavar="PATTERN", action="append",
+            help="Ignore files and folders whose name matches this glob pattern. Repeat this \
+                    option to ignore multiple patterns, in addition to: %s" % " ".join(tree.EXCLUDED))
+
+    parser_generate = subparsers.add_parser("generate", parents=[exclude_parser],
             help="Generate a static website")
     parser_generate.add_argument("src_path", metavar="SOURCE",
             help="Path of source files")
     parser_generate.add_argument("dst_path", metavar="DEST",
             help="Path of destination files")
-    parser_generate.add_argument("-l", "--locale",
-            help="Locale of the generated content")
+    parser_generate.add_argument("-l", "--locale", action="append",
+            help="Locale of the generated content. Repeat this option to generate \
+                    multiple locales, each in its own DEST/LOCALE folder.")
+    parser_generate.add_argument("-A", "--all-locales", action="store_true",
+            help="Generate content for all locales that have a .po file in SOURCE")
+    parser_generate.add_argument("-i", "--incremental", action="store_true",
+            help="Render only the templates that changed since the previous generation")
+    parser_generate.add_argument("-j", "--jobs", type=int, default=1,
+            help="Number of processes used to render templates")
+    parser_generate.add_argument("--media-checksum", action="store_true",
+            help="Compare media files by content instead of modification time")
+    parser_generate.add_argument("--link-media", action="store_true",
+            help="Hardlink media files instead of copying them, when possible")
+    parser_generate.add_argument("--staging", action="store_true",
+            help="Generate the website in a staging folder that replaces DEST once the build succeeded")
+    parser_generate.add_argument("-o", "--output", action="append", default=[],
+            choices=artifacts.OUTPUTS,
+            help="Also generate a sitemap.xml, an Atom feed.xml or a search.json index of \
+                    all pages. Repeat this option to generate multiple outputs.")
+    parser_generate.add_argument("--base-url", metavar="URL",
+            help="Url of the root of the website, required by the sitemap and the feed")
+    parser_generate.add_argument("--minify", action="store_true",
+            help="Minify html pages, and css and js media files")
+    parser_generate.add_argument("--precompress", action="store_true",
+            help="Write .gz siblings of the generated files, and .br siblings if the brotli \
+                    module is installed, such that web servers do not compress them")
+    parser_generate.add_argument("--profile", action="store_true",
+            help="Measure the time spent rendering templates, in filters, loading templates \
+                    and writing files, and print the most expensive operations")
+    parser_generate.add_argument("--profile-top", metavar="N", type=int, default=20,
+            help="Number of operations printed by --profile")
+    parser_generate.add_argument("--profile-output", metavar="PATH",
+            help="Save all --profile measurements to a .json or .csv file")
 
-    parser_translate = subparsers.add_parser("translate",
+    parser_translate = subparsers.add_parser("translate", parents=[exclude_parser],
             help="Produce the translation files for the static website")
-    parser_translate.add_argument("locale", metavar="LOCALE",
-            help="Locale code for generated translation files. E.g: fr, en_US.")
+    parser_translate.add_argument("locale", metavar="LOCALE", nargs="*",
+            help="Locale code for generated translation files. E.g: fr, en_US. Multiple \
+                    locales can be given, in which case messages are extracted only once.")
+    parser_translate.add_argument("-A", "--all-locales", action="store_true",
+            help="Update the translation files of all locales that have a .po file in SOURCE")
     parser_translate.add_argument("src_path", metavar="SOURCE",
             help="Path of source files")
+    parser_translate.add_argument("-j", "--jobs", type=int,
+            help="Number of processes used to extract messages from modified templates. \
+                    Default: number of CPUs")
+
+    parser_watch = subparsers.add_parser("watch", parents=[exclude_parser],
+            help="Generate a static website and regenerate it whenever source files are modified")
+    parser_watch.add_argument("src_path", metavar="SOURCE",
+            help="Path of source files")
+    parser_watch.add_argument("dst_path", metavar="DEST",
+            help="Path of destination files")
+    parser_watch.add_argument("-l", "--locale",
+            help="Locale of the generated content")
+    parser_watch.add_argument("--polling", action="store_true",
+            help="Detect modifications by polling the source folder instead of using inotify")
 
-    parser_serve = subparsers.add_parser("serve",
+    parser_serve = subparsers.add_parser("serve", parents=[exclude_parser],
             help="Run a web server to dynamically serve your source folder.")
     parser_serve.add_argument("-l", "--locale", metavar="LOCALE",
             help="Locale code for generated translation files. E.g: fr, en_US.")
     parser_serve.add_argument("-a", "--address", metavar="IPADDR:PORT", default="127.0.0.1:8000",
             help="IP address and port where the content should be served.")
+    parser_serve.add_argument("-w", "--workers", type=int, default=16,
+            help="Number of threads that handle requests.")
+    parser_serve.add_argument("--cache-size", type=int, default=256,
+            help="Maximum number of rendered pages kept in memory.")
     parser_serve.add_argument("src_path", metavar="SOURCE",
             help="Path of source files")
     args = parser.parse_args()
 
     if args.command == "generate":
-        generate(args.src_path, args.dst_path, args.locale)
+        locale = args.locale
+        if locale is not None and len(locale) == 1:
+            locale = locale[0]
+        if args.all_locales:
+            locale = all_locales(args.src_path)
+        if args.base_url is None and ("sitemap" in args.output or "feed" in args.output):
+            parser_generate.error("--base-url is required by the sitemap and the feed")
+        if args.profile:
+            profiler.enable()
+        generate(args.src_path, args.dst_path, locale, args.incremental, args.jobs,
+                 args.media_checksum, args.link_media, args.exclude, args.staging,
+                 args.output, args.base_url, args.minify, args.precompress)
+        if args.profile:
+            print profiler.get().report(args.profile_top)
+            if args.profile_output is not None:
+                profiler.get().write(args.profile_output)
     elif args.command == "translate":
-        translate_templates(args.locale, args.src_path)
+        locales = args.locale
+        if args.all_locales:
+            locales = sorted(set(locales + all_locales(args.src_path)))
+        if not locales:
+            parser_translate.error("at least one LOCALE or --all-locales is required")
+        for locale in translate_templates(locales, args.src_path, args.exclude, args.jobs):
+            print "Updated", os.path.join(args.src_path, locale + ".po")
+    elif args.command == "watch":
+        watch(args.src_path, args.dst_path, args.locale, args.polling, args.exclude)
     elif args.command == "serve":
-        serve(args.src_path, args.locale, args.address)
+        serve(args.src_path, args.locale, args.address, args.workers, args.cache_size,
+              args.exclude)
 
 if __name__ == "__main__":
     main()
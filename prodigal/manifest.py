@@ -0,0 +1,276 @@
+import os
+import hashlib
+import json
+
+import cache
+
+def _encode(value):
+    # json returns unicode strings, while paths are manipulated as utf-8 str
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_encode(k), _encode(v)) for k, v in value.iteritems())
+    return value
+
+class FileStates(object):
+    """FileStates
+    Cache the (mtime, size, sha1) state of source files during a build, such
+    that files shared by many pages are stat'ed and hashed only once.
+    """
+    def __init__(self):
+        self._stats = {}
+        self._hashes = {}
+
+    def stat(self, path):
+        if path not in self._stats:
+            try:
+                st = os.stat(path)
+                self._stats[path] = (st.st_mtime, st.st_size)
+            except OSError:
+                self._stats[path] = None
+        return self._stats[path]
+
+    def hash(self, path):
+        if path not in self._hashes:
+            self._hashes[path] = cache.file_hash(path)
+        return self._hashes[path]
+
+    def state(self, path):
+        """state
+        Return the [path, mtime, size, sha1] state of a file, or None if the
+        file does not exist.
+
+        :param path:
+        """
+        stat = self.stat(path)
+        if stat is None:
+            return None
+        return [path, stat[0], stat[1], self.hash(path)]
+
+    def unchanged(self, state):
+        """unchanged
+        Return True if the file described by state was not modified. The
+        content hash is computed only if the mtime or size differ.
+
+        :param state:
+        """
+        path, mtime, size, sha1 = state
+        stat = self.stat(path)
+        if stat is None:
+            return False
+        if stat == (mtime, size):
+            return True
+        if self.hash(path) != sha1:
+            return False
+        # Content is identical: remember the new mtime to skip hashing next time
+        state[1], state[2] = stat
+        return True
+
+def dependencies_state(env, dependencies, files):
+    """dependencies_state
+    Return a serializable description of the current state of the inputs that
+    were read to render a template.
+
+    :param env: jinjaenv.Environment
+    :param dependencies: jinjaenv.Dependencies
+    :param files: FileStates
+    """
+    translations = None
+    if env.translations_path is not None:
+        translations = files.state(env.translations_path)
+    templates = []
+    for template_name, path in sorted(dependencies.templates.iteritems()):
+        state = files.state(path)
+        if state is not None:
+            templates.append([template_name, state])
+    variables = [[template_name, key, env.variable_digest(template_name, key)]
+                 for template_name, key in sorted(dependencies.variables)]
+    queries = []
+    for name, args in sorted(dependencies.queries):
+        args = _encode(json.loads(args))
+        queries.append([name, args, env.query_digest(name, args)])
+    return {
+        "templates": templates,
+        "variables": variables,
+        "queries": queries,
+        "translations": translations,
+    }
+
+def is_up_to_date(state, env, files):
+    """is_up_to_date
+    Return True if none of the inputs described by a dependencies state have
+    changed.
+
+    :param state: value returned by dependencies_state
+    :param env: jinjaenv.Environment
+    :param files: FileStates
+    """
+    translations = state["translations"]
+    if translations is None:
+        if env.translations_path is not None:
+            return False
+    elif translations[0] != env.translations_path or not files.unchanged(translations):
+        return False
+    for template_name, template_state in state["templates"]:
+        if env.template_path(template_name) != template_state[0] or not files.unchanged(template_state):
+            return False
+    for template_name, key, value_digest in state["variables"]:
+        if env.variable_digest(template_name, key) != value_digest:
+            return False
+    for name, args, result_digest in state["queries"]:
+        if env.query_digest(name, args) != result_digest:
+            return False
+    return True
+
+class Manifest(object):
+    """Manifest
+    Persistent record of the inputs of each generated file. A file whose
+    inputs were left untouched since the previous build does not need to be
+    rendered again, unless the files were written with other options (e.g:
+    minified).
+    """
+    VERSION = 3
+
+    def __init__(self, path, options=None):
+        self.path = path
+        self.options = options or {}
+        self.files = FileStates()
+        self.entries = {}
+        self._dependents = None
+        # Entries of files written with other options are only kept for pruning
+        self._stale = False
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    content = json.load(f)
+            except ValueError:
+                content = {}
+            if content.get("version") == self.VERSION:
+                self.entries = _encode(content["entries"])
+                self._stale = _encode(content.get("options", {})) != self.options
+
+    @staticmethod
+    def build_path(src_path, dst_path, locale):
+        """build_path
+        Return the path of the manifest associated to a (source, destination,
+        locale) build.
+
+        :param src_path:
+        :param dst_path:
+        :param locale:
+        """
+        key = "%s\0%s" % (os.path.abspath(dst_path), locale or "")
+        return cache.path(src_path, "manifest-%s.json" % hashlib.sha1(key).hexdigest()[:16])
+
+    @classmethod
+    def for_build(cls, src_path, dst_path, locale, options=None):
+        """for_build
+        Load the manifest associated to a (source, destination, locale) build.
+
+        :param src_path:
+        :param dst_path:
+        :param locale:
+        :param options: options of the output.Writer of the build.
+        """
+        return cls(cls.build_path(src_path, dst_path, locale), options)
+
+    @classmethod
+    def discard(cls, src_path, dst_path, locale):
+        """discard
+        Delete the manifest associated to a build, e.g: after its files were
+        generated again without recording their inputs, such that the next
+        incremental build does not trust outdated entries.
+
+        :param src_path:
+        :param dst_path:
+        :param locale:
+        """
+        path = cls.build_path(src_path, dst_path, locale)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def is_fresh(self, dst_file_path, env):
+        """is_fresh
+        Return True if dst_file_path exists and none of the inputs it was
+        rendered from have changed.
+
+        :param dst_file_path:
+        :param env: jinjaenv.Environment
+        """
+        entry = self.entries.get(dst_file_path)
+        if entry is None or self._stale or not os.path.exists(dst_file_path):
+            return False
+        return is_up_to_date(entry, env, self.files)
+
+    def record(self, dst_file_path, url, env, dependencies):
+        """record
+        Save the inputs that were used to render dst_file_path.
+
+        :param dst_file_path:
+        :param url: url of the rendered template.
+        :param env: jinjaenv.Environment
+        :param dependencies: jinjaenv.Dependencies
+        """
+        self._unindex(dst_file_path)
+        entry = dependencies_state(env, dependencies, self.files)
+        entry["url"] = url
+        self.entries[dst_file_path] = entry
+        self._index(dst_file_path)
+
+    def _index(self, dst_file_path):
+        if self._dependents is not None:
+            for template_name, state in self.entries[dst_file_path]["templates"]:
+                self._dependents.setdefault(state[0], set()).add(dst_file_path)
+
+    def _unindex(self, dst_file_path):
+        if self._dependents is not None and dst_file_path in self.entries:
+            for template_name, state in self.entries[dst_file_path]["templates"]:
+                self._dependents[state[0]].discard(dst_file_path)
+
+    def dependent_urls(self, paths):
+        """dependent_urls
+        Return the urls of the generated files that depend on any of the given
+        template files.
+
+        :param paths: set of absolute template paths.
+        """
+        if self._dependents is None:
+            self._dependents = {}
+            for dst_file_path in self.entries:
+                self._index(dst_file_path)
+        dst_file_paths = set()
+        for path in paths:
+            dst_file_paths.update(self._dependents.get(path, ()))
+        return [self.entries[dst_file_path]["url"] for dst_file_path in dst_file_paths]
+
+    def prune(self, dst_file_paths, writer=None):
+        """prune
+        Delete the generated files that are listed in the manifest but were not
+        generated during the current build.
+
+        :param dst_file_paths: set of files that should be kept.
+        :param writer: output.Writer that deletes the files.
+        """
+        for dst_file_path in self.entries.keys():
+            if dst_file_path not in dst_file_paths:
+                self.prune_file(dst_file_path, writer)
+
+    def prune_file(self, dst_file_path, writer=None):
+        if writer is not None:
+            writer.remove(dst_file_path)
+        elif os.path.exists(dst_file_path):
+            os.remove(dst_file_path)
+        self._unindex(dst_file_path)
+        self.entries.pop(dst_file_path, None)
+
+    def save(self):
+        # json.dumps uses the C encoder, unlike json.dump
+        content = json.dumps({"version": self.VERSION, "options": self.options,
+                              "entries": self.entries})
+        with open(self.path, "w") as f:
+            f.write(content)
+        # All the files were rendered again with the current options
+        self._stale = False
+
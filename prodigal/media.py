@@ -1,10 +1,28 @@
+import os
+import sys
+import json
+import errno
+import shutil
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import cache
+import compress
+import minify
+
+# Linux ioctl that creates a copy-on-write clone of a file (reflink)
+FICLONE = 0x40049409
+
 class Media(object):
     _instance = None
 
     def __init__(self):
         self.folders = []
     def add(self, folder):
-        self.folders.append(folder)
+        if folder not in self.folders:
+            self.folders.append(folder)
 
 def get():
     if Media._instance is None:
@@ -16,3 +34,178 @@ def add(folder):
 
 def folders():
     return get().folders
+
+def _is_modified(src_file, dst_file, checksum):
+    try:
+        dst_stat = os.stat(dst_file)
+    except OSError:
+        return True
+    src_stat = os.stat(src_file)
+    if src_stat.st_size != dst_stat.st_size:
+        return True
+    if checksum:
+        return cache.file_hash(src_file) != cache.file_hash(dst_file)
+    # Some filesystems do not store sub-second timestamps
+    return abs(src_stat.st_mtime - dst_stat.st_mtime) >= 1
+
+def _minify(src_file, dst_file, minifier):
+    if os.path.lexists(dst_file):
+        os.remove(dst_file)
+    with open(src_file, "rb") as f:
+        content = minifier(f.read())
+    with open(dst_file, "wb") as f:
+        f.write(content)
+    # The minified file keeps the mtime of the source file
+    shutil.copystat(src_file, dst_file)
+
+def _minified_stamp(src_file, dst_file):
+    try:
+        src_stat = os.stat(src_file)
+        dst_stat = os.stat(dst_file)
+    except OSError:
+        return None
+    return [src_stat.st_mtime, src_stat.st_size, dst_stat.st_mtime, dst_stat.st_size]
+
+class MinifiedFiles(object):
+    """MinifiedFiles
+    Persistent record of the (mtime, size) of each minified media file and of
+    its source, such that files are minified again only if either of them
+    was modified since. Without path, the record is not persistent.
+    """
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.files = {}
+        self._previous = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    content = json.load(f)
+            except ValueError:
+                content = {}
+            if content.get("version") == self.VERSION:
+                self._previous = dict((name.encode("utf-8"), stamp)
+                                      for name, stamp in content["files"].iteritems())
+
+    @classmethod
+    def for_source(cls, src_path):
+        return cls(cache.path(src_path, "minified.json"))
+
+    def is_modified(self, src_file, dst_file):
+        """is_modified
+        Return True if dst_file is not the minified version of the current
+        content of src_file.
+
+        :param src_file:
+        :param dst_file:
+        """
+        src_file = os.path.abspath(src_file)
+        stamp = _minified_stamp(src_file, dst_file)
+        if stamp is None or stamp != self._previous.get(src_file):
+            return True
+        self.files[src_file] = stamp
+        return False
+
+    def record(self, src_file, dst_file):
+        src_file = os.path.abspath(src_file)
+        self.files[src_file] = _minified_stamp(src_file, dst_file)
+
+    def save(self):
+        """save
+        Save the files that were minified or checked since the record was
+        loaded, such that removed files are forgotten.
+        """
+        if self.path is None or self.files == self._previous:
+            return
+        with cache.atomic_file(self.path) as f:
+            json.dump({"version": self.VERSION, "files": self.files}, f)
+        self._previous = dict(self.files)
+
+def _clone(src_file, dst_file):
+    with open(src_file, "rb") as fsrc:
+        with open(dst_file, "wb") as fdst:
+            if fcntl is not None and sys.platform.startswith("linux"):
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    return
+                except IOError:
+                    # Reflinks are not supported by this filesystem
+                    pass
+            shutil.copyfileobj(fsrc, fdst, 1024*1024)
+
+def _copy(src_file, dst_file, link):
+    # Never write to an existing file, which might be a hardlink to the source
+    if os.path.lexists(dst_file):
+        os.remove(dst_file)
+    if link:
+        try:
+            os.link(src_file, dst_file)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    _clone(src_file, dst_file)
+    shutil.copystat(src_file, dst_file)
+
+def sync(src_folder, dst_folder, checksum=False, link=False, minify_files=False, minified=None):
+    """sync
+    Synchronize the content of dst_folder with src_folder: copy only new and
+    modified files and delete files that no longer exist in src_folder.
+    Files are considered modified if their size or mtime differ; if checksum
+    is True, files of equal size are compared by content instead of mtime.
+    Copies are performed with reflinks when the filesystem supports them.
+    Precompressed siblings of the copied files (e.g: style.css.gz) are kept.
+    Return the (copied, deleted) number of files.
+
+    :param src_folder:
+    :param dst_folder:
+    :param checksum: compare file contents instead of mtimes.
+    :param link: create hardlinks instead of copies when possible.
+    :param minify_files: minify css and js files instead of copying them.
+    :param minified: MinifiedFiles record of the files that were minified by
+    previous syncs; without it, all css and js files are minified again.
+    """
+    if minified is None:
+        minified = MinifiedFiles()
+    copied = 0
+    deleted = 0
+    src_files = set()
+    for dirpath, dirnames, filenames in os.walk(src_folder, followlinks=True):
+        dst_dirpath = os.path.join(dst_folder, os.path.relpath(dirpath, src_folder))
+        if not os.path.isdir(dst_dirpath):
+            if os.path.lexists(dst_dirpath):
+                os.remove(dst_dirpath)
+            os.makedirs(dst_dirpath)
+        src_files.add(os.path.normpath(dst_dirpath))
+        for filename in filenames:
+            src_file = os.path.join(dirpath, filename)
+            dst_file = os.path.join(dst_dirpath, filename)
+            src_files.add(os.path.normpath(dst_file))
+            if os.path.isdir(dst_file) and not os.path.islink(dst_file):
+                shutil.rmtree(dst_file)
+            minifier = minify.MINIFIERS.get(os.path.splitext(filename)[1]) if minify_files else None
+            if minifier is not None:
+                if minified.is_modified(src_file, dst_file):
+                    _minify(src_file, dst_file, minifier)
+                    minified.record(src_file, dst_file)
+                    copied += 1
+            elif _is_modified(src_file, dst_file, checksum):
+                _copy(src_file, dst_file, link)
+                copied += 1
+
+    # Delete removed files, deepest first
+    for dirpath, dirnames, filenames in os.walk(dst_folder, topdown=False):
+        for name in filenames + dirnames:
+            path = os.path.join(dirpath, name)
+            if os.path.normpath(path) in src_files:
+                continue
+            base, ext = os.path.splitext(path)
+            if ext in compress.EXTENSIONS and os.path.normpath(base) in src_files:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+                deleted += 1
+    return copied, deleted
@@ -0,0 +1,326 @@
+import bisect
+import operator
+import threading
+
+_MISSING = object()
+
+def _intern(name):
+    # Template names are shared by many records and index entries
+    return intern(name) if isinstance(name, str) else name
+
+class PageRecord(object):
+    """PageRecord
+    Variables of a page. The most common variables are stored in slots and
+    the others in a dict that is created only when needed, such that records
+    take little memory. A record is a read-only mapping of its variables.
+    Aliases also record the name of the template they render.
+    """
+    __slots__ = ("template", "title", "date", "tags", "post", "extra")
+    FIELDS = frozenset(["title", "date", "tags", "post"])
+
+    def __init__(self, template=None):
+        self.template = template
+        self.title = None
+        self.date = None
+        self.tags = None
+        self.post = None
+        self.extra = None
+
+    def set(self, key, value):
+        if key in PageRecord.FIELDS:
+            setattr(self, key, value)
+            if value is not None:
+                if self.extra is not None:
+                    self.extra.pop(key, None)
+                return
+        # Slots set to None are undefined: defined None values are extra
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def get(self, key, default=None):
+        if key in PageRecord.FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        if self.extra is None:
+            return default
+        return self.extra.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def keys(self):
+        keys = [key for key in PageRecord.FIELDS if getattr(self, key) is not None]
+        if self.extra is not None:
+            keys += self.extra.keys()
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self.get(key)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __eq__(self, other):
+        return dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return (self.template, self.title, self.date, self.tags, self.post, self.extra)
+
+    def __setstate__(self, state):
+        self.template, self.title, self.date, self.tags, self.post, self.extra = state
+
+class MetadataStore(object):
+    """MetadataStore
+    Records of the variables of each page (title, date, tags...) and of the
+    template rendered by each alias, with secondary indexes that answer
+    listing queries without scanning all pages. Indexes are built on the
+    first query that needs them, and dropped whenever a variable they depend
+    on is modified: during a build, each index is thus sorted once, after
+    _config.html was rendered. Stores are pickled as flat tuples, without
+    their indexes, e.g: to be sent to rendering processes.
+    """
+    # Queries that can be run by name, e.g. from recorded dependencies
+    QUERIES = ("latest", "sorted_by", "range_by", "with_value", "values", "paginate")
+
+    def __init__(self):
+        self._pages = {}
+        # key -> sorted list of (value, template_name)
+        self._sorted = {}
+        # key -> {value: template names sorted by decreasing date}
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # One list per field, which pickles faster than one tuple per page;
+        # fields that are never set are not pickled
+        names = self._pages.keys()
+        records = [self._pages[name] for name in names]
+        columns = []
+        for field in PageRecord.__slots__:
+            column = map(operator.attrgetter(field), records)
+            columns.append(column if any(value is not None for value in column) else None)
+        return names, columns
+
+    def __setstate__(self, state):
+        self.__init__()
+        names, columns = state
+        columns = [[None] * len(names) if column is None else column for column in columns]
+        new = PageRecord.__new__
+        for name, template, title, date, tags, post, extra in zip(names, *columns):
+            record = new(PageRecord)
+            record.template = template
+            record.title = title
+            record.date = date
+            record.tags = tags
+            record.post = post
+            record.extra = extra
+            self._pages[_intern(name)] = record
+
+    def get(self, template_name, key=None):
+        """get
+        Return the value of a variable, or the record of all variables of
+        the template if key is None.
+
+        :param template_name:
+        :param key:
+        """
+        record = self._pages.get(template_name)
+        if key is None:
+            return {} if record is None else record
+        return None if record is None else record.get(key)
+
+    def _record(self, template_name):
+        record = self._pages.get(template_name)
+        if record is None:
+            record = PageRecord()
+            self._pages[_intern(template_name)] = record
+        return record
+
+    def set(self, template_name, key, value):
+        self._record(template_name).set(key, value)
+        self._invalidate([key])
+
+    def set_all(self, template_name, variables, template=None):
+        """set_all
+        Replace all variables of a page.
+
+        :param template_name:
+        :param variables: dict
+        :param template: name of the template rendered by this page, if it
+        is an alias.
+        """
+        record = PageRecord(None if template is None else _intern(template))
+        for key, value in variables.iteritems():
+            record.set(key, value)
+        self._pages[_intern(template_name)] = record
+        self._invalidate(variables.keys())
+
+    def template(self, template_name):
+        """template
+        Return the name of the template rendered by an alias, or None.
+        """
+        record = self._pages.get(template_name)
+        return None if record is None else record.template
+
+    def aliases(self):
+        """aliases
+        Return the names of all aliases.
+        """
+        return [name for name, record in self._pages.iteritems() if record.template is not None]
+
+    def _invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                self._sorted.pop(key, None)
+                self._groups.pop(key, None)
+                if key == "date":
+                    # Groups are sorted by date
+                    self._groups.clear()
+
+    def templates_with(self, key):
+        """templates_with
+        Return the sorted (template_name, value) pairs of all templates that
+        define a variable.
+
+        :param key:
+        """
+        return sorted([(t, record[key]) for t, record in self._pages.iteritems()
+                       if key in record])
+
+    def _sorted_index(self, key):
+        with self._lock:
+            index = self._sorted.get(key)
+            if index is None:
+                index = sorted((value, t) for t, value in self.templates_with(key))
+                self._sorted[key] = index
+            return index
+
+    def _group_index(self, key):
+        with self._lock:
+            groups = self._groups.get(key)
+        if groups is not None:
+            return groups
+        groups = {}
+        # Iterate by decreasing date, such that groups are sorted by date
+        dated = [t for date, t in reversed(self._sorted_index("date"))]
+        undated = sorted(t for t, record in self._pages.iteritems()
+                         if "date" not in record)
+        for t in dated + undated:
+            value = self._pages[t].get(key)
+            if value is None:
+                continue
+            for v in value if isinstance(value, (list, tuple)) else [value]:
+                groups.setdefault(v, []).append(t)
+        with self._lock:
+            self._groups[key] = groups
+        return groups
+
+    def sorted_by(self, key, reverse=False, start=0, count=None):
+        """sorted_by
+        Return the names of the templates that define a variable, sorted by
+        value (ties are sorted by template name).
+
+        :param key:
+        :param reverse: sort by decreasing value.
+        :param start: index of the first returned template.
+        :param count: maximum number of returned templates.
+        """
+        index = self._sorted_index(key)
+        if reverse:
+            end = len(index) - start
+            begin = 0 if count is None else max(end - count, 0)
+            return [t for value, t in reversed(index[begin:max(end, 0)])]
+        end = len(index) if count is None else start + count
+        return [t for value, t in index[start:end]]
+
+    def latest(self, count):
+        """latest
+        Return the names of the `count` templates with the most recent date.
+        """
+        return self.sorted_by("date", True, 0, count)
+
+    def range_by(self, key, low, high):
+        """range_by
+        Return the names of the templates whose value is in [low, high),
+        sorted by value.
+        """
+        index = self._sorted_index(key)
+        begin = bisect.bisect_left(index, (low,))
+        end = bisect.bisect_left(index, (high,))
+        return [t for value, t in index[begin:end]]
+
+    def with_value(self, key, value, start=0, count=None):
+        """with_value
+        Return the names of the templates whose variable is equal to value, or
+        contains value if it is a list (e.g: tags), sorted by decreasing date.
+
+        :param key:
+        :param value:
+        :param start:
+        :param count:
+        """
+        templates = self._group_index(key).get(value, [])
+        end = len(templates) if count is None else start + count
+        return templates[start:end]
+
+    def values(self, key):
+        """values
+        Return the sorted (value, number of templates) pairs of a variable,
+        e.g: all tags and their number of posts.
+        """
+        return sorted((value, len(templates)) for value, templates
+                      in self._group_index(key).iteritems())
+
+    def paginate(self, page, per_page, key="date", reverse=True, value_key=None, value=None):
+        """paginate
+        Return a page of templates sorted by a variable, as a dict with
+        "items", "page" and "page_count" keys. Pages are numbered from 1.
+
+        :param page:
+        :param per_page:
+        :param key: sort variable; the most recent pages come first by default.
+        :param reverse:
+        :param value_key: if not None, list only the templates for which
+        with_value(value_key, value) is true.
+        :param value:
+        """
+        if value_key is None:
+            total = len(self._sorted_index(key))
+        else:
+            total = len(self.with_value(value_key, value))
+        page_count = max(1, (total + per_page - 1) / per_page)
+        start = (page - 1) * per_page
+        if value_key is None:
+            items = self.sorted_by(key, reverse, start, per_page)
+        else:
+            items = self.with_value(value_key, value, start, per_page)
+        return {"items": items, "page": page, "page_count": page_count}
+
+    def query(self, name, *args):
+        """query
+        Run one of the QUERIES by name.
+
+        :param name:
+        :param args:
+        """
+        if name not in self.QUERIES:
+            raise ValueError("Unknown query: %s" % name)
+        return getattr(self, name)(*args)
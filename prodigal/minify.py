@@ -0,0 +1,166 @@
+import re
+
+_SPACES = re.compile(r"\s+")
+_HTML_TOKEN = re.compile(r"<!--|<(pre|textarea|script|style)\b|<", re.I)
+
+class HtmlMinifier(object):
+    """HtmlMinifier
+    Streaming html minifier: runs of whitespace are collapsed into a single
+    space (or newline) and comments are removed, except conditional comments.
+    The content of pre, textarea, script and style elements is kept as-is.
+    Chunks are minified as they are produced; incomplete tags at the end of
+    a chunk are kept until the next chunk.
+    """
+    def __init__(self):
+        self._tail = ""
+        # True if the output ends with whitespace
+        self._space = False
+
+    def _text(self, text):
+        if not text:
+            return ""
+        text = _SPACES.sub(lambda match: "\n" if "\n" in match.group(0) else " ", text)
+        if self._space and text[0] in " \n":
+            text = text[1:]
+        if text:
+            self._space = text[-1] in " \n"
+        return text
+
+    def _token_end(self, data, match):
+        start = match.start()
+        if match.group(0) == "<!--":
+            end = data.find("-->", start + 4)
+            return -1 if end < 0 else end + 3
+        if match.group(1) is not None:
+            close = re.compile(r"</%s\s*>" % match.group(1), re.I).search(data, match.end())
+            return -1 if close is None else close.end()
+        end = data.find(">", start + 1)
+        return -1 if end < 0 else end + 1
+
+    def feed(self, chunk):
+        """feed
+        Return the minified content of a chunk.
+
+        :param chunk: str
+        """
+        data = self._tail + chunk
+        result = []
+        pos = 0
+        while True:
+            match = _HTML_TOKEN.search(data, pos)
+            if match is None:
+                result.append(self._text(data[pos:]))
+                self._tail = ""
+                break
+            result.append(self._text(data[pos:match.start()]))
+            end = self._token_end(data, match)
+            if end < 0:
+                self._tail = data[match.start():]
+                break
+            token = data[match.start():end]
+            if not token.startswith("<!--") or token.startswith("<!--[if") or token.startswith("<!--<!"):
+                result.append(token)
+                self._space = False
+            pos = end
+        return "".join(result)
+
+    def close(self):
+        """close
+        Return the rest of the content, e.g: an unterminated tag.
+        """
+        tail = self._tail
+        self._tail = ""
+        return tail
+
+    def chunks(self, chunks):
+        """chunks
+        Yield the minified chunks of an iterable of chunks.
+
+        :param chunks: iterable of str
+        """
+        for chunk in chunks:
+            chunk = self.feed(chunk)
+            if chunk:
+                yield chunk
+        chunk = self.close()
+        if chunk:
+            yield chunk
+
+def minify_html(content):
+    return "".join(HtmlMinifier().chunks([content]))
+
+_CSS_TOKEN = re.compile(r"(\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*')|(/\*.*?\*/)", re.S)
+_CSS_PUNCTUATION = re.compile(r"\s*([{};,>])\s*")
+
+def _minify_css_code(code):
+    code = _CSS_PUNCTUATION.sub(r"\1", _SPACES.sub(" ", code))
+    # Spaces before colons are significant in selectors, e.g: "a :hover"
+    return code.replace(": ", ":").replace(";}", "}")
+
+def minify_css(content):
+    """minify_css
+    Remove comments (except /*! ... */ comments) and unnecessary whitespace
+    from a stylesheet. Strings are kept as-is.
+
+    :param content: str
+    """
+    result = []
+    code = []
+    pos = 0
+    for match in _CSS_TOKEN.finditer(content):
+        code.append(content[pos:match.start()])
+        pos = match.end()
+        string, comment = match.groups()
+        if string is None and not comment.startswith("/*!"):
+            # Comments separate tokens
+            code.append(" ")
+            continue
+        result.append(_minify_css_code("".join(code)))
+        result.append(match.group(0))
+        code = []
+    code.append(content[pos:])
+    result.append(_minify_css_code("".join(code)))
+    return "".join(result).strip()
+
+_JS_TOKEN = re.compile(r"//[^\n]*|/\*.*?\*/|\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*'"
+                       r"|`(?:\\.|[^`\\])*`", re.S)
+
+def _js_literals(content):
+    # Comments are matched too, such that their quotes do not start strings
+    for match in _JS_TOKEN.finditer(content):
+        if match.group(0)[0] in "\"'`" and "\n" in match.group(0):
+            yield match.span()
+
+def minify_js(content):
+    """minify_js
+    Remove indentation, trailing whitespace and blank lines from a script.
+    Line breaks are kept, such that automatic semicolon insertion is not
+    affected. Lines of multi-line template literals and of strings continued
+    with a backslash are kept as-is.
+
+    :param content: str
+    """
+    literals = list(_js_literals(content))
+    result = []
+    i = 0
+    start = 0
+    for line in content.split("\n"):
+        end = start + len(line)
+        while i < len(literals) and literals[i][1] <= start:
+            i += 1
+        starts_in_literal = i < len(literals) and literals[i][0] < start
+        j = i
+        while j < len(literals) and literals[j][1] <= end:
+            j += 1
+        ends_in_literal = j < len(literals) and literals[j][0] < end
+        if not starts_in_literal:
+            line = line.lstrip()
+        if not ends_in_literal:
+            line = line.rstrip()
+        if line or starts_in_literal or ends_in_literal:
+            result.append(line)
+        start = end + 1
+    return "\n".join(result)
+
+# Minifiers of media files, by extension
+MINIFIERS = {".css": minify_css, ".js": minify_js}
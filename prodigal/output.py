@@ -0,0 +1,184 @@
+import os
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+
+import cache
+import minify
+import tree
+
+def _link_tree(src_folder, dst_folder):
+    """_link_tree
+    Create a copy of a folder in which files are hardlinks to the original
+    files. Files are copied when hardlinks are not supported.
+
+    :param src_folder:
+    :param dst_folder:
+    """
+    for dirpath, dirnames, filenames in os.walk(src_folder):
+        dst_dirpath = os.path.join(dst_folder, os.path.relpath(dirpath, src_folder))
+        if not os.path.isdir(dst_dirpath):
+            os.makedirs(dst_dirpath)
+        for filename in filenames:
+            src_file = os.path.join(dirpath, filename)
+            dst_file = os.path.join(dst_dirpath, filename)
+            if os.path.islink(src_file):
+                os.symlink(os.readlink(src_file), dst_file)
+                continue
+            try:
+                os.link(src_file, dst_file)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(src_file, dst_file)
+
+class Writer(object):
+    """Writer
+    Output stage of a build. Files are written to a temporary file that is
+    then renamed, such that readers of the destination folder never see
+    half-written files, and files whose content did not change are left
+    untouched, which preserves their mtime. Created folders are cached.
+
+    With staging, files are written to a copy of the destination folder
+    (made of hardlinks) that replaces the destination folder on commit. If
+    the destination is a symbolic link, the link is replaced atomically;
+    otherwise the previous folder is renamed before the staging folder is
+    renamed in its place.
+
+    With minify_html, html files are minified as they are written.
+    """
+    def __init__(self, dst_path, staging=False, minify_html=False):
+        self.dst_path = os.path.abspath(dst_path)
+        self.staging = staging
+        self.minify_html = minify_html
+        self.written = 0
+        self.skipped = 0
+        self._directories = set()
+        self._mode = cache.file_mode()
+        self.path = self.dst_path
+        if staging:
+            self.path = self._staging_path()
+            if os.path.lexists(self.path):
+                shutil.rmtree(self.path)
+            if os.path.isdir(self.dst_path):
+                _link_tree(self.dst_path, self.path)
+            else:
+                os.makedirs(self.path)
+
+    def _staging_path(self):
+        if os.path.islink(self.dst_path):
+            # Each build gets its own folder, the link is switched on commit
+            return "%s.%d" % (os.path.realpath(self.dst_path), int(time.time() * 1000))
+        return self.dst_path + ".staging"
+
+    @property
+    def options(self):
+        """options
+        Options that change the content of the written files, such that files
+        generated with other options are not considered up-to-date.
+        """
+        return {"minify_html": True} if self.minify_html else {}
+
+    def target(self, dst_file_path):
+        """target
+        Return the path where a file of the destination folder is actually
+        written.
+
+        :param dst_file_path:
+        """
+        if self.path == self.dst_path:
+            return dst_file_path
+        return os.path.join(self.path, os.path.relpath(dst_file_path, self.dst_path))
+
+    def makedirs(self, dirname):
+        if dirname in self._directories:
+            return
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Folder may have been created concurrently
+                if not os.path.isdir(dirname):
+                    raise
+        self._directories.add(dirname)
+
+    def is_unchanged(self, path, size, sha1):
+        entry = tree.stat(path)
+        if entry is None or entry.size != size:
+            return False
+        return cache.file_hash(path) == sha1
+
+    def write(self, dst_file_path, content):
+        """write
+        Atomically write content to a file of the destination folder, unless
+        the file already has this content. Return True if the file was
+        written.
+
+        :param dst_file_path:
+        :param content: str, or iterable of str chunks that are written as
+        they are produced.
+        """
+        path = self.target(dst_file_path)
+        if self.minify_html and os.path.splitext(path)[1] in (".html", ".htm"):
+            if isinstance(content, str):
+                content = minify.minify_html(content)
+            else:
+                content = minify.HtmlMinifier().chunks(content)
+        if isinstance(content, str):
+            if self.is_unchanged(path, len(content), hashlib.sha1(content).hexdigest()):
+                self.skipped += 1
+                return False
+            content = [content]
+        self.makedirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            sha1 = hashlib.sha1()
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                os.fchmod(f.fileno(), self._mode)
+                for chunk in content:
+                    sha1.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            if self.is_unchanged(path, size, sha1.hexdigest()):
+                os.remove(tmp_path)
+                self.skipped += 1
+                return False
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        self.written += 1
+        return True
+
+    def remove(self, dst_file_path):
+        path = self.target(dst_file_path)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def commit(self):
+        """commit
+        Replace the destination folder by the staging folder, if any.
+        """
+        if not self.staging:
+            return
+        if os.path.islink(self.dst_path):
+            previous = os.path.realpath(self.dst_path)
+            link = self.dst_path + ".tmp"
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.path, link)
+            os.rename(link, self.dst_path)
+        else:
+            previous = self.dst_path + ".previous"
+            if os.path.lexists(previous):
+                shutil.rmtree(previous)
+            if os.path.lexists(self.dst_path):
+                os.rename(self.dst_path, previous)
+            os.rename(self.path, self.dst_path)
+        if os.path.isdir(previous):
+            shutil.rmtree(previous)
+        self.path = self.dst_path
+        self.staging = False
@@ -0,0 +1,152 @@
+import csv
+import json
+import time
+import contextlib
+
+class Profiler(object):
+    """Profiler
+    Accumulate the number of calls, wall time and CPU time spent in each
+    profiled operation. Operations are identified by a category (e.g:
+    "render", "filter") and a name (e.g: a template name).
+    """
+    _instance = None
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stats = {}
+
+    def add(self, category, name, count, wall, cpu):
+        stat = self.stats.get((category, name))
+        if stat is None:
+            self.stats[(category, name)] = [count, wall, cpu]
+        else:
+            stat[0] += count
+            stat[1] += wall
+            stat[2] += cpu
+
+    @contextlib.contextmanager
+    def measure(self, category, name):
+        wall = time.time()
+        cpu = time.clock()
+        try:
+            yield
+        finally:
+            self.add(category, name, 1, time.time() - wall, time.clock() - cpu)
+
+    def pop_stats(self):
+        """pop_stats
+        Return the collected statistics in a picklable form and reset them.
+        """
+        stats = [(category, name) + tuple(stat) for (category, name), stat in self.stats.iteritems()]
+        self.stats = {}
+        return stats
+
+    def merge(self, stats):
+        for category, name, count, wall, cpu in stats:
+            self.add(category, name, count, wall, cpu)
+
+    def rows(self):
+        """rows
+        Return (category, name, count, wall, cpu) rows sorted by decreasing
+        wall time.
+        """
+        rows = [(category, name) + tuple(stat) for (category, name), stat in self.stats.iteritems()]
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows
+
+    def report(self, top=20):
+        """report
+        Return a text report of the time spent in each category and of the
+        `top` most expensive operations.
+
+        :param top:
+        """
+        totals = Profiler()
+        for category, name, count, wall, cpu in self.rows():
+            totals.add(category, "", count, wall, cpu)
+
+        lines = ["%-8s %8s %10s %10s" % ("category", "calls", "wall (ms)", "cpu (ms)")]
+        for category, name, count, wall, cpu in totals.rows():
+            lines.append("%-8s %8d %10.1f %10.1f" % (category, count, wall * 1000, cpu * 1000))
+        lines.append("")
+        lines.append("%-8s %-40s %8s %10s %10s %10s" % ("category", "name", "calls", "wall (ms)",
+                                                       "cpu (ms)", "ms/call"))
+        for category, name, count, wall, cpu in self.rows()[:top]:
+            lines.append("%-8s %-40s %8d %10.1f %10.1f %10.3f" % (category, name[-40:], count,
+                wall * 1000, cpu * 1000, wall * 1000 / count))
+        return "\n".join(lines)
+
+    def write(self, path):
+        """write
+        Save all statistics to a .json or .csv file, depending on the file
+        extension.
+
+        :param path:
+        """
+        fields = ["category", "name", "calls", "wall", "cpu"]
+        rows = sorted(self.rows())
+        with open(path, "wb") as f:
+            if path.endswith(".csv"):
+                writer = csv.writer(f)
+                writer.writerow(fields)
+                writer.writerows(rows)
+            else:
+                json.dump([dict(zip(fields, row)) for row in rows], f, indent=2)
+
+class _NoProfiling(object):
+    def __enter__(self):
+        pass
+    def __exit__(self, *args):
+        pass
+
+_NO_PROFILING = _NoProfiling()
+
+def get():
+    if Profiler._instance is None:
+        Profiler._instance = Profiler()
+    return Profiler._instance
+
+def enable():
+    """enable
+    Start profiling with empty statistics.
+    """
+    Profiler._instance = Profiler(enabled=True)
+
+def is_enabled():
+    return get().enabled
+
+def measure(category, name):
+    """measure
+    Context manager that measures the time spent in its scope, if profiling
+    is enabled.
+
+    :param category:
+    :param name:
+    """
+    profiler = get()
+    if not profiler.enabled:
+        return _NO_PROFILING
+    return profiler.measure(category, name)
+
+class TimedIterator(object):
+    """TimedIterator
+    Iterator that measures the wall and CPU time spent producing the items of
+    another iterator, e.g: the chunks of a streamed template, such that
+    rendering can be told apart from writing.
+    """
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.wall = 0
+        self.cpu = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        wall = time.time()
+        cpu = time.clock()
+        try:
+            return next(self._iterator)
+        finally:
+            self.wall += time.time() - wall
+            self.cpu += time.clock() - cpu
@@ -1,5 +1,7 @@
 import os
 
+import tree
+
 def should_translate(path):
     """should_translate
     Return True if the template should be added to the list of files to
@@ -24,27 +26,29 @@ def should_render(path):
         return False
     return True
 
-def list_files(src_path):
+def list_files(src_path, excluded=None):
     """list_files
-    List all files in the given path by walking the directory. Note that all
-    files are returned, including non-renderable, non-translatable files.
+    List all files in the given path. Note that all files are returned,
+    including non-renderable, non-translatable files, except those that match
+    the exclusion patterns.
 
     :param src_path:
+    :param excluded: list of glob patterns, in addition to tree.EXCLUDED.
     """
-    for (dirpath, dirnames, filenames) in os.walk(src_path):
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
-            yield file_path
+    index = tree.TreeIndex(src_path, excluded)
+    for path in index.files():
+        # Paths are returned relative to src_path, as given
+        yield os.path.join(src_path, os.path.relpath(path, index.root))
     raise StopIteration
 
-def list_renderable_files(src_path):
-    for path in list_files(src_path):
+def list_renderable_files(src_path, excluded=None):
+    for path in list_files(src_path, excluded):
         if should_render(path):
             yield path
     raise StopIteration
 
-def list_translatable_files(src_path):
-    for path in list_files(src_path):
+def list_translatable_files(src_path, excluded=None):
+    for path in list_files(src_path, excluded):
         if should_translate(path):
             yield path
     raise StopIteration
@@ -3,12 +3,35 @@ import unittest
 import tempfile
 import os
 import shutil
+import time
+import threading
+import httplib
+import pickle
+import json
+import gzip
+import tarfile
+import StringIO
+import collections
+import babel.messages.catalog
 
 from prodigal import jinjaenv
 from prodigal import tools
 from prodigal import translate
 from prodigal import templates
+from prodigal import tree
+from prodigal import metadata
 from prodigal import filters
+from prodigal import frontmatter
+from prodigal import media
+from prodigal import output
+from prodigal import watcher
+from prodigal import httpserver
+from prodigal import profiler
+from prodigal import benchmark
+from prodigal import artifacts
+from prodigal import compress
+from prodigal import minify
+from prodigal import cache
 
 class ProdigalTestCase(unittest.TestCase):
 
@@ -56,6 +79,9 @@ class ProdigalTestCase(unittest.TestCase):
 msgstr ""
 
 """, po_content)
+        # Only the catalogs built by prodigal use the standard ordered dict
+        self.assertIsInstance(translator.catalog._messages, collections.OrderedDict)
+        self.assertIsNot(collections.OrderedDict, getattr(babel.messages.catalog, "odict", None))
 
     def test_translate_file(self):
         tmp = tempfile.NamedTemporaryFile()
@@ -84,9 +110,76 @@ msgstr "Bonjour tout le monde !"
 
         translate.compile(po_path)
         self.assertTrue(os.path.exists(mo_path))
+        # Compiled files get the permissions of files created by the user
+        self.assertEqual(cache.file_mode(), os.stat(mo_path).st_mode & 0777)
         os.remove(mo_path)
         os.remove(po_path)
 
+    def test_compile_cache(self):
+        src_path = tempfile.mkdtemp()
+        po_path = os.path.join(src_path, "fr.po")
+        def write_po(translation):
+            with open(po_path, "w") as f:
+                f.write('msgid "Hello"\nmsgstr "%s"\n' % translation)
+        try:
+            write_po("Bonjour")
+            self.assertTrue(translate.compile(po_path))
+            self.assertFalse(translate.compile(po_path))
+            write_po("Salut")
+            self.assertTrue(translate.compile(po_path))
+            # Only the current catalog of the locale is kept
+            self.assertEqual(1, len(os.listdir(os.path.join(src_path, cache.DIRNAME, "translations"))))
+
+            # Catalogs that are cached are not parsed again
+            os.remove(os.path.join(src_path, "fr.mo"))
+            read_po = translate._read_po
+            translate._read_po = None
+            try:
+                self.assertTrue(translate.compile(po_path))
+            finally:
+                translate._read_po = read_po
+            translations = translate.MoTranslations(os.path.join(src_path, "fr.mo"))
+            self.assertEqual(u"Salut", translations.ugettext("Hello"))
+        finally:
+            shutil.rmtree(src_path)
+
+    def test_mo_translations(self):
+        src_path = tempfile.mkdtemp()
+        po_path = os.path.join(src_path, "fr.po")
+        with open(po_path, "w") as f:
+            f.write("""msgid ""
+msgstr ""
+"Content-Type: text/plain; charset=utf-8\\n"
+"Plural-Forms: nplurals=2; plural=(n > 1)\\n"
+
+msgid "Hello"
+msgstr "Bonjour"
+
+msgid "%(num)d apple"
+msgid_plural "%(num)d apples"
+msgstr[0] "%(num)d pomme"
+msgstr[1] "%(num)d pommes"
+
+msgid "Zebra"
+msgstr "Z\xc3\xa8bre"
+
+msgid "Untranslated"
+msgstr ""
+""")
+        try:
+            translate.compile(po_path)
+            translations = translate.MoTranslations(os.path.join(src_path, "fr.mo"))
+            self.assertEqual(u"Bonjour", translations.ugettext("Hello"))
+            self.assertEqual(u"Z\xe8bre", translations.ugettext(u"Zebra"))
+            self.assertEqual(u"Untranslated", translations.ugettext("Untranslated"))
+            self.assertEqual(u"Missing", translations.ugettext("Missing"))
+            self.assertEqual(u"%(num)d pomme", translations.ungettext("%(num)d apple", "%(num)d apples", 1))
+            self.assertEqual(u"%(num)d pomme", translations.ungettext("%(num)d apple", "%(num)d apples", 0))
+            self.assertEqual(u"%(num)d pommes", translations.ungettext("%(num)d apple", "%(num)d apples", 2))
+            self.assertEqual(u"pears", translations.ungettext("pear", "pears", 2))
+        finally:
+            shutil.rmtree(src_path)
+
     def test_translation_updater(self):
         src_path = tempfile.mkdtemp()
         updater = translate.Updater(src_path, "fr")
@@ -141,6 +234,108 @@ class JinjaenvTest(unittest.TestCase):
         self.assertEqual("catch 42", jinjaenv.get().render_template("_foo.html", {"times": 42}))
         self.assertEqual("catch 22", jinjaenv.get().render_relative_path("blog"))
 
+    def test_filters_use_rendering_environment(self):
+        with open(os.path.join(self.src_path, "page.html"), "w") as f:
+            f.write("{{ title }} {{ 'page.html'|get_title }} {{ template_name }} {{ range(2)|list }}")
+        env = jinjaenv.Environment(self.src_path)
+        env.set_variable("page.html", "title", "Own")
+        jinjaenv.get().set_variable("page.html", "title", "Current")
+        self.assertEqual("Own Own page.html [0, 1]", env.render_template("page.html"))
+        self.assertEqual("Other Own page.html [0, 1]",
+                         env.render_template("page.html", {"title": "Other"}))
+
+    def test_chain_map(self):
+        chain = jinjaenv.ChainMap({"a": 1}, {"a": 2, "b": 3})
+        self.assertEqual((1, 3), (chain["a"], chain["b"]))
+        self.assertFalse("c" in chain)
+        self.assertEqual({"a": 1, "b": 3}, dict(chain))
+
+    def test_stream_template(self):
+        with open(os.path.join(self.src_path, "big.html"), "w") as f:
+            f.write("{% for i in range(100000) %}{{ i }}\xc3\xa8\n{% endfor %}")
+        chunks = list(jinjaenv.get().stream_template("big.html"))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual("".join("%d\xc3\xa8\n" % i for i in range(100000)), "".join(chunks))
+        self.assertEqual("".join(chunks), jinjaenv.get().render_path(os.path.join(self.src_path, "big.html")))
+        self.assertEqual(None, jinjaenv.get().stream_template("missing.html"))
+
+    def test_bytecode_cache(self):
+        path = os.path.join(self.src_path, "_foo.html")
+        with open(path, "w") as f:
+            f.write("{{ 6 * 7 }}")
+        filters.add_alias("bar", "_foo.html")
+        self.assertEqual("42", jinjaenv.get().render_template("_foo.html"))
+        self.assertEqual("42", jinjaenv.get().render_template("bar"))
+
+        # Aliases share the same cache entry
+        bytecode_path = os.path.join(self.src_path, ".prodigal-cache", "bytecode")
+        self.assertEqual(1, len(os.listdir(bytecode_path)))
+
+        # Compiled templates are loaded from the cache on restart
+        jinjaenv.reinit()
+        filters.add_alias("bar", "_foo.html")
+        self.assertEqual("42", jinjaenv.get().render_template("bar"))
+        self.assertEqual(1, len(os.listdir(bytecode_path)))
+
+        # Modified templates are recompiled
+        with open(path, "w") as f:
+            f.write("{{ 6 * 6 }}")
+        jinjaenv.reinit()
+        self.assertEqual("36", jinjaenv.get().render_template("_foo.html"))
+
+    def write_config(self, content):
+        with open(os.path.join(self.src_path, "_config.html"), "w") as f:
+            f.write(content)
+
+    def test_config_cache(self):
+        with open(os.path.join(self.src_path, "_inc.html"), "w") as f:
+            f.write("{{ 'index.html'|set_title('Home') }}")
+        self.write_config("{% include '_inc.html' %}{{ 'post'|add_alias('_post.html') }}"
+                          "{{ 'media'|add_media }}")
+        jinjaenv.init(self.src_path)
+        self.assertEqual("Home", jinjaenv.get().get_variable("index.html", "title"))
+
+        # The cached evaluation is loaded as long as no file it read is modified
+        cache_path = jinjaenv.ConfigCache.for_environment(jinjaenv.get()).path
+        with open(cache_path, "rb") as f:
+            content = pickle.load(f)
+        store = metadata.MetadataStore()
+        store.__setstate__(content["pages"])
+        store.set("index.html", "title", "Cached")
+        content["pages"] = store.__getstate__()
+        with open(cache_path, "wb") as f:
+            pickle.dump(content, f)
+        jinjaenv.init(self.src_path)
+        env = jinjaenv.get()
+        self.assertEqual("Cached", env.get_variable("index.html", "title"))
+        self.assertEqual("_post.html", env.pages.template("post"))
+        self.assertIn("_inc.html", env.config_dependencies.templates)
+        self.assertIn("media", media.folders())
+
+        with open(os.path.join(self.src_path, "_inc.html"), "w") as f:
+            f.write("{{ 'index.html'|set_title('Modified') }}")
+        jinjaenv.init(self.src_path)
+        self.assertEqual("Modified", jinjaenv.get().get_variable("index.html", "title"))
+
+    def test_reinit(self):
+        for name in ("_a.html", "_b.html"):
+            with open(os.path.join(self.src_path, name), "w") as f:
+                f.write(name)
+        self.write_config("{{ 'page'|add_alias('_a.html') }}")
+        jinjaenv.init(self.src_path)
+        previous = jinjaenv.get()
+        self.assertEqual("_a.html", previous.render_template("page"))
+
+        self.write_config("{{ 'page'|add_alias('_b.html') }}{{ 'x'|set_title('X') }}")
+        jinjaenv.reinit()
+        env = jinjaenv.get()
+        self.assertIsNot(previous, env)
+        self.assertIs(previous._jinja_env, env._jinja_env)
+        self.assertIs(env, env._jinja_env.owner)
+        self.assertEqual("_b.html", env.render_template("page"))
+        self.assertEqual("X", env.get_variable("x", "title"))
+        self.assertEqual(None, previous.get_variable("x", "title"))
+
 class ToolsTranslateTest(unittest.TestCase):
     def setUp(self):
         self.src_path = tempfile.mkdtemp()
@@ -186,6 +381,64 @@ msgstr "Bonjour tout le monde !"
         tools.translate_templates("fr", self.src_path)
         self.assertEqual(translations, open(po_path).read())
 
+    def test_incremental_translate(self):
+        po_path = os.path.join(self.src_path, "fr.po")
+        tools.translate_templates("fr", self.src_path)
+        with open(po_path, "w") as f:
+            f.write("""#: %s:1
+msgid "Hello World!"
+msgstr "Bonjour tout le monde !"
+""" % self.f1.name)
+
+        # Unmodified templates are not parsed again
+        extracted = []
+        extract_file = translate.extract_file
+        translate.extract_file = lambda path: extracted.append(path) or extract_file(path)
+        try:
+            tools.translate_templates("fr", self.src_path)
+            self.assertEqual([], extracted)
+            with open(self.f1.name, "w") as f:
+                f.write("{% trans %}Goodbye!{% endtrans %}")
+            tools.translate_templates("fr", self.src_path)
+            self.assertEqual([self.f1.name], extracted)
+        finally:
+            translate.extract_file = extract_file
+
+        # Removed messages are obsolete
+        self.assertEqual("""#: %s:1
+msgid "Goodbye!"
+msgstr ""
+
+#~ msgid "Hello World!"
+#~ msgstr "Bonjour tout le monde !"
+
+""" % self.f1.name, open(po_path).read())
+
+        # Obsolete messages recover their translation
+        with open(self.f1.name, "w") as f:
+            f.write("{% trans %}Hello World!{% endtrans %}")
+        tools.translate_templates("fr", self.src_path)
+        self.assertEqual("""#: %s:1
+msgid "Hello World!"
+msgstr "Bonjour tout le monde !"
+
+#~ msgid "Goodbye!"
+#~ msgstr ""
+
+""" % self.f1.name, open(po_path).read())
+
+    def test_translate_multiple_locales(self):
+        self.assertEqual(["de", "fr"], tools.translate_templates(["de", "fr"], self.src_path))
+        for locale in ["de", "fr"]:
+            self.assertIn('msgid "Hello World!"', open(os.path.join(self.src_path, locale + ".po")).read())
+
+        # Only modified catalogs are written
+        de_path = os.path.join(self.src_path, "de.po")
+        with open(de_path, "w") as f:
+            f.write("")
+        self.assertEqual(["de"], tools.translate_templates(["de", "fr"], self.src_path))
+        self.assertEqual([], tools.translate_templates(["de", "fr"], self.src_path))
+
 class ToolsGenerateTest(unittest.TestCase):
     def setUp(self):
         self.src_path = tempfile.mkdtemp()
@@ -224,13 +477,1048 @@ msgstr "Bonjour tout le monde !"
         self.assertFalse(os.path.exists(f2_dst_path))
         self.assertEqual("Bonjour tout le monde !", open(f1_dst_path).read())
 
+    def test_multiple_locales(self):
+        for locale, translation in [("fr", "Bonjour tout le monde !"), ("de", "Hallo Welt!")]:
+            with open(os.path.join(self.src_path, locale + ".po"), "w") as tmp:
+                tmp.write("""msgid "Hello World!"
+msgstr "%s"
+""" % translation)
+        self.assertEqual(["de", "fr"], tools.all_locales(self.src_path))
+        tools.generate(self.src_path, self.dst_path, ["fr", "de"])
+
+        filename = os.path.basename(self.f1.name)
+        self.assertEqual("Bonjour tout le monde !",
+                         open(os.path.join(self.dst_path, "fr", filename)).read())
+        self.assertEqual("Hallo Welt!",
+                         open(os.path.join(self.dst_path, "de", filename)).read())
+        self.assertFalse(os.path.exists(os.path.join(self.dst_path, filename)))
+
+    def test_parallel(self):
+        paths = [os.path.join(self.src_path, "page%d.html" % i) for i in range(4)]
+        for i, path in enumerate(paths):
+            with open(path, "w") as f:
+                f.write("{{ %d * 2 }}" % i)
+        tools.generate(self.src_path, self.dst_path, jobs=2)
+
+        for i, path in enumerate(paths):
+            dst_path = os.path.join(self.dst_path, os.path.basename(path))
+            self.assertEqual(str(i * 2), open(dst_path).read())
+
+class ToolsIncrementalGenerateTest(unittest.TestCase):
+    def setUp(self):
+        self.src_path = tempfile.mkdtemp()
+        self.dst_path = tempfile.mkdtemp()
+        with open(os.path.join(self.src_path, "_base.html"), "w") as f:
+            f.write("base {% block content %}{% endblock %}")
+        with open(os.path.join(self.src_path, "_config.html"), "w") as f:
+            f.write("{{ 'index.html'|set_title('Index') }}")
+        with open(os.path.join(self.src_path, "index.html"), "w") as f:
+            f.write("{% extends '_base.html' %}{% block content %}{{ 'index.html'|get_title }}{% endblock %}")
+        with open(os.path.join(self.src_path, "about.html"), "w") as f:
+            f.write("about")
+        self.index_path = os.path.join(self.dst_path, "index.html")
+        self.about_path = os.path.join(self.dst_path, "about.html")
+
+    def tearDown(self):
+        shutil.rmtree(self.src_path)
+        shutil.rmtree(self.dst_path)
+
+    def tamper(self, *paths):
+        for path in paths:
+            with open(path, "w") as f:
+                f.write("tampered")
+
+    def test_unchanged_files_are_skipped(self):
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.assertEqual("base Index", open(self.index_path).read())
+
+        self.tamper(self.index_path, self.about_path)
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.assertEqual("tampered", open(self.index_path).read())
+        self.assertEqual("tampered", open(self.about_path).read())
+
+    def test_modified_dependencies_are_rendered(self):
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+
+        # Modify parent template
+        self.tamper(self.index_path, self.about_path)
+        with open(os.path.join(self.src_path, "_base.html"), "w") as f:
+            f.write("new base {% block content %}{% endblock %}")
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.assertEqual("new base Index", open(self.index_path).read())
+        self.assertEqual("tampered", open(self.about_path).read())
+
+        # Modify config variable
+        with open(os.path.join(self.src_path, "_config.html"), "w") as f:
+            f.write("{{ 'index.html'|set_title('New index') }}")
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.assertEqual("new base New index", open(self.index_path).read())
+        self.assertEqual("tampered", open(self.about_path).read())
+
+    def test_modified_listings_are_rendered(self):
+        with open(os.path.join(self.src_path, "_config.html"), "w") as f:
+            f.write("{{ 'about.html'|set_date('2013-01-01') }}{{ 'about.html'|set_title('About') }}")
+        with open(os.path.join(self.src_path, "index.html"), "w") as f:
+            f.write("{% for page in 1|latest_pages %}{{ page|get_title }}{% endfor %}")
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.assertEqual("About", open(self.index_path).read())
+
+        # Variables that do not change the listing
+        self.tamper(self.index_path)
+        with open(os.path.join(self.src_path, "_config.html"), "w") as f:
+            f.write("{{ 'about.html'|set_date('2013-01-01') }}{{ 'about.html'|set_title('About') }}"
+                    "{{ 'old.html'|set_date('2012-01-01') }}")
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.assertEqual("tampered", open(self.index_path).read())
+
+        # New latest page
+        with open(os.path.join(self.src_path, "_config.html"), "w") as f:
+            f.write("{{ 'about.html'|set_date('2013-01-01') }}{{ 'about.html'|set_title('About') }}"
+                    "{{ 'new.html'|set_date('2014-01-01') }}{{ 'new.html'|set_title('New') }}")
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.assertEqual("New", open(self.index_path).read())
+
+    def test_modified_options_are_rendered(self):
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.tamper(self.index_path, self.about_path)
+        tools.generate(self.src_path, self.dst_path, incremental=True, minify=True)
+        self.assertEqual("base Index", open(self.index_path).read())
+        self.assertEqual("about", open(self.about_path).read())
+
+        self.tamper(self.index_path)
+        tools.generate(self.src_path, self.dst_path, incremental=True, minify=True)
+        self.assertEqual("tampered", open(self.index_path).read())
+
+    def test_full_build_invalidates_manifest(self):
+        about_src_path = os.path.join(self.src_path, "about.html")
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        with open(about_src_path, "w") as f:
+            f.write("modified")
+        tools.generate(self.src_path, self.dst_path)
+        self.assertEqual("modified", open(self.about_path).read())
+
+        # The manifest of the first build no longer describes the output
+        with open(about_src_path, "w") as f:
+            f.write("about")
+        os.utime(about_src_path, (0, 0))
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.assertEqual("about", open(self.about_path).read())
+
+    def test_removed_templates_are_pruned(self):
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        os.remove(os.path.join(self.src_path, "about.html"))
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.assertTrue(os.path.exists(self.index_path))
+        self.assertFalse(os.path.exists(self.about_path))
+
+class ArtifactsTest(unittest.TestCase):
+    def setUp(self):
+        self.src_path = tempfile.mkdtemp()
+        self.dst_path = tempfile.mkdtemp()
+        with open(os.path.join(self.src_path, "index.html"), "w") as f:
+            f.write("<html><head><title>Home</title><style>p {}</style></head>"
+                    "<body><p>{% trans %}Hello World!{% endtrans %}</p></body></html>")
+        with open(os.path.join(self.src_path, "_post.html"), "w") as f:
+            f.write("<p>Post &amp; text</p><script>var x;</script>")
+        with open(os.path.join(self.src_path, "_config.html"), "w") as f:
+            f.write("{{ '_post.html'|set_blog_template }}"
+                    "{{ '_post.html'|add_blog_post('post', 'Post', '2014-01-10') }}")
+
+    def tearDown(self):
+        shutil.rmtree(self.src_path)
+        shutil.rmtree(self.dst_path)
+
+    def read(self, *names):
+        return open(os.path.join(self.dst_path, *names)).read()
+
+    def test_text_extractor(self):
+        extractor = artifacts.TextExtractor(10)
+        chunks = ["<title>A &amp; B</title><p>caf", "\xc3\xa9 &eacute;<script>x</script>",
+                  " one two three four</p>"]
+        self.assertEqual(chunks, list(extractor.tee(chunks)))
+        self.assertEqual("A & B", extractor.title)
+        self.assertEqual(u"caf\xe9 \xe9 o", extractor.text)
+        self.assertTrue(extractor.done)
+
+    def test_outputs(self):
+        tools.generate(self.src_path, self.dst_path, outputs=artifacts.OUTPUTS,
+                       base_url="http://example.com")
+        sitemap = self.read("sitemap.xml")
+        self.assertIn("<url><loc>http://example.com/</loc></url>", sitemap)
+        self.assertIn("<loc>http://example.com/post/</loc><lastmod>2014-01-10</lastmod>", sitemap)
+        feed = self.read("feed.xml")
+        self.assertIn("<title>Home</title>\n<author><name>Home</name></author>", feed)
+        self.assertIn("<entry><title>Post</title><id>http://example.com/post/</id>", feed)
+        self.assertIn("<summary>Post &amp; text</summary>", feed)
+        self.assertEqual([{"url": "http://example.com/", "title": "Home", "text": "Hello World!"},
+                          {"url": "http://example.com/post/", "title": "Post", "text": "Post & text"}],
+                         json.loads(self.read("search.json")))
+
+        # Pages that are up-to-date are read back from the destination folder
+        tools.generate(self.src_path, self.dst_path, incremental=True, outputs=["search"])
+        self.assertEqual(["/", "/post/"],
+                         sorted(page["url"] for page in json.loads(self.read("search.json"))))
+        self.assertRaises(ValueError, artifacts.Collector, ["feed"])
+
+    def test_feed_author(self):
+        with open(os.path.join(self.src_path, "_config.html"), "a") as f:
+            f.write("{{ 'index.html'|set_author('Jane & John') }}")
+        tools.generate(self.src_path, self.dst_path, outputs=["feed"], base_url="http://example.com")
+        self.assertIn("<author><name>Jane &amp; John</name></author>", self.read("feed.xml"))
+
+    def test_sorted_entries(self):
+        class Env(object):
+            def lookup(self, template_name, key):
+                return {"title": template_name, "date": "2014-01-0%s" % template_name[1]}
+        pages = ["p2.html", "p1.html", "p3.html", "q1.html"]
+        contents = []
+        for names in [pages, list(reversed(pages))]:
+            dst_path = os.path.join(self.dst_path, str(len(contents)))
+            collector = artifacts.Collector(artifacts.OUTPUTS, "http://example.com")
+            for name in names:
+                collector.add(Env(), name, name)
+            collector.write(output.Writer(dst_path), dst_path)
+            contents.append([open(os.path.join(dst_path, name)).read()
+                             for name in [artifacts.SITEMAP, artifacts.FEED, artifacts.SEARCH_INDEX]])
+        self.assertEqual(contents[0], contents[1])
+        self.assertEqual(["p1.html", "p2.html", "p3.html", "q1.html"],
+                         [page["title"] for page in json.loads(contents[0][2])])
+        # Most recent entries first, then by url
+        feed = contents[0][1]
+        self.assertTrue(feed.index("/p3.html") < feed.index("/p2.html") < feed.index("/p1.html")
+                        < feed.index("/q1.html"))
+
+    def test_multiple_locales(self):
+        for locale in ["fr", "de_DE"]:
+            with open(os.path.join(self.src_path, locale + ".po"), "w") as f:
+                f.write("")
+        tools.generate(self.src_path, self.dst_path, ["fr", "de_DE"], outputs=["sitemap"],
+                       base_url="http://example.com/")
+        self.assertIn("<loc>http://example.com/fr/sitemap.xml</loc>", self.read("sitemap.xml"))
+        sitemap = self.read("de_DE", "sitemap.xml")
+        self.assertIn("<url><loc>http://example.com/de_DE/</loc>"
+                      '<xhtml:link rel="alternate" hreflang="fr" href="http://example.com/fr/"/>'
+                      '<xhtml:link rel="alternate" hreflang="de-DE" href="http://example.com/de_DE/"/>'
+                      "</url>", sitemap)
+
+class ListingTest(unittest.TestCase):
+    def setUp(self):
+        self.src_path = tempfile.mkdtemp()
+        self.dst_path = tempfile.mkdtemp()
+        self.write("_listing.html", "{{ tag or year }}:{{ items|join(',') }}:{{ page }}/{{ page_count }}:"
+                   "{{ previous_page }}:{{ next_page }}")
+        self.config = ("{{ '_listing.html'|add_listing('archive', 2) }}"
+                       "{{ '_listing.html'|add_listing('tag', 2) }}"
+                       "{{ '_listing.html'|add_listing('year', 2, 'blog') }}")
+        self.posts = ""
+        for name, date, tags in [("a", "2012-05-01", ["x"]), ("b", "2013-01-01", ["x", "y"]),
+                                 ("c", "2013-02-01", ["y"])]:
+            self.add_post(name, date, tags)
+
+    def tearDown(self):
+        shutil.rmtree(self.src_path)
+        shutil.rmtree(self.dst_path)
+
+    def write(self, name, content):
+        with open(os.path.join(self.src_path, name), "w") as f:
+            f.write(content)
+
+    def read(self, name):
+        return open(os.path.join(self.dst_path, name, "index.html")).read()
+
+    def add_post(self, name, date, tags):
+        self.write(name + ".html", name)
+        self.posts += "{{ '%s.html'|set_date('%s') }}{{ '%s.html'|set_tags(%r) }}" % (name, date, name, tags)
+        self.write("_config.html", self.config + self.posts)
+
+    def test_listings(self):
+        tools.generate(self.src_path, self.dst_path)
+        self.assertEqual(":c.html,b.html:1/2:None:archive/page/2", self.read("archive"))
+        self.assertEqual(":a.html:2/2:archive:None", self.read("archive/page/2"))
+        self.assertEqual("x:b.html,a.html:1/1:None:None", self.read("tags/x"))
+        self.assertEqual("y:c.html,b.html:1/1:None:None", self.read("tags/y"))
+        self.assertEqual("2012:a.html:1/1:None:None", self.read("blog/2012"))
+        self.assertEqual("2013:c.html,b.html:1/1:None:None", self.read("blog/2013"))
+
+    def test_tag_slugs(self):
+        for name in ["d", "e", "f"]:
+            self.add_post(name, "2014-01-0%d" % (ord(name) - ord("a")), ["node.js"])
+        self.add_post("g", "2014-02-01", ["..", "_hidden", "node-js"])
+        tools.generate(self.src_path, self.dst_path)
+        # Tags with the same slug are listed in distinct folders
+        self.assertEqual("node-js:g.html:1/1:None:None", self.read("tags/node-js"))
+        self.assertEqual("node.js:f.html,e.html:1/2:None:tags/node-js-2/page/2", self.read("tags/node-js-2"))
+        self.assertEqual("node.js:d.html:2/2:tags/node-js-2:None", self.read("tags/node-js-2/page/2"))
+        self.assertEqual("..:g.html:1/1:None:None", self.read("tags/-"))
+        self.assertEqual("_hidden:g.html:1/1:None:None", self.read("tags/hidden"))
+        self.assertEqual(["-", "hidden", "node-js", "node-js-2", "x", "y"],
+                         sorted(os.listdir(os.path.join(self.dst_path, "tags"))))
+
+    def test_incremental_listings(self):
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        for name in ["tags/x", "tags/y", "blog/2012", "blog/2013"]:
+            with open(os.path.join(self.dst_path, name, "index.html"), "w") as f:
+                f.write("tampered")
+        self.add_post("d", "2014-01-01", ["z"])
+        tools.generate(self.src_path, self.dst_path, incremental=True)
+        self.assertEqual("z:d.html:1/1:None:None", self.read("tags/z"))
+        self.assertEqual("2014:d.html:1/1:None:None", self.read("blog/2014"))
+        for name in ["tags/x", "tags/y", "blog/2012", "blog/2013"]:
+            self.assertEqual("tampered", self.read(name))
+
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.src_path = tempfile.mkdtemp()
+        self.dst_path = tempfile.mkdtemp()
+        self.write("_base.html", "base {% block content %}{% endblock %}")
+        self.write("_config.html", "{{ 'index.html'|set_title('Index') }}")
+        self.write("index.html", "{% extends '_base.html' %}{% block content %}{{ 'index.html'|get_title }}{% endblock %}")
+        self.write("about.html", "about")
+        self.builder = watcher.Builder(self.src_path, self.dst_path)
+        self.builder.build()
+
+    def tearDown(self):
+        shutil.rmtree(self.src_path)
+        shutil.rmtree(self.dst_path)
+
+    def write(self, name, content):
+        path = os.path.join(self.src_path, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def read(self, name):
+        return open(os.path.join(self.dst_path, name)).read()
+
+    def tamper(self):
+        for name in ["index.html", "about.html"]:
+            with open(os.path.join(self.dst_path, name), "w") as f:
+                f.write("tampered")
+
+    def test_update_parent_template(self):
+        self.tamper()
+        path = self.write("_base.html", "new base {% block content %}{% endblock %}")
+        self.assertTrue(self.builder.update(set([path])))
+        self.assertEqual("new base Index", self.read("index.html"))
+        self.assertEqual("tampered", self.read("about.html"))
+
+    def test_update_config(self):
+        self.tamper()
+        path = self.write("_config.html", "{{ 'index.html'|set_title('New index') }}")
+        self.assertTrue(self.builder.update(set([path])))
+        self.assertEqual("base New index", self.read("index.html"))
+        self.assertEqual("tampered", self.read("about.html"))
+
+    def test_create_and_delete_templates(self):
+        path = self.write("new.html", "new")
+        self.assertTrue(self.builder.update(set([path])))
+        self.assertEqual("new", self.read("new.html"))
+
+        os.remove(path)
+        self.assertTrue(self.builder.update(set([path])))
+        self.assertFalse(os.path.exists(os.path.join(self.dst_path, "new.html")))
+
+    def test_update_front_matter(self):
+        path = self.write("_post.html", "{#---\ntitle: One\nalias: post.html\n---#}\n{{ title }}")
+        self.assertTrue(self.builder.update(set([path])))
+        self.assertEqual("One", self.read("post.html"))
+
+        self.write("_post.html", "{#---\ntitle: Two\nalias: post.html\n---#}\n{{ title }}")
+        self.assertTrue(self.builder.update(set([path])))
+        self.assertEqual("Two", self.read("post.html"))
+
+        os.remove(path)
+        self.assertTrue(self.builder.update(set([path])))
+        self.assertFalse(os.path.exists(os.path.join(self.dst_path, "post.html")))
+
+    def test_ignored_files(self):
+        path = self.write("notes.txt", "")
+        self.assertFalse(self.builder.update(set([path])))
+
+    def check_observer(self, observer):
+        try:
+            path = self.write("about.html", "new about")
+            self.assertIn(path, observer.read(5))
+        finally:
+            observer.close()
+
+    def test_polling_observer(self):
+        observer = watcher.PollingObserver(self.src_path, interval=0.01)
+        # Make sure that mtime changes
+        time.sleep(0.01)
+        self.check_observer(observer)
+
+    @unittest.skipUnless(watcher.InotifyObserver.is_available(), "inotify is not available")
+    def test_inotify_observer(self):
+        self.check_observer(watcher.InotifyObserver(self.src_path))
+
+    @unittest.skipUnless(watcher.InotifyObserver.is_available(), "inotify is not available")
+    def test_inotify_deleted_folders(self):
+        os.makedirs(os.path.join(self.src_path, "blog", "2013"))
+        os.mkdir(os.path.join(self.src_path, "drafts"))
+        observer = watcher.InotifyObserver(self.src_path)
+        try:
+            self.assertEqual(4, len(observer.watches))
+            shutil.rmtree(os.path.join(self.src_path, "blog"))
+            os.rename(os.path.join(self.src_path, "drafts"), os.path.join(self.src_path, "old"))
+            paths = set()
+            for i in range(10):
+                paths.update(observer.read(0.5))
+                if len(observer.watches) == 2:
+                    break
+            self.assertIn(os.path.join(self.src_path, "blog"), paths)
+            self.assertIn(os.path.join(self.src_path, "old"), paths)
+            # Moved folders are watched under their new path only
+            self.assertEqual(sorted([self.src_path, os.path.join(self.src_path, "old")]),
+                             sorted(observer.watches.values()))
+        finally:
+            observer.close()
+
+class HttpServerTest(unittest.TestCase):
+    def setUp(self):
+        self.src_path = tempfile.mkdtemp()
+        with open(os.path.join(self.src_path, "index.html"), "w") as f:
+            f.write("{{ 6 * 7 }}")
+        with open(os.path.join(self.src_path, "style.css"), "w") as f:
+            f.write("body {}")
+        self.httpd = httpserver.make_server(self.src_path, None, "127.0.0.1:0", workers=2)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+        self.connection = httplib.HTTPConnection(*self.httpd.socket.getsockname())
+
+    def tearDown(self):
+        self.connection.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        shutil.rmtree(self.src_path)
+
+    def get(self, path, headers={}):
+        self.connection.request("GET", path, headers=headers)
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test_keep_alive(self):
+        response, content = self.get("/index.html")
+        self.assertEqual(200, response.status)
+        self.assertEqual("42", content)
+        sock = self.connection.sock
+        self.assertIsNotNone(sock)
+
+        response, content = self.get("/style.css")
+        self.assertEqual(200, response.status)
+        self.assertEqual("body {}", content)
+        self.assertIs(sock, self.connection.sock)
+
+    def test_streamed_page(self):
+        with open(os.path.join(self.src_path, "big.html"), "w") as f:
+            f.write("{% for i in range(100000) %}{{ i }}\xc3\xa8\n{% endfor %}")
+        expected = "".join("%d\xc3\xa8\n" % i for i in range(100000))
+        response, content = self.get("/big.html")
+        self.assertEqual(200, response.status)
+        self.assertEqual(str(len(expected)), response.getheader("Content-Length"))
+        self.assertEqual(expected, content)
+
+    def test_compressed_responses(self):
+        with open(os.path.join(self.src_path, "big.html"), "w") as f:
+            f.write("{% for i in range(100) %}{{ i }} {% endfor %}")
+        expected = "".join("%d " % i for i in range(100))
+        response, content = self.get("/big.html", {"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual("gzip", response.getheader("Content-Encoding"))
+        self.assertEqual("Accept-Encoding", response.getheader("Vary"))
+        self.assertEqual(expected, gzip.GzipFile(fileobj=StringIO.StringIO(content)).read())
+        response, content = self.get("/big.html", {"Accept-Encoding": "gzip;q=0"})
+        self.assertEqual(None, response.getheader("Content-Encoding"))
+        self.assertEqual(expected, content)
+
+        # Up-to-date precompressed files are sent instead of static files
+        css_path = os.path.join(self.src_path, "style.css")
+        with open(css_path, "w") as f:
+            f.write("body {}" * 100)
+        self.assertEqual(1, compress.precompress(self.src_path))
+        response, content = self.get("/style.css", {"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", response.getheader("Content-Encoding"))
+        self.assertEqual("body {}" * 100, gzip.GzipFile(fileobj=StringIO.StringIO(content)).read())
+        os.utime(css_path, (0, 0))
+        response, content = self.get("/style.css", {"Accept-Encoding": "gzip"})
+        self.assertEqual(None, response.getheader("Content-Encoding"))
+
+    def test_conditional_requests(self):
+        response, content = self.get("/index.html")
+        etag = response.getheader("ETag")
+        last_modified = response.getheader("Last-Modified")
+        self.assertIsNotNone(etag)
+        self.assertIsNotNone(last_modified)
+
+        response, content = self.get("/index.html", {"If-None-Match": etag})
+        self.assertEqual(304, response.status)
+        self.assertEqual("", content)
+        response, content = self.get("/index.html", {"If-Modified-Since": last_modified})
+        self.assertEqual(304, response.status)
+
+        # Modified template
+        with open(os.path.join(self.src_path, "index.html"), "w") as f:
+            f.write("{{ 6 * 8 }}")
+        response, content = self.get("/index.html", {"If-None-Match": etag})
+        self.assertEqual(200, response.status)
+        self.assertEqual("48", content)
+
+    def test_config_modification(self):
+        with open(os.path.join(self.src_path, "index.html"), "w") as f:
+            f.write("{{ 'index.html'|get_title }}")
+        response, content = self.get("/index.html")
+        self.assertEqual("None", content)
+        last_modified = response.getheader("Last-Modified")
+        with open(os.path.join(self.src_path, "_config.html"), "w") as f:
+            f.write("{{ 'index.html'|set_title('Index') }}")
+        # Modified variables change the modification date of the page
+        response, content = self.get("/index.html", {"If-Modified-Since": last_modified})
+        self.assertEqual(200, response.status)
+        self.assertEqual("Index", content)
+        self.assertNotEqual(last_modified, response.getheader("Last-Modified"))
+
+    def test_static_files(self):
+        response, content = self.get("/style.css")
+        self.assertEqual("bytes", response.getheader("Accept-Ranges"))
+        etag = response.getheader("ETag")
+        self.assertEqual(304, self.get("/style.css", {"If-None-Match": etag})[0].status)
+
+        response, content = self.get("/style.css", {"Range": "bytes=2-4"})
+        self.assertEqual(206, response.status)
+        self.assertEqual("dy ", content)
+        self.assertEqual("bytes 2-4/7", response.getheader("Content-Range"))
+
+        response, content = self.get("/style.css", {"Range": "bytes=-2"})
+        self.assertEqual(206, response.status)
+        self.assertEqual("{}", content)
+
+        response, content = self.get("/style.css", {"Range": "bytes=10-"})
+        self.assertEqual(416, response.status)
+
+        response, content = self.get("/style.css", {"Range": "bytes=0-1", "If-Range": '"outdated"'})
+        self.assertEqual(200, response.status)
+        self.assertEqual("body {}", content)
+
+    def test_redirect(self):
+        os.mkdir(os.path.join(self.src_path, "blog"))
+        response, content = self.get("/blog")
+        self.assertEqual(301, response.status)
+        self.assertEqual("/blog/", response.getheader("Location"))
+
+    def test_created_files(self):
+        self.assertEqual(404, self.get("/new.html")[0].status)
+        os.makedirs(os.path.join(self.src_path, "blog", "2013"))
+        with open(os.path.join(self.src_path, "blog", "2013", "new.html"), "w") as f:
+            f.write("new")
+        self.assertEqual("new", self.get("/blog/2013/new.html")[1])
+        os.mkdir(os.path.join(self.src_path, "node_modules"))
+        with open(os.path.join(self.src_path, "node_modules", "excluded.html"), "w") as f:
+            f.write("excluded")
+        self.assertEqual(404, self.get("/node_modules/excluded.html")[0].status)
+
+    def test_listing_folders(self):
+        with open(os.path.join(self.src_path, "_listing.html"), "w") as f:
+            f.write("{{ items|join(',') }}")
+        with open(os.path.join(self.src_path, "_config.html"), "w") as f:
+            f.write("{{ '_listing.html'|add_listing('archive') }}"
+                    "{{ 'index.html'|set_date('2014-01-01') }}")
+        response, content = self.get("/archive")
+        self.assertEqual(301, response.status)
+        self.assertEqual("/archive/", response.getheader("Location"))
+        self.assertEqual("index.html", self.get("/archive/")[1])
+
+    def test_created_front_matter(self):
+        self.assertEqual(404, self.get("/post.html")[0].status)
+        with open(os.path.join(self.src_path, "_post.html"), "w") as f:
+            f.write("{#---\ntitle: Post\nalias: post.html\n---#}\n{{ title }}")
+        self.assertEqual("Post", self.get("/post.html")[1])
+        os.remove(os.path.join(self.src_path, "_post.html"))
+        self.assertEqual(404, self.get("/post.html")[0].status)
+
+    def test_polling_exclusions(self):
+        is_available = watcher.InotifyObserver.__dict__["is_available"]
+        watcher.InotifyObserver.is_available = staticmethod(lambda: False)
+        try:
+            httpd = httpserver.make_server(self.src_path, None, "127.0.0.1:0", workers=2,
+                                           excluded=["drafts"])
+        finally:
+            watcher.InotifyObserver.is_available = is_available
+        self.assertIsInstance(httpd.observer, watcher.ObserverThread)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        connection = httplib.HTTPConnection(*httpd.socket.getsockname())
+
+        def get(path):
+            connection.request("GET", path)
+            response = connection.getresponse()
+            return response.status, response.read()
+        try:
+            os.mkdir(os.path.join(self.src_path, "drafts"))
+            with open(os.path.join(self.src_path, "drafts", "draft.html"), "w") as f:
+                f.write("draft")
+            with open(os.path.join(self.src_path, "new.html"), "w") as f:
+                f.write("new")
+            # Modifications are detected in the background, at the polling interval
+            deadline = time.time() + 5
+            while get("/new.html")[0] == 404 and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual((200, "new"), get("/new.html"))
+            self.assertEqual(404, get("/drafts/draft.html")[0])
+            # Excluded patterns are added to the default ones
+            self.assertIn("node_modules", httpd.index.excluded)
+            self.assertIn(cache.DIRNAME, httpd.index.excluded)
+        finally:
+            connection.close()
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+class TreeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write("index.html")
+        self.write("blog/post.html")
+        self.write("static/style.css")
+        self.write("node_modules/lib/lib.html")
+        self.write(".git/HEAD")
+        self.index = tree.TreeIndex(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, content=""):
+        dirname = os.path.dirname(self.path(name))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.path(name), "w") as f:
+            f.write(content)
+        return self.path(name)
+
+    def test_exclusions(self):
+        self.assertEqual([self.path("blog/post.html"), self.path("index.html"),
+                          self.path("static/style.css")], self.index.files())
+        self.assertEqual([self.path("blog/post.html"), self.path("index.html")],
+                         self.index.files(".html"))
+        self.assertIsNone(self.index.get(self.path("node_modules/lib/lib.html")))
+
+        # Given patterns are excluded in addition to the default ones
+        index = tree.TreeIndex(self.root, ["static", "*.css", "blog"])
+        self.assertEqual([self.path("index.html")], index.files())
+
+    def test_entries(self):
+        entry = self.index.get(self.path("index.html"))
+        self.assertEqual(".html", entry.ext)
+        self.assertEqual(0, entry.size)
+        self.assertEqual(os.stat(self.path("index.html")).st_mtime, entry.mtime)
+        self.assertTrue(self.index.isfile(self.path("blog/../index.html")))
+        self.assertFalse(self.index.isfile(self.path("blog")))
+
+    def test_update(self):
+        # Modified file: the index is a snapshot until it is updated
+        path = self.write("index.html", "modified")
+        self.assertEqual(0, self.index.get(path).size)
+        self.index.update([path])
+        self.assertEqual(8, self.index.get(path).size)
+
+        # Created folder
+        self.write("blog/2013/new.html")
+        self.index.update([self.path("blog/2013")])
+        self.assertTrue(self.index.isfile(self.path("blog/2013/new.html")))
+
+        # Deleted folder
+        shutil.rmtree(self.path("blog"))
+        self.index.update([self.path("blog")])
+        self.assertEqual([self.path("index.html"), self.path("static/style.css")],
+                         self.index.files())
+
+        # Excluded files are ignored
+        self.write("node_modules/new.html")
+        self.index.update([self.path("node_modules/new.html")])
+        self.assertFalse(self.index.isfile(self.path("node_modules/new.html")))
+
+class MediaSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.src_path = tempfile.mkdtemp()
+        self.dst_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.src_path, "img"))
+        self.write(os.path.join(self.src_path, "style.css"), "body {}")
+        self.write(os.path.join(self.src_path, "img", "logo.png"), "logo")
+
+    def tearDown(self):
+        shutil.rmtree(self.src_path)
+        shutil.rmtree(self.dst_path)
+
+    def write(self, path, content):
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_sync(self):
+        self.assertEqual((2, 0), media.sync(self.src_path, self.dst_path))
+        self.assertEqual("logo", open(os.path.join(self.dst_path, "img", "logo.png")).read())
+        self.assertEqual((0, 0), media.sync(self.src_path, self.dst_path))
+
+        # Modify and delete files
+        self.write(os.path.join(self.src_path, "style.css"), "body { margin: 0; }")
+        os.remove(os.path.join(self.src_path, "img", "logo.png"))
+        self.assertEqual((1, 1), media.sync(self.src_path, self.dst_path))
+        self.assertEqual("body { margin: 0; }", open(os.path.join(self.dst_path, "style.css")).read())
+        self.assertFalse(os.path.exists(os.path.join(self.dst_path, "img", "logo.png")))
+
+    def test_sync_checksum(self):
+        media.sync(self.src_path, self.dst_path)
+        dst_file = os.path.join(self.dst_path, "style.css")
+        stat = os.stat(dst_file)
+        self.write(dst_file, "body {{")
+        os.utime(dst_file, (stat.st_atime, stat.st_mtime))
+
+        # Same size and mtime: file is considered unmodified
+        self.assertEqual((0, 0), media.sync(self.src_path, self.dst_path))
+        self.assertEqual((1, 0), media.sync(self.src_path, self.dst_path, checksum=True))
+        self.assertEqual("body {}", open(dst_file).read())
+
+    def test_sync_link(self):
+        media.sync(self.src_path, self.dst_path, link=True)
+        src_file = os.path.join(self.src_path, "style.css")
+        dst_file = os.path.join(self.dst_path, "style.css")
+        self.assertEqual(os.stat(src_file).st_ino, os.stat(dst_file).st_ino)
+
+class CompressTest(unittest.TestCase):
+    def setUp(self):
+        self.dst_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dst_path)
+
+    def test_minify_html(self):
+        html = ("<html>\n  <head>\n    <!-- comment -->\n    <!--[if IE]>ie<![endif]-->\n"
+                "<style>  p  {}  </style></head>\n<body>  <p>Some   text\n  here</p>\n"
+                "<pre>  keep\n  this </pre><script>\n  var a = '<p>  b';</script>  </body></html>")
+        expected = ("<html>\n<head>\n<!--[if IE]>ie<![endif]-->\n"
+                    "<style>  p  {}  </style></head>\n<body> <p>Some text\nhere</p>\n"
+                    "<pre>  keep\n  this </pre><script>\n  var a = '<p>  b';</script> </body></html>")
+        self.assertEqual(expected, minify.minify_html(html))
+        self.assertEqual(expected, minify.minify_html(expected))
+        # Chunks are minified as they come, whatever their boundaries
+        for i in range(len(html)):
+            self.assertEqual(expected, "".join(minify.HtmlMinifier().chunks([html[:i], html[i:]])))
+
+    def test_minify_css_js(self):
+        self.assertEqual('a :hover,b>i{color:red;content:" ; { "}/*! license */',
+                         minify.minify_css('a :hover, b > i {\n  color: red; /* comment */\n'
+                                           '  content: " ; { ";\n}\n/*! license */'))
+        self.assertEqual("var a = 1\nb()", minify.minify_js("  var a = 1\n\n   b()  \n"))
+        # Multi-line literals are kept as-is
+        self.assertEqual("var t = `a \n  b\n\n`;\nvar s = 'x\\\n  y';\n// don't\nc(\"`\")",
+                         minify.minify_js("var t = `a \n  b\n\n`;\n  var s = 'x\\\n  y';\n"
+                                          "  // don't\n  c(\"`\")  \n"))
+
+    def test_precompress(self):
+        path = os.path.join(self.dst_path, "index.html")
+        with open(path, "w") as f:
+            f.write("Hello World! " * 100)
+        with open(os.path.join(self.dst_path, "small.html"), "w") as f:
+            f.write("Hello")
+        with open(os.path.join(self.dst_path, "removed.html.gz"), "w") as f:
+            f.write("stale")
+        self.assertEqual(1, compress.precompress(self.dst_path))
+        self.assertEqual(["index.html", "index.html.gz", "small.html"], sorted(os.listdir(self.dst_path)))
+        self.assertEqual("Hello World! " * 100, gzip.open(path + ".gz").read())
+        self.assertTrue(compress.is_up_to_date(path, path + ".gz"))
+
+        # Up-to-date files are skipped
+        self.assertEqual(0, compress.precompress(self.dst_path, jobs=2))
+        os.utime(path, (0, 0))
+        self.assertEqual(1, compress.precompress(self.dst_path, jobs=2))
+
+    def test_minified_media(self):
+        src_path = os.path.join(self.dst_path, "src")
+        media_path = os.path.join(self.dst_path, "media")
+        os.mkdir(src_path)
+        with open(os.path.join(src_path, "style.css"), "w") as f:
+            f.write("body {\n  margin: 0;\n}\n" * 20)
+        with open(os.path.join(src_path, "app.min.js"), "w") as f:
+            f.write("var a=1;")
+        stamps_path = os.path.join(self.dst_path, "minified.json")
+        minified = media.MinifiedFiles(stamps_path)
+        self.assertEqual((2, 0), media.sync(src_path, media_path, minify_files=True,
+                                            minified=minified))
+        minified.save()
+        css_path = os.path.join(media_path, "style.css")
+        self.assertEqual("body{margin:0}" * 20, open(css_path).read())
+        self.assertEqual(1, compress.precompress(media_path))
+
+        # Minified files, already minified files and precompressed siblings are kept
+        minified = media.MinifiedFiles(stamps_path)
+        self.assertEqual((0, 0), media.sync(src_path, media_path, minify_files=True,
+                                            minified=minified))
+        self.assertEqual(["app.min.js", "style.css", "style.css.gz"], sorted(os.listdir(media_path)))
+        self.assertEqual(0, compress.precompress(media_path))
+
+        # Minified files that were modified are minified again
+        with open(css_path, "w") as f:
+            f.write("tampered")
+        self.assertEqual((1, 0), media.sync(src_path, media_path, minify_files=True,
+                                            minified=minified))
+        self.assertEqual("body{margin:0}" * 20, open(css_path).read())
+
+    def test_precompress_media_archives(self):
+        src_path = os.path.join(self.dst_path, "src")
+        www_path = os.path.join(self.dst_path, "www")
+        static_path = os.path.join(src_path, "static")
+        os.makedirs(static_path)
+        with open(os.path.join(src_path, "_config.html"), "w") as f:
+            f.write("{{ 'static'|add_media }}")
+        with open(os.path.join(src_path, "index.html"), "w") as f:
+            f.write("Hello World! " * 100)
+        with open(os.path.join(static_path, "app.js"), "w") as f:
+            f.write("var a = 1;\n" * 100)
+        with open(os.path.join(static_path, "app.js.gz"), "w") as f:
+            f.write("provided")
+        archive = tarfile.open(os.path.join(static_path, "archive.tar.gz"), "w:gz")
+        archive.add(os.path.join(static_path, "app.js"), "app.js")
+        archive.close()
+
+        tools.generate(src_path, www_path, precompress=True)
+        archive_path = os.path.join(www_path, "static", "archive.tar.gz")
+        st = os.stat(archive_path)
+        self.assertTrue(os.path.exists(os.path.join(www_path, "index.html.gz")))
+        self.assertEqual("provided", open(os.path.join(www_path, "static", "app.js.gz")).read())
+
+        # Media files that look precompressed are neither deleted nor replaced
+        tools.generate(src_path, www_path, precompress=True)
+        self.assertEqual(st.st_ino, os.stat(archive_path).st_ino)
+        self.assertEqual(["app.js"], tarfile.open(archive_path).getnames())
+        self.assertEqual("provided", open(os.path.join(www_path, "static", "app.js.gz")).read())
+
+class OutputWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.dst_path = os.path.join(self.root, "www")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read(self, *names):
+        return open(os.path.join(self.dst_path, *names)).read()
+
+    def test_write(self):
+        writer = output.Writer(self.dst_path)
+        path = os.path.join(self.dst_path, "a", "index.html")
+        self.assertTrue(writer.write(path, "content"))
+        self.assertEqual("content", self.read("a", "index.html"))
+        self.assertEqual(cache.file_mode(), os.stat(path).st_mode & 0777)
+
+        # Identical content is not written
+        os.utime(path, (0, 0))
+        self.assertFalse(writer.write(path, "content"))
+        self.assertEqual(0, os.stat(path).st_mtime)
+        self.assertTrue(writer.write(path, "modified"))
+        self.assertEqual((2, 1), (writer.written, writer.skipped))
+
+    def test_staging(self):
+        output.Writer(self.dst_path).write(os.path.join(self.dst_path, "a.html"), "a")
+        writer = output.Writer(self.dst_path, staging=True)
+        writer.write(os.path.join(self.dst_path, "b.html"), "b")
+        writer.write(os.path.join(self.dst_path, "a.html"), "a2")
+
+        # The destination is modified only on commit
+        self.assertEqual("a", self.read("a.html"))
+        self.assertFalse(os.path.exists(os.path.join(self.dst_path, "b.html")))
+        writer.commit()
+        self.assertEqual("a2", self.read("a.html"))
+        self.assertEqual("b", self.read("b.html"))
+        self.assertEqual(["www"], os.listdir(self.root))
+
+    def test_staging_link(self):
+        os.mkdir(os.path.join(self.root, "v1"))
+        os.symlink(os.path.join(self.root, "v1"), self.dst_path)
+        output.Writer(self.dst_path).write(os.path.join(self.dst_path, "a.html"), "a")
+        writer = output.Writer(self.dst_path, staging=True)
+        writer.write(os.path.join(self.dst_path, "b.html"), "b")
+        writer.commit()
+        self.assertTrue(os.path.islink(self.dst_path))
+        self.assertEqual(["a.html", "b.html"], sorted(os.listdir(self.dst_path)))
+        self.assertEqual(2, len(os.listdir(self.root)))
+
+    def test_generate_staging(self):
+        src_path = os.path.join(self.root, "src")
+        os.mkdir(src_path)
+        with open(os.path.join(src_path, "index.html"), "w") as f:
+            f.write("{{ 6 * 7 }}")
+        tools.generate(src_path, self.dst_path, staging=True)
+        self.assertEqual("42", self.read("index.html"))
+        os.utime(os.path.join(self.dst_path, "index.html"), (0, 0))
+        tools.generate(src_path, self.dst_path, staging=True)
+        self.assertEqual(0, os.stat(os.path.join(self.dst_path, "index.html")).st_mtime)
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.src_path = tempfile.mkdtemp()
+        self.dst_path = tempfile.mkdtemp()
+        with open(os.path.join(self.src_path, "index.html"), "w") as f:
+            f.write("{{ 'index.html'|get_title }}")
+        profiler.enable()
+
+    def tearDown(self):
+        profiler.Profiler._instance = None
+        shutil.rmtree(self.src_path)
+        shutil.rmtree(self.dst_path)
+
+    def check_stats(self):
+        stats = dict(((row[0], row[1]), row[2]) for row in profiler.get().rows())
+        self.assertEqual(1, stats[("render", "index.html")])
+        self.assertEqual(1, stats[("filter", "get_title")])
+        self.assertEqual(1, stats[("load", "index.html")])
+        self.assertEqual(1, stats[("write", "index.html")])
+
+    def test_profile(self):
+        tools.generate(self.src_path, self.dst_path)
+        self.check_stats()
+        self.assertIn("get_title", profiler.get().report())
+
+    def test_profile_parallel(self):
+        with open(os.path.join(self.src_path, "about.html"), "w") as f:
+            f.write("about")
+        tools.generate(self.src_path, self.dst_path, jobs=2)
+        self.check_stats()
+
+    def test_write(self):
+        tools.generate(self.src_path, self.dst_path)
+        json_path = os.path.join(self.dst_path, "profile.json")
+        profiler.get().write(json_path)
+        self.assertIn("get_title", open(json_path).read())
+        csv_path = os.path.join(self.dst_path, "profile.csv")
+        profiler.get().write(csv_path)
+        self.assertEqual("category,name,calls,wall,cpu", open(csv_path).readline().strip())
+
+class BenchmarkTest(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def test_run(self):
+        results = benchmark.run(self.work_path, pages=3, posts=2, media_files=1, jobs=2, requests=2)
+        for name in ["translate", "compile", "generate_cold", "generate_incremental_noop",
+                     "generate_jobs", "serve_cold", "serve_warm"]:
+            self.assertIn(name, results)
+        dst_path = os.path.join(self.work_path, "dst")
+        self.assertTrue(os.path.exists(os.path.join(dst_path, "pages", "000", "page2.html")))
+        self.assertTrue(os.path.exists(os.path.join(dst_path, "post1", "index.html")))
+        self.assertTrue(os.path.exists(os.path.join(dst_path, "static", "file0.bin")))
+
+    def test_compare(self):
+        self.assertEqual(["generate"], benchmark.compare({"generate": 2, "translate": 1},
+                                                         {"generate": 1, "translate": 1}, 0.2))
+
+class FrontMatterTest(unittest.TestCase):
+    def setUp(self):
+        self.src_path = tempfile.mkdtemp()
+        filters.BLOG_TEMPLATE = None
+
+    def tearDown(self):
+        shutil.rmtree(self.src_path)
+
+    def write(self, name, content):
+        with open(os.path.join(self.src_path, name), "w") as f:
+            f.write(content)
+
+    def test_parse(self):
+        self.assertEqual(None, frontmatter.parse(["<p>{#---</p>\n"]))
+        self.assertEqual({"title": "Title: 1", "tags": ["a", "b c"], "quoted": "x"},
+                         frontmatter.parse(["{#---\n", "title: Title: 1\n", "\n", "tags: [a, 'b c']\n",
+                                            "quoted: 'x'\n", "---#}\n", "content: 1\n"]))
+        self.assertRaises(ValueError, frontmatter.parse, ["{#---\n", "title: 1\n"])
+
+    def test_front_matter(self):
+        self.write("page.html", "{#---\ntitle: Page\ndate: 2014-01-01\n---#}\n{{ title }}")
+        self.write("_post.html", "{#---\ntitle: Post\ndate: 2013-01-01\nalias: post\n---#}\nPost")
+        self.write("_layout.html", "{% include post %}!")
+        self.write("_config.html", "{{ '_layout.html'|set_blog_template }}{{ 'page.html'|set_title('Config') }}")
+        jinjaenv.init(self.src_path)
+        env = jinjaenv.get()
+
+        # Front matter is not rendered and takes precedence over _config.html
+        self.assertEqual("Page", env.render_template("page.html"))
+        self.assertEqual("Post!", env.render_template("post"))
+        self.assertEqual(["page.html", "post"], env.query("latest", None))
+        self.assertEqual("_post.html", env.get_variable("post", "post"))
+        self.assertEqual(None, env.get_variable("_post.html", "title"))
+
+        # Modified front matter is parsed again on reinit
+        self.write("_post.html", "{#---\ntitle: Post\ndate: 2015-01-01\nalias: post\n---#}\nPost")
+        os.utime(os.path.join(self.src_path, "_post.html"), (0, 0))
+        jinjaenv.init(self.src_path)
+        self.assertEqual(["post", "page.html"], jinjaenv.get().query("latest", None))
+
+class MetadataStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = metadata.MetadataStore()
+        for name, date, tags in [("a", "2013-01", ["python"]), ("b", "2013-03", ["jinja", "python"]),
+                                 ("c", "2013-02", []), ("d", "2012-12", ["python"])]:
+            self.store.set(name, "date", date)
+            self.store.set(name, "tags", tags)
+        self.store.set("e", "title", "Undated")
+
+    def test_sorted_by(self):
+        self.assertEqual(["b", "c"], self.store.latest(2))
+        self.assertEqual(["b", "c", "a", "d"], self.store.latest(10))
+        self.assertEqual(["d", "a", "c", "b"], self.store.sorted_by("date"))
+        self.assertEqual(["c", "a"], self.store.sorted_by("date", True, 1, 2))
+        self.assertEqual(["a", "c"], self.store.range_by("date", "2013-01", "2013-03"))
+
+        # Indexes are updated
+        self.store.set("e", "date", "2014-01")
+        self.assertEqual(["e", "b"], self.store.latest(2))
+
+    def test_with_value(self):
+        self.assertEqual(["b", "a", "d"], self.store.with_value("tags", "python"))
+        self.assertEqual(["a"], self.store.with_value("tags", "python", 1, 1))
+        self.assertEqual([("jinja", 1), ("python", 3)], self.store.values("tags"))
+        self.store.set("a", "tags", ["jinja"])
+        self.assertEqual(["b", "a"], self.store.with_value("tags", "jinja"))
+        self.store.set("a", "date", "2014-01")
+        self.assertEqual(["a", "b"], self.store.with_value("tags", "jinja"))
+
+    def test_records(self):
+        self.store.set_all("alias", {"title": "Alias", "custom": None}, "_post.html")
+        record = self.store.get("alias")
+        self.assertEqual({"title": "Alias", "custom": None}, dict(record.iteritems()))
+        self.assertTrue("custom" in record)
+        self.assertFalse("date" in record)
+        self.assertEqual("_post.html", self.store.template("alias"))
+        self.assertEqual(None, self.store.template("a"))
+        self.assertEqual(["alias"], self.store.aliases())
+        self.assertFalse(hasattr(record, "__dict__"))
+
+    def test_pickle(self):
+        self.store.set_all("alias", {"title": "Alias"}, "_post.html")
+        store = pickle.loads(pickle.dumps(self.store, 2))
+        self.assertEqual(["b", "c", "a", "d"], store.latest(10))
+        self.assertEqual("_post.html", store.template("alias"))
+        self.assertEqual({"title": "Undated"}, dict(store.get("e").iteritems()))
+
+    def test_paginate(self):
+        self.assertEqual({"items": ["b", "c", "a"], "page": 1, "page_count": 2},
+                         self.store.paginate(1, 3))
+        self.assertEqual({"items": ["d"], "page": 2, "page_count": 2},
+                         self.store.paginate(2, 3))
+        self.assertEqual({"items": ["d"], "page": 2, "page_count": 2},
+                         self.store.paginate(2, 2, "date", True, "tags", "python"))
+        self.assertEqual({"items": [], "page": 1, "page_count": 1},
+                         self.store.paginate(1, 3, "date", True, "tags", "missing"))
+
 class FiltersTest(unittest.TestCase):
     def test_filters_are_registered(self):
         env = jinjaenv.get()._jinja_env
         self.assertIn("set_date", env.filters.keys())
         self.assertIn("get_date", env.filters.keys())
-        self.assertEqual(filters.set_date, env.filters["set_date"])
-        self.assertEqual(filters.get_date, env.filters["get_date"])
+        self.assertEqual(filters.set_date, env.filters["set_date"].__wrapped__)
+        self.assertEqual(filters.get_date, env.filters["get_date"].__wrapped__)
 
     def test_set_date(self):
         string = "{{ 'Title'|set_date('2013-11') }}"
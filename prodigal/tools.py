@@ -1,27 +1,48 @@
 #! /usr/bin/env python
 import os.path
+import time
 import logging
 import sys
-import shutil
+import multiprocessing
 
 import translate
 import jinjaenv
+import artifacts
+import compress
 import templates
 import httpserver
 import media
+import manifest
+import output
+import profiler
+import watcher
 
-def translate_templates(locale, src_path):
+def translate_templates(locale, src_path, excluded=None, jobs=None):
     """translate_templates
-    Save locale strings to a locale.po translation file.
+    Save locale strings to a locale.po translation file. Messages are
+    extracted only from the templates that were modified since the previous
+    run; messages that no longer appear in any template are marked obsolete.
+    When a list of locales is given, messages are extracted once and merged
+    into each catalog. Only the catalogs whose content changes are written.
+    Return the list of locales whose catalog was written.
 
-    :param locale:
+    :param locale: locale code, or list of locale codes.
     :param src_path:
+    :param excluded: glob patterns of files and folders that are ignored.
+    :param jobs: number of processes that extract messages; defaults to the
+    number of CPUs.
     """
-    po_path = os.path.join(src_path, locale + ".po")
-    translator = translate.Translator(po_path)
-    for path in templates.list_translatable_files(src_path):
-        translator.add_file(path)
-    translator.write_po(po_path)
+    locales = locale if isinstance(locale, (list, tuple)) else [locale]
+    paths = list(templates.list_translatable_files(src_path, excluded))
+    template = translate.extract_catalog(src_path, paths, jobs)
+    updated = []
+    for locale in locales:
+        po_path = os.path.join(src_path, locale + ".po")
+        translator = translate.Translator(po_path)
+        translator.update(template)
+        if translator.write_po(po_path):
+            updated.append(locale)
+    return updated
 
 def compile_locale(src_path, locale):
     po_file_path = os.path.join(src_path, locale + ".po")
@@ -31,60 +52,328 @@ def compile_locale(src_path, locale):
                     '%s translate %s %s' first." % \
                     (po_file_path, sys.argv[0], locale, src_path))
             return
-    translate.compile(po_file_path)
+    translate.Updater(src_path, locale).run()
+
+def all_locales(src_path):
+    """all_locales
+    Return the sorted list of locales for which a .po file exists in the
+    source directory.
+
+    :param src_path:
+    """
+    locales = []
+    for filename in os.listdir(src_path):
+        locale, ext = os.path.splitext(filename)
+        if ext == ".po":
+            locales.append(locale)
+    return sorted(locales)
 
-def generate(src_path, dst_path, locale=None):
+def generate(src_path, dst_path, locale=None, incremental=False, jobs=1,
+             media_checksum=False, link_media=False, excluded=None, staging=False, outputs=(),
+             base_url=None, minify=False, precompress=False):
     """generate
-    Compile appropriate locale (if necessary) and then render all templates
-    into the destination path.
+    Compile appropriate locales (if necessary) and then render all templates
+    into the destination path. When a list of locales is given, each locale
+    is generated in its own dst_path/<locale> folder; template files are
+    listed and compiled only once for all locales, and media files are copied
+    once to dst_path.
 
     :param src_path:
     :param dst_path:
-    :param locale:
+    :param locale: locale code, or list of locale codes.
+    :param incremental: if True, skip templates whose inputs did not change
+    since the previous build.
+    :param jobs: number of processes that render templates in parallel.
+    :param media_checksum: compare media files by content instead of mtime.
+    :param link_media: hardlink media files instead of copying them.
+    :param excluded: glob patterns of files and folders that are ignored, in
+    addition to tree.EXCLUDED.
+    :param staging: if True, generate the website in a staging folder that
+    replaces dst_path once the build succeeded.
+    :param outputs: names of the artifacts.OUTPUTS generated in each locale
+    folder (sitemap, feed and search index). With multiple locales, the
+    sitemap lists the alternates of each page in the other locales and a
+    sitemap index is generated in dst_path.
+    :param base_url: url of the root of the website, required by the sitemap
+    and the feed.
+    :param minify: minify html pages, and css and js media files.
+    :param precompress: write .gz (and .br) siblings of the generated files,
+    in `jobs` processes.
     """
     src_path = os.path.abspath(src_path)
     dst_path = os.path.abspath(dst_path)
-    if locale is not None:
-        compile_locale(src_path, locale)
-    generate_templates(src_path, dst_path, locale)
+    multiple_locales = isinstance(locale, (list, tuple))
+    locales = locale if multiple_locales else [locale]
+    template_cache = jinjaenv.TemplateCache(excluded)
+    writer = output.Writer(dst_path, staging, minify)
+    for locale in locales:
+        locale_dst_path = dst_path
+        if locale is not None:
+            compile_locale(src_path, locale)
+            if multiple_locales:
+                locale_dst_path = os.path.join(dst_path, locale)
+        collector = None
+        if outputs:
+            collector = artifacts.Collector(outputs, base_url, locale,
+                                            locales if multiple_locales else None)
+        generate_templates(src_path, locale_dst_path, locale, incremental, jobs, template_cache,
+                           writer, collector)
+    if multiple_locales and "sitemap" in outputs:
+        writer.write(os.path.join(dst_path, artifacts.SITEMAP),
+                     artifacts.sitemap_index(base_url, locales))
+    copy_media(src_path, writer.path, media_checksum, link_media, minify)
+    if precompress:
+        compress.precompress(writer.path, jobs, _media_siblings(src_path, writer.path))
+    writer.commit()
 
-def generate_templates(src_path, dst_path, locale):
-    jinjaenv.init(src_path, locale)
+def destination_path(env, dst_path, url):
+    """destination_path
+    Return the path of the file in which the given url should be saved.
+
+    :param env:
+    :param dst_path:
+    :param url:
+    """
+    template_name = env.template_name(url)
+    if os.path.splitext(template_name)[1] == '':
+        template_name = os.path.join(template_name, "index.html")
+    return os.path.join(dst_path, template_name)
+
+def _init_render_worker(src_path, locale, profile, excluded, pages):
+    if profile:
+        profiler.enable()
+    jinjaenv.init(src_path, locale, jinjaenv.TemplateCache(excluded), pages=pages)
+
+def _render_url(url):
     env = jinjaenv.get()
-    for url in env.renderable_urls():
-        # Render
-        rendered = env.render_path(url)
+    with profiler.measure("render", env.template_name(url)):
+        with env.recording() as dependencies:
+            rendered = env.render_path(url)
+    return url, rendered, dependencies
+
+def _render_url_in_worker(url):
+    result = _render_url(url)
+    # Profiling statistics are sent back to the parent process
+    stats = profiler.get().pop_stats() if profiler.is_enabled() else None
+    return result + (stats,)
+
+def render_urls(src_path, locale, urls, jobs=1, excluded=None, pages=None):
+    """render_urls
+    Render the given urls and yield (url, rendered, dependencies) tuples in
+    arbitrary order. When jobs > 1, templates are rendered by a pool of
+    processes that each create their own environment; in that case, results
+    are pickled back to the calling process. Processes that receive the pages
+    of the website do not need to load _config.html again.
+
+    :param src_path:
+    :param locale:
+    :param urls: list of urls to render.
+    :param jobs: number of rendering processes.
+    :param excluded: glob patterns of files and folders that are ignored.
+    :param pages: metadata.MetadataStore of the current environment.
+    """
+    if jobs <= 1 or len(urls) <= 1:
+        for url in urls:
+            yield _render_url(url)
+        return
+
+    pool = multiprocessing.Pool(jobs, _init_render_worker,
+                                (src_path, locale, profiler.is_enabled(), excluded, pages))
+    try:
+        chunksize = max(1, len(urls) / (jobs * 8))
+        for result in pool.imap_unordered(_render_url_in_worker, urls, chunksize):
+            if result[3] is not None:
+                profiler.get().merge(result[3])
+            yield result[:3]
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def generate_templates(src_path, dst_path, locale, incremental=False, jobs=1,
+                       template_cache=None, writer=None, collector=None):
+    if writer is None:
+        writer = output.Writer(dst_path)
+    jinjaenv.init(src_path, locale, template_cache)
+    build_manifest = None
+    if incremental:
+        build_manifest = manifest.Manifest.for_build(src_path, dst_path, locale, writer.options)
+    else:
+        manifest.Manifest.discard(src_path, dst_path, locale)
+    render_templates(jinjaenv.get(), dst_path, build_manifest, jobs, writer=writer,
+                     collector=collector)
+    if build_manifest is not None:
+        build_manifest.save()
+    if collector is not None:
+        collector.write(writer, dst_path)
+
+def render_templates(env, dst_path, build_manifest=None, jobs=1, urls=None, writer=None,
+                     collector=None):
+    """render_templates
+    Render templates from an initialized environment into the destination
+    path. If urls is None, all renderable urls are rendered, except those
+    that are up-to-date according to the build manifest, and generated files
+    that no longer have a template are removed. Otherwise, only the given urls
+    are rendered.
+
+    :param env: jinjaenv.Environment
+    :param dst_path:
+    :param build_manifest: manifest.Manifest
+    :param jobs: number of processes that render templates in parallel.
+    :param urls: list of urls to render.
+    :param writer: output.Writer of dst_path; files are written in place by
+    default.
+    :param collector: artifacts.Collector of the rendered pages; pages that
+    are up-to-date are read back from dst_path.
+    """
+    if writer is None:
+        writer = output.Writer(dst_path)
+    if urls is None:
+        dst_file_paths = set()
+        urls = []
+        for url in env.renderable_urls():
+            dst_file_path = destination_path(env, dst_path, url)
+            dst_file_paths.add(dst_file_path)
+            if build_manifest is not None and build_manifest.is_fresh(dst_file_path, env):
+                if collector is not None:
+                    collector.add_file(env, env.template_name(url),
+                                       os.path.relpath(dst_file_path, dst_path),
+                                       writer.target(dst_file_path))
+                continue
+            urls.append(url)
+        if build_manifest is not None:
+            build_manifest.prune(dst_file_paths, writer)
+
+    if jobs <= 1 or len(urls) <= 1:
+        for url in urls:
+            dst_file_path = destination_path(env, dst_path, url)
+            extractor = None if collector is None else collector.extractor()
+            dependencies = _stream_url(env, url, dst_path, dst_file_path, writer, extractor)
+            _record_url(env, url, dst_path, dst_file_path, dependencies, build_manifest, writer,
+                        collector, extractor)
+        return
+
+    excluded = env.index.excluded if env.index is not None else None
+    for url, rendered, dependencies in render_urls(env.src_path, env.locale, urls, jobs, excluded,
+                                                   env.pages):
+        dst_file_path = destination_path(env, dst_path, url)
+        extractor = None
         if rendered is None:
-            print "Warning: Could not find template for url", url
-            continue
-
-        # Save
-        template_name = env.template_name(url)
-        if os.path.splitext(template_name)[1] == '':
-            template_name = os.path.join(template_name, "index.html")
-        dst_file_path = os.path.join(dst_path, template_name)
-        dst_dirname = os.path.dirname(dst_file_path)
-        if not os.path.exists(dst_dirname):
-            os.makedirs(dst_dirname)
-        with open(dst_file_path, "w") as f:
-            f.write(rendered)
-
-    # Copy media files
+            dependencies = None
+        else:
+            with profiler.measure("write", os.path.relpath(dst_file_path, dst_path)):
+                writer.write(dst_file_path, rendered)
+            if collector is not None:
+                extractor = collector.extractor()
+                if extractor is not None:
+                    extractor.feed(rendered)
+        _record_url(env, url, dst_path, dst_file_path, dependencies, build_manifest, writer,
+                    collector, extractor)
+
+def _stream_url(env, url, dst_path, dst_file_path, writer, extractor=None):
+    """_stream_url
+    Render a url and write it chunk by chunk as it is rendered, such that the
+    page is never held in memory. Return the dependencies of the page, or
+    None if the url has no template.
+
+    :param env:
+    :param url:
+    :param dst_path:
+    :param dst_file_path:
+    :param writer: output.Writer
+    :param extractor: artifacts.TextExtractor that parses the chunks as they
+    are written.
+    """
+    start = time.time(), time.clock()
+    with env.recording() as dependencies:
+        chunks = env.stream_path(url)
+        if chunks is None:
+            return None
+        chunks = profiler.TimedIterator(chunks)
+        write_start = time.time(), time.clock()
+        writer.write(dst_file_path, chunks if extractor is None else extractor.tee(chunks))
+    if profiler.is_enabled():
+        # Templates are rendered while chunks are written: the time spent
+        # producing chunks is accounted to rendering
+        end = time.time(), time.clock()
+        write = (end[0] - write_start[0] - chunks.wall, end[1] - write_start[1] - chunks.cpu)
+        profiler.get().add("render", env.template_name(url), 1,
+                           end[0] - start[0] - write[0], end[1] - start[1] - write[1])
+        profiler.get().add("write", os.path.relpath(dst_file_path, dst_path), 1, write[0], write[1])
+    return dependencies
+
+def _record_url(env, url, dst_path, dst_file_path, dependencies, build_manifest, writer,
+                collector=None, extractor=None):
+    if dependencies is None:
+        print "Warning: Could not find template for url", url
+        if build_manifest is not None:
+            build_manifest.prune_file(dst_file_path, writer)
+        return
+    if build_manifest is not None:
+        build_manifest.record(dst_file_path, url, env, dependencies)
+    if collector is not None:
+        collector.add(env, env.template_name(url), os.path.relpath(dst_file_path, dst_path),
+                      extractor)
+
+def _media_siblings(src_path, dst_path):
+    """_media_siblings
+    Yield the destination paths of the media files that look like
+    precompressed siblings, e.g: a style.css.gz file of a media folder.
+
+    :param src_path:
+    :param dst_path:
+    """
+    for folder in media.folders():
+        src_folder = os.path.join(src_path, folder)
+        for dirpath, dirnames, filenames in os.walk(src_folder, followlinks=True):
+            for filename in filenames:
+                if compress.is_sibling(filename):
+                    yield os.path.normpath(os.path.join(
+                        dst_path, folder, os.path.relpath(dirpath, src_folder), filename))
+
+def copy_media(src_path, dst_path, checksum=False, link=False, minify=False):
+    """copy_media
+    Synchronize the media folders declared in _config.html with the
+    destination path.
+
+    :param src_path:
+    :param dst_path:
+    :param checksum: compare media files by content instead of mtime.
+    :param link: hardlink media files instead of copying them.
+    :param minify: minify css and js files.
+    """
+    minified = media.MinifiedFiles.for_source(src_path) if minify else None
     for folder in media.folders():
         src_folder = os.path.join(src_path, folder)
         dst_folder = os.path.join(dst_path, folder)
-        if os.path.exists(dst_folder):
-            # TODO synchronize files intelligently
-            shutil.rmtree(dst_folder)
-        shutil.copytree(src_folder, dst_folder)
+        media.sync(src_folder, dst_folder, checksum, link, minify, minified)
+    if minified is not None:
+        minified.save()
+
+def watch(src_path, dst_path, locale=None, polling=False, excluded=None):
+    """watch
+    Generate the website, then watch the source folder and regenerate the
+    files affected by each modification.
+
+    :param src_path:
+    :param dst_path:
+    :param locale:
+    :param polling: if True, detect modifications by polling the source
+    folder instead of using inotify.
+    :param excluded: glob patterns of files and folders that are ignored.
+    """
+    return watcher.watch(src_path, dst_path, locale, polling, excluded=excluded)
 
-def serve(src_path, locale, address):
+def serve(src_path, locale, address, workers=16, cache_size=256, excluded=None):
     """serve
     Run a simple HTTP server that renders templates dynamically.
 
     :param src_path:
     :param locale:
     :param address:
+    :param workers: number of threads that handle requests.
+    :param cache_size: maximum number of rendered templates kept in memory.
+    :param excluded: glob patterns of files and folders that are ignored.
     """
 
-    return httpserver.serve(src_path, locale, address)
+    return httpserver.serve(src_path, locale, address, workers, cache_size, excluded)
@@ -1,20 +1,74 @@
 import os.path
+import re
+import json
+import mmap
+import types
+import struct
+import filecmp
+import gettext
+import hashlib
+import threading
+import collections
+import multiprocessing
+import babel
+import babel.messages.catalog
 from babel.messages.catalog import Catalog
 from babel.messages.pofile import write_po, read_po
 from babel.messages.mofile import write_mo
 from jinja2.ext import babel_extract
 from StringIO import StringIO
 
+import cache
+
+class _OrderedDictAttribute(object):
+    """_OrderedDictAttribute
+    Attribute whose assigned values are stored as standard ordered dicts.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return instance.__dict__[self.name]
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = collections.OrderedDict(value)
+
+# Babel 1.x stores catalog messages in an ordered dict that checks for
+# existing keys in a list, such that building a catalog of n messages takes
+# O(n^2) time. The catalogs built here use the standard ordered dict, which
+# provides the same interface, and read_po is copied such that it builds them.
+if getattr(babel.messages.catalog, "odict", None) is not None:
+    class _Catalog(Catalog):
+        _messages = _OrderedDictAttribute("_messages")
+        obsolete = _OrderedDictAttribute("obsolete")
+
+    _read_po = types.FunctionType(read_po.func_code,
+                                  dict(read_po.func_globals, Catalog=_Catalog),
+                                  read_po.func_name, read_po.func_defaults)
+else:
+    _Catalog = Catalog
+    _read_po = read_po
+
+KEYWORDS = ('gettext', 'ngettext', '_')
+
+def _message_key(msgid):
+    # Plural messages are identified by their singular form
+    if isinstance(msgid, (list, tuple)):
+        return msgid[0]
+    return msgid
+
 class Translator(object):
     def __init__(self, path=None):
         if path is not None and os.path.exists(path):
             # Load existing translations
             locale = os.path.splitext(os.path.basename(path))[0]
             with open(path) as f:
-                self.catalog = read_po(f, locale)
+                self.catalog = _read_po(f, locale)
         else:
             # Create new catalog
-            self.catalog = Catalog(project="The Awesome Project",
+            self.catalog = _Catalog(project="The Awesome Project",
                     version="v42",
                     msgid_bugs_address=None,
                     copyright_holder=None,
@@ -30,7 +84,7 @@ class Translator(object):
 
     def _add(self, reader, filepath=None):
         # Parse messages to translate
-        extracted = list(babel_extract(reader, ('gettext', 'ngettext', '_'), [], {}))
+        extracted = list(babel_extract(reader, KEYWORDS, [], {}))
         # Add messages to translate to catalog
         self.add_messages(extracted, filepath=filepath)
 
@@ -41,23 +95,178 @@ class Translator(object):
         with open(filepath) as f:
             self._add(f, filepath=filepath)
 
+    def update(self, template):
+        """update
+        Update the catalog with the messages of a template catalog. Messages
+        that are no longer in the template are marked obsolete; obsolete
+        messages that are back in the template recover their translation.
+
+        :param template: babel.messages.catalog.Catalog
+        """
+        obsolete = dict((_message_key(msgid), msgid) for msgid in self.catalog.obsolete)
+        for message in template:
+            msgid = obsolete.get(_message_key(message.id))
+            if msgid is not None:
+                message = self.catalog.obsolete.pop(msgid)
+                self.catalog[message.id] = message
+        self.catalog.update(template, no_fuzzy_matching=True)
+
     def get_po(self):
         stringio = StringIO()
         write_po(stringio, self.catalog, width=76, no_location=False, omit_header=True,
-                 sort_output=True, sort_by_file=True, ignore_obsolete=True,
+                 sort_output=True, sort_by_file=True, ignore_obsolete=False,
                  include_previous=False)
         po_content = stringio.getvalue()
         stringio.close()
         return po_content
 
     def write_po(self, path):
+        """write_po
+        Save the catalog to a .po file, unless the file already has the same
+        content. Return True if the file was written.
+
+        :param path:
+        """
+        po_content = self.get_po()
+        if os.path.exists(path):
+            with open(path) as f:
+                if f.read() == po_content:
+                    return False
         with open(path, "w") as f:
-            f.write(self.get_po())
+            f.write(po_content)
+        return True
+
+def extract_file(path):
+    """extract_file
+    Return the list of (lineno, funcname, message, comments) messages to
+    translate in a template file.
+
+    :param path:
+    """
+    with open(path) as f:
+        return list(babel_extract(f, KEYWORDS, [], {}))
+
+def _extract_files(paths, jobs=None):
+    """_extract_files
+    Extract messages from template files, in a pool of processes if there
+    are many files. Return the lists of messages in the same order as paths.
+
+    :param paths:
+    :param jobs: number of processes; defaults to the number of CPUs.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs <= 1 or len(paths) < MessageCache.POOL_MIN_FILES:
+        return [extract_file(path) for path in paths]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        chunksize = max(1, len(paths) / (jobs * 8))
+        extracted = pool.map(extract_file, paths, chunksize)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return extracted
+
+class MessageCache(object):
+    """MessageCache
+    Persistent record of the messages extracted from each template file.
+    Entries are keyed by content hash, such that only new and modified
+    templates are parsed again; hashes are computed only for files whose
+    mtime or size changed.
+    """
+    VERSION = 1
+    # Below this number of files to extract, a pool of processes is slower
+    POOL_MIN_FILES = 50
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    content = json.load(f)
+            except ValueError:
+                content = {}
+            if content.get("version") == self.VERSION:
+                self.files = content["files"]
+
+    @classmethod
+    def for_source(cls, src_path):
+        return cls(cache.path(src_path, "messages.json"))
+
+    def _cached_messages(self, name, path):
+        entry = self.files.get(name)
+        if entry is None:
+            return None
+        st = os.stat(path)
+        if [st.st_mtime, st.st_size] != entry["stat"]:
+            if cache.file_hash(path) != entry["sha1"]:
+                return None
+            entry["stat"] = [st.st_mtime, st.st_size]
+        # json returns lists instead of the tuples of plural messages
+        return [(lineno, funcname, tuple(message) if isinstance(message, list) else message,
+                 comments) for lineno, funcname, message, comments in entry["messages"]]
+
+    def extract(self, src_path, paths, jobs=None):
+        """extract
+        Return the (path, messages) pairs of the given template files, sorted
+        by path. Messages are extracted only from files that are not in the
+        cache. Entries of files that are not listed are removed from the cache.
+
+        :param src_path:
+        :param paths: template files located in src_path.
+        :param jobs: number of extraction processes.
+        """
+        files = {}
+        extracted = {}
+        modified = []
+        for path in paths:
+            name = os.path.relpath(path, src_path)
+            messages = self._cached_messages(name, path)
+            if messages is None:
+                modified.append(path)
+            else:
+                files[name] = self.files[name]
+                extracted[path] = messages
+        for path, messages in zip(modified, _extract_files(modified, jobs)):
+            st = os.stat(path)
+            files[os.path.relpath(path, src_path)] = {
+                "stat": [st.st_mtime, st.st_size],
+                "sha1": cache.file_hash(path),
+                "messages": messages,
+            }
+            extracted[path] = messages
+        self.files = files
+        return sorted(extracted.iteritems())
+
+    def save(self):
+        with cache.atomic_file(self.path) as f:
+            json.dump({"version": self.VERSION, "files": self.files}, f)
+
+def extract_catalog(src_path, paths, jobs=None):
+    """extract_catalog
+    Return a template catalog of the messages to translate in the given
+    template files. Extracted messages are cached in the source folder.
+
+    :param src_path:
+    :param paths: template files located in src_path.
+    :param jobs: number of extraction processes; defaults to the number of CPUs.
+    """
+    message_cache = MessageCache.for_source(src_path)
+    extracted = message_cache.extract(src_path, paths, jobs)
+    message_cache.save()
+    template = Translator()
+    for path, messages in extracted:
+        template.add_messages(messages, filepath=path)
+    return template.catalog
 
 class Updater(object):
     def __init__(self, src_path, locale):
         self.src_path = src_path
         self.locale = locale
+        self._lock = threading.Lock()
+        self._po_stat = None
 
     @property
     def po_path(self):
@@ -65,28 +274,61 @@ class Updater(object):
     @property
     def mo_path(self):
         return os.path.join(self.src_path, self.locale + ".mo")
-    def po_mtime(self):
-        return os.stat(self.po_path).st_mtime
-    def mo_mtime(self):
-        return os.stat(self.mo_path).st_mtime
 
     def run(self):
         """run
-        Compile the .po translation file if it was modified more recently than
-        the .mo file.
+        Compile the .po translation file if it was modified since the previous
+        run, or if the .mo file does not exist. Return True if the .mo file was
+        modified. This method can be called concurrently from multiple threads.
         """
-        if not os.path.exists(self.po_path):
-            return False
-        if os.path.exists(self.mo_path) and self.po_mtime() <= self.mo_mtime():
-            return False
+        with self._lock:
+            try:
+                st = os.stat(self.po_path)
+            except OSError:
+                return False
+            po_stat = (st.st_mtime, st.st_size)
+            if po_stat == self._po_stat and os.path.exists(self.mo_path):
+                return False
+            self._po_stat = po_stat
+            return compile(self.po_path)
 
-        # Compile locale file
-        compile(self.po_path)
-        return True
+def catalog_hash(po_file_path, locale):
+    """catalog_hash
+    Return a hash of the content of a .po file, of the locale it is compiled
+    for and of the version of the compiler.
+
+    :param po_file_path:
+    :param locale:
+    """
+    h = hashlib.sha1("%s\0%s\0" % (babel.__version__, locale))
+    h.update(cache.file_hash(po_file_path))
+    return h.hexdigest()
+
+def _prune_translations(cache_dir, locale, cached_name):
+    """_prune_translations
+    Delete the compiled catalogs of a locale that are not the current one,
+    along with catalogs cached without their locale in their name.
+
+    :param cache_dir:
+    :param locale:
+    :param cached_name: name of the current compiled catalog.
+    """
+    pattern = re.compile(r"^(%s-)?[0-9a-f]{40}\.mo$" % re.escape(locale))
+    for name in os.listdir(cache_dir):
+        if name != cached_name and pattern.match(name):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                # Catalog may have been deleted concurrently
+                pass
 
 def compile(po_file_path):
     """compile
-    Compile a xx.po file into an xx.mo file.
+    Compile a xx.po file into an xx.mo file. Compiled catalogs are cached by
+    content hash, such that a .po file is parsed only if its content was never
+    compiled before; only the current catalog of each locale is kept. The .mo
+    file is replaced atomically, and only if its content changes. Return True
+    if the .mo file was written.
 
     :param po_file_path:
     """
@@ -95,16 +337,141 @@ def compile(po_file_path):
     locale   = os.path.splitext(filename)[0]
     mo_file_path = os.path.join(dirname, locale + ".mo")
 
-    # Read catalog
-    with open(po_file_path) as f:
-        catalog = read_po(f, locale)
+    cached_name = "%s-%s.mo" % (locale, catalog_hash(po_file_path, locale))
+    cached_path = cache.path(dirname, "translations", cached_name)
+    if not os.path.exists(cached_path):
+        # Read catalog
+        with open(po_file_path) as f:
+            catalog = _read_po(f, locale)
+        with cache.atomic_file(cached_path) as f:
+            write_mo(f, catalog)
+        _prune_translations(os.path.dirname(cached_path), locale, cached_name)
 
     # Write .mo file
-    with open(mo_file_path, "w") as f:
-        write_mo(f, catalog)
+    if os.path.exists(mo_file_path) and filecmp.cmp(cached_path, mo_file_path, shallow=False):
+        return False
+    with open(cached_path, "rb") as src:
+        with cache.atomic_file(mo_file_path) as f:
+            f.write(src.read())
+    return True
 
 def compile_if_possible(src_path, locale):
     if locale is not None:
         po_path = os.path.join(src_path, locale + ".po")
         if os.path.exists(po_path):
             compile(po_path)
+
+class MoTranslations(gettext.NullTranslations):
+    """MoTranslations
+    Translations that are looked up in a memory-mapped .mo file instead of
+    being loaded in a dict. Processes that load the same file share the same
+    memory pages. Original strings are sorted in .mo files written by Babel,
+    such that they are found by binary search; otherwise, an index of the
+    original strings is built.
+    """
+    LE_MAGIC = 0x950412de
+    BE_MAGIC = 0xde120495
+
+    def __init__(self, path):
+        gettext.NullTranslations.__init__(self)
+        with open(path, "rb") as f:
+            self._mo = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = struct.unpack_from("<I", self._mo)[0]
+        if magic == self.LE_MAGIC:
+            byte_order = "<"
+        elif magic == self.BE_MAGIC:
+            byte_order = ">"
+        else:
+            raise IOError(0, "Bad magic number", path)
+        self._entry = struct.Struct(byte_order + "2I")
+        self._count, self._ids_offset, self._strs_offset = struct.unpack_from(
+            byte_order + "3I", self._mo, 8)
+        self._index = None
+        if not self._is_sorted():
+            self._index = dict((self._singular(i), i) for i in xrange(self._count))
+
+        self._charset = "utf-8"
+        self.plural = lambda n: int(n != 1)
+        index = self._find("")
+        if index >= 0:
+            self._parse_header(self._string(self._strs_offset, index))
+
+    def _parse_header(self, header):
+        for line in header.splitlines():
+            key, _, value = line.partition(":")
+            key = key.strip().lower()
+            if key == "content-type" and "charset=" in value:
+                self._charset = value.split("charset=")[1].strip()
+            elif key == "plural-forms" and "plural=" in value:
+                self.plural = gettext.c2py(value.split("plural=")[1].strip().rstrip(";"))
+
+    def _string(self, table_offset, index):
+        length, offset = self._entry.unpack_from(self._mo, table_offset + 8 * index)
+        return self._mo[offset:offset + length]
+
+    def _singular(self, index):
+        # Plural entries are stored as "singular\0plural"
+        return self._string(self._ids_offset, index).split("\0", 1)[0]
+
+    def _is_sorted(self):
+        previous = None
+        for index in xrange(self._count):
+            singular = self._singular(index)
+            if previous is not None and singular <= previous:
+                return False
+            previous = singular
+        return True
+
+    def _find(self, singular):
+        """_find
+        Return the index of the entry of a message, or -1.
+
+        :param singular: encoded singular form of the message.
+        """
+        if self._index is not None:
+            return self._index.get(singular, -1)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) / 2
+            if self._singular(middle) < singular:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._singular(low) == singular:
+            return low
+        return -1
+
+    def _translations(self, message):
+        """_translations
+        Return the (is_plural, translated strings) of a message, or None.
+
+        :param message:
+        """
+        if isinstance(message, unicode):
+            message = message.encode(self._charset)
+        index = self._find(message)
+        if index < 0:
+            return None
+        is_plural = "\0" in self._string(self._ids_offset, index)
+        strings = self._string(self._strs_offset, index).split("\0")
+        return is_plural, [string.decode(self._charset) for string in strings]
+
+    def ugettext(self, message):
+        translations = self._translations(message)
+        if translations is None or translations[0]:
+            return unicode(message)
+        return translations[1][0]
+
+    def ungettext(self, singular, plural, n):
+        translations = self._translations(singular)
+        if translations is not None and translations[0]:
+            index = self.plural(n)
+            if index < len(translations[1]):
+                return translations[1][index]
+        return unicode(singular if n == 1 else plural)
+
+    def gettext(self, message):
+        return self.ugettext(message).encode(self._charset)
+
+    def ngettext(self, singular, plural, n):
+        return self.ungettext(singular, plural, n).encode(self._charset)
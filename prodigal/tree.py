@@ -0,0 +1,185 @@
+import os
+import fnmatch
+import collections
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+import cache
+
+# Folders and files that are never indexed
+EXCLUDED = [".git", ".hg", ".svn", "node_modules", cache.DIRNAME]
+
+Entry = collections.namedtuple("Entry", ["path", "ext", "mtime", "size"])
+
+def excluded_patterns(excluded=None):
+    """excluded_patterns
+    Return the EXCLUDED patterns, followed by the given patterns. The cache
+    folder is always excluded, such that cache writes are never seen as
+    source modifications.
+
+    :param excluded: additional glob patterns, or None.
+    """
+    patterns = list(EXCLUDED)
+    for pattern in excluded or ():
+        if pattern not in patterns:
+            patterns.append(pattern)
+    return patterns
+
+def is_excluded(name, patterns):
+    """is_excluded
+    Return True if a file or folder name matches any of the glob patterns.
+
+    :param name: base name of the file or folder.
+    :param patterns:
+    """
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+def _list_dir(dirpath):
+    """_list_dir
+    Yield the (path, is_dir) pairs of the content of a folder. Symbolic links
+    to folders are not followed, as in os.walk.
+
+    :param dirpath:
+    """
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            yield entry.path, entry.is_dir() and not entry.is_symlink()
+    else:
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            yield path, os.path.isdir(path) and not os.path.islink(path)
+
+def stat(path):
+    """stat
+    Return the Entry of a file, or None if the file does not exist.
+
+    :param path:
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return Entry(path, os.path.splitext(path)[1], st.st_mtime, st.st_size)
+
+class TreeIndex(object):
+    """TreeIndex
+    Index of the path, extension, mtime and size of all the files of a source
+    folder, collected in a single pass. Files and folders that match the
+    exclusion patterns are skipped, and excluded folders are not descended.
+    The index is a snapshot: it must be updated with the paths that were
+    modified afterwards. Updates replace the entries atomically, such that
+    the index can be read while it is updated from another thread.
+    """
+    def __init__(self, root, excluded=None):
+        self.root = os.path.abspath(root)
+        self.excluded = excluded_patterns(excluded)
+        self._entries = {}
+        self.scan()
+
+    def scan(self):
+        entries = {}
+        self._scan(self.root, entries)
+        self._entries = entries
+
+    def _scan(self, dirpath, entries):
+        try:
+            content = list(_list_dir(dirpath))
+        except OSError:
+            return
+        for path, is_dir in content:
+            if is_excluded(os.path.basename(path), self.excluded):
+                continue
+            if is_dir:
+                self._scan(path, entries)
+            else:
+                entry = stat(path)
+                if entry is not None:
+                    entries[path] = entry
+
+    def contains(self, path):
+        """contains
+        Return True if path is located in the indexed folder and is not
+        excluded. Such paths are never stat'ed by the index.
+
+        :param path: absolute path.
+        """
+        if not path.startswith(self.root + os.sep):
+            return False
+        for name in os.path.relpath(path, self.root).split(os.sep):
+            if name == os.pardir or is_excluded(name, self.excluded):
+                return False
+        return True
+
+    def get(self, path):
+        """get
+        Return the Entry of a file, or None if the file does not exist. Files
+        that are located out of the indexed folder are stat'ed.
+
+        :param path: absolute path.
+        """
+        # Fast path: indexed files are neither excluded nor out of the folder
+        entry = self._entries.get(path)
+        if entry is not None:
+            return entry
+        path = os.path.normpath(path)
+        if not self.contains(path):
+            if path.startswith(self.root + os.sep):
+                return None
+            return stat(path)
+        return self._entries.get(path)
+
+    def isfile(self, path):
+        return self.get(path) is not None
+
+    def files(self, ext=None):
+        """files
+        Return the sorted list of indexed file paths.
+
+        :param ext: if not None, return only files with this extension (e.g:
+        ".html").
+        """
+        return sorted(path for path, entry in self._entries.iteritems()
+                      if ext is None or entry.ext == ext)
+
+    def update(self, paths):
+        """update
+        Update the entries of files and folders that were modified, created or
+        deleted.
+
+        :param paths: absolute paths.
+        """
+        entries = dict(self._entries)
+        for path in paths:
+            path = os.path.normpath(path)
+            if path == self.root:
+                self.scan()
+                return
+            if not self.contains(path):
+                continue
+            entry = None
+            if os.path.isdir(path) and not os.path.islink(path):
+                # Created or renamed folder: index all its content again
+                prefix = path + os.sep
+                for indexed_path in [p for p in entries if p.startswith(prefix)]:
+                    del entries[indexed_path]
+                self._scan(path, entries)
+            else:
+                entry = stat(path)
+                if entry is None:
+                    # Deleted file or folder
+                    prefix = path + os.sep
+                    for indexed_path in [p for p in entries if p.startswith(prefix)]:
+                        del entries[indexed_path]
+            if entry is None:
+                entries.pop(path, None)
+            else:
+                entries[path] = entry
+        self._entries = entries
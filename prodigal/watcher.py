@@ -0,0 +1,356 @@
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import threading
+import ctypes
+import ctypes.util
+
+import cache
+import jinjaenv
+import manifest
+import media
+import templates
+import tools
+import tree
+
+# inotify event masks, see inotify(7)
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ISDIR        = 0x40000000
+IN_WATCH_MASK   = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |\
+                  IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+class PollingObserver(object):
+    """PollingObserver
+    Detect file modifications by periodically comparing the mtime and size of
+    all files in a folder.
+    """
+    def __init__(self, root, ignored=(), interval=0.5, excluded=None):
+        self.root = root
+        self.ignored = set(ignored)
+        self.excluded = tree.excluded_patterns(excluded)
+        self.interval = interval
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) not in self.ignored
+                           and not tree.is_excluded(d, self.excluded)]
+            for filename in filenames:
+                if tree.is_excluded(filename, self.excluded):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_mtime, st.st_size)
+        return snapshot
+
+    def read(self, timeout=None):
+        """read
+        Return the set of paths that were modified, created or deleted. Block
+        until a modification occurs or until timeout seconds have elapsed.
+
+        :param timeout:
+        """
+        start = time.time()
+        while True:
+            time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+            snapshot = self._snapshot()
+            paths = set(path for path in set(snapshot) | set(self.snapshot)
+                        if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if paths or (timeout is not None and time.time() - start >= timeout):
+                return paths
+
+    def close(self):
+        pass
+
+class ObserverThread(object):
+    """ObserverThread
+    Read the modifications detected by an observer in a background thread,
+    e.g: a PollingObserver, such that reading the pending modifications
+    neither blocks nor scans the watched folder.
+    """
+    def __init__(self, observer):
+        self.observer = observer
+        self._paths = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed.is_set():
+            paths = self.observer.read(self.observer.interval)
+            if paths:
+                with self._lock:
+                    self._paths.update(paths)
+
+    def read(self, timeout=None):
+        """read
+        Return the set of paths that were modified since the previous read,
+        without waiting for new modifications.
+
+        :param timeout: ignored.
+        """
+        with self._lock:
+            paths, self._paths = self._paths, set()
+        return paths
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.observer.close()
+
+class InotifyObserver(object):
+    """InotifyObserver
+    Detect file modifications with the Linux inotify API.
+    """
+    _libc = None
+
+    def __init__(self, root, ignored=(), excluded=None):
+        self.root = root
+        self.ignored = set(ignored)
+        self.excluded = tree.excluded_patterns(excluded)
+        self.fd = self.libc().inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.watches = {}
+        self._add_tree(root)
+
+    @classmethod
+    def libc(cls):
+        if cls._libc is None:
+            cls._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return cls._libc
+
+    @classmethod
+    def is_available(cls):
+        try:
+            return hasattr(cls.libc(), "inotify_init")
+        except OSError:
+            return False
+
+    def _add_tree(self, root):
+        """_add_tree
+        Watch root and all its subfolders. Return the list of files contained
+        in these folders.
+
+        :param root:
+        """
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) not in self.ignored
+                           and not tree.is_excluded(d, self.excluded)]
+            wd = self.libc().inotify_add_watch(self.fd, dirpath, IN_WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = dirpath
+            paths += [os.path.join(dirpath, filename) for filename in filenames]
+        return paths
+
+    def read(self, timeout=None):
+        """read
+        Return the set of paths that were modified, created or deleted. Block
+        until a modification occurs or until timeout seconds have elapsed. If
+        some events were lost, the root folder is returned.
+
+        :param timeout:
+        """
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+        if not ready:
+            return set()
+
+        paths = set()
+        data = os.read(self.fd, 65536)
+        header = struct.Struct("iIII")
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = header.unpack_from(data, offset)
+            offset += header.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                paths.add(self.root)
+                continue
+            if mask & (IN_DELETE_SELF | IN_IGNORED):
+                # The folder was deleted (and reported by its parent folder)
+                # or its watch was removed
+                self.watches.pop(wd, None)
+                continue
+            dirpath = self.watches.get(wd)
+            if dirpath is None:
+                continue
+            path = os.path.join(dirpath, name) if name else dirpath
+            if path in self.ignored or tree.is_excluded(name, self.excluded):
+                continue
+            paths.add(path)
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self._remove_tree(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                paths.update(self._add_tree(path))
+        return paths
+
+    def _remove_tree(self, root):
+        """_remove_tree
+        Stop watching a folder that was moved, along with its subfolders, such
+        that their events are not reported under their previous paths. Moves
+        within the watched folder are watched again under their new paths.
+
+        :param root:
+        """
+        prefix = root + os.sep
+        for wd, dirpath in self.watches.items():
+            if dirpath == root or dirpath.startswith(prefix):
+                self.libc().inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def close(self):
+        os.close(self.fd)
+
+def get_observer(root, ignored=(), polling=False, excluded=None):
+    if polling or not InotifyObserver.is_available():
+        return PollingObserver(root, ignored, excluded=excluded)
+    return InotifyObserver(root, ignored, excluded)
+
+class Builder(object):
+    """Builder
+    Generate a website and regenerate only the files affected by subsequent
+    source modifications. The same environment is reused across rebuilds,
+    unless the translations, _config.html or the front matter of templates
+    are modified. The index of source files is updated with each
+    modification instead of being rebuilt.
+    """
+    def __init__(self, src_path, dst_path, locale=None, excluded=None):
+        self.src_path = os.path.abspath(src_path)
+        self.dst_path = os.path.abspath(dst_path)
+        self.locale = locale
+        self.manifest = manifest.Manifest.for_build(self.src_path, self.dst_path, locale)
+        self.index = tree.TreeIndex(self.src_path, excluded)
+        self.env = None
+
+    @property
+    def po_path(self):
+        if self.locale is None:
+            return None
+        return os.path.join(self.src_path, self.locale + ".po")
+
+    @property
+    def config_paths(self):
+        paths = set(self.env.config_dependencies.templates.itervalues())
+        paths.add(os.path.join(self.src_path, "_config.html"))
+        return paths
+
+    def build(self, translations=True):
+        """build
+        Initialize a new environment and regenerate all files that are not
+        up-to-date. After the first build, the templates that were already
+        loaded are reused.
+
+        :param translations: if False, the translations were not modified
+        since the previous build.
+        """
+        if self.locale is not None:
+            tools.compile_locale(self.src_path, self.locale)
+        if self.env is None:
+            jinjaenv.init(self.src_path, self.locale, index=self.index)
+        else:
+            jinjaenv.reinit(translations and self.locale is not None)
+        self.env = jinjaenv.get()
+        self.manifest.files = manifest.FileStates()
+        tools.render_templates(self.env, self.dst_path, self.manifest)
+        self.manifest.save()
+        tools.copy_media(self.src_path, self.dst_path)
+
+    def update(self, paths):
+        """update
+        Regenerate the files affected by the modification of the given paths.
+        Return False if none of the paths affect the generated files.
+
+        :param paths: set of modified, created or deleted absolute paths.
+        """
+        self.index.update(paths)
+        if (self.src_path in paths or self.po_path in paths or paths & self.config_paths
+                or self.env.is_front_matter_modified(paths)):
+            self.build(self.src_path in paths or self.po_path in paths)
+            return True
+
+        updated = False
+        for folder in media.folders():
+            src_folder = os.path.join(self.src_path, folder)
+            if any(path.startswith(src_folder + os.sep) for path in paths):
+                media.sync(src_folder, os.path.join(self.dst_path, folder))
+                updated = True
+
+        template_paths = set(path for path in paths if templates.should_translate(path)
+                             and self.index.contains(path))
+        urls = set(self.manifest.dependent_urls(template_paths))
+        for path in template_paths:
+            if templates.should_render(path) and self.index.isfile(path):
+                urls.add(path)
+        if urls:
+            self.manifest.files = manifest.FileStates()
+            tools.render_templates(self.env, self.dst_path, self.manifest, urls=sorted(urls))
+            self.manifest.save()
+            updated = True
+        return updated
+
+def watch(src_path, dst_path, locale=None, polling=False, delay=0.02, excluded=None):
+    """watch
+    Generate the website, then watch the source folder and regenerate the
+    files affected by each modification. Events are collected until no new
+    event occurs during `delay` seconds, such that bursts of modifications
+    trigger a single rebuild.
+
+    :param src_path:
+    :param dst_path:
+    :param locale:
+    :param polling:
+    :param delay:
+    :param excluded: glob patterns of files and folders that are ignored.
+    """
+    src_path = os.path.abspath(src_path)
+    ignored = [os.path.join(src_path, cache.DIRNAME), os.path.abspath(dst_path)]
+    # Watch files before the first build, such that no modification is lost
+    observer = get_observer(src_path, ignored, polling, excluded)
+    try:
+        builder = Builder(src_path, dst_path, locale, excluded)
+        builder.build()
+        print "Watching", builder.src_path, "..."
+        while True:
+            paths = observer.read()
+            while True:
+                more_paths = observer.read(delay)
+                if not more_paths:
+                    break
+                paths.update(more_paths)
+
+            start = time.time()
+            try:
+                if builder.update(paths):
+                    print "Regenerated in %d ms" % ((time.time() - start) * 1000)
+            except Exception:
+                logging.exception("Could not regenerate website")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.close()